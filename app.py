@@ -1,10 +1,19 @@
 from __future__ import annotations
-import os, re, threading, time, hashlib, json, logging
-from collections import deque
+import os, re, threading, time, json, logging, fnmatch, bisect, random, heapq, itertools, sqlite3, csv, io, zipfile, zlib
+import base64, functools, hashlib, mmap, socket, struct, tempfile, http.client
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as _futures_wait
 from datetime import datetime, timedelta, timezone
+from urllib.parse import quote, unquote
+from xml.sax.saxutils import escape as _xml_escape
 import requests as http_requests
 from dotenv import load_dotenv
+import numpy as np
 from flask import Flask, jsonify, render_template, request
+from werkzeug.serving import make_server
+try: import fcntl
+except ImportError: fcntl = None
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 load_dotenv()
@@ -30,51 +39,424 @@ _fb_session = http_requests.Session()
 _fb_adapter = http_requests.adapters.HTTPAdapter(pool_connections=20, pool_maxsize=20)
 _fb_session.mount('https://', _fb_adapter)
 _fb_session.mount('http://', _fb_adapter)
-_fb_etags = {}
-_fb_cache = {}
+# --- Metrics --------------------------------------------------------------------
+# Minimal Prometheus instruments; /metrics renders these plus gauges read from
+# the subsystems at scrape time. Firebase paths are reduced to templates
+# (devices/{id}/History/{ph}/{sid}/...) to keep label cardinality bounded.
+_LAT_BUCKETS  = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_metrics_lock = threading.Lock()
+_METRICS      = []
+
+class _Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels, self._v = name, help, labels, {}
+        _METRICS.append(self)
+    def inc(self, *lv, n: float = 1) -> None:
+        with _metrics_lock: self._v[lv] = self._v.get(lv, 0) + n
+    def render(self) -> list:
+        with _metrics_lock: items = sorted(self._v.items())
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter'] + \
+               [f'{self.name}{_prom_labels(self.labels, lv)} {v}' for lv, v in items]
+class _Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = _LAT_BUCKETS):
+        self.name, self.help, self.labels, self.buckets, self._v = name, help, labels, buckets, {}
+        _METRICS.append(self)
+    def observe(self, value: float, *lv) -> None:
+        with _metrics_lock:
+            s = self._v.get(lv)
+            if s is None: s = self._v[lv] = [[0] * (len(self.buckets) + 1), 0.0]
+            s[0][bisect.bisect_left(self.buckets, value)] += 1; s[1] += value
+    def render(self) -> list:
+        with _metrics_lock: items = sorted((lv, (list(c), t)) for lv, (c, t) in self._v.items())
+        out = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for lv, (counts, total) in items:
+            acc = 0
+            for le, c in zip(list(self.buckets) + ['+Inf'], counts):
+                acc += c
+                out.append(f'{self.name}_bucket{_prom_labels(self.labels + ("le",), lv + (le,))} {acc}')
+            out += [f'{self.name}_sum{_prom_labels(self.labels, lv)} {total}', f'{self.name}_count{_prom_labels(self.labels, lv)} {acc}']
+        return out
+def _prom_labels(names: tuple, values: tuple) -> str:
+    if not names: return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in zip(names, values)) + '}'
+_TPL_RULES = ((_PHASE_RE, '{ph}'), (re.compile(r'^session_\d+$'), '{sid}'), (re.compile(r'^capture_\d+$'), '{rec}'),
+              (re.compile(r'^\d{4}-\d{2}-\d{2}$'), '{date}'), (re.compile(r'^\d{4}$'), '{key}'))
+def _path_template(path: str) -> str:
+    parts = [x for x in path.split('/') if x]
+    return '/'.join('{id}' if i == 1 and parts[0] == 'devices' else next((t for rx, t in _TPL_RULES if rx.match(x)), x)
+                    for i, x in enumerate(parts)) or '/'
+
+_m_fb_latency   = _Histogram('fb_request_seconds', 'Firebase REST request latency', ('method', 'path'))
+_m_fb_errors    = _Counter('fb_errors_total', 'Firebase REST failures (timeout, connection, http_<status>)', ('method', 'path', 'kind'))
+_m_live_cycle   = _Histogram('live_cycle_seconds', 'Duration of one live-buffer polling cycle')
+_m_live_overrun = _Counter('live_cycle_overruns_total', 'Live-buffer cycles that exceeded LIVE_CYCLE_BUDGET')
+_m_cap_late     = _Histogram('capture_lateness_seconds', 'Capture tick start minus its scheduled time')
+_m_cap_drift    = _Histogram('capture_drift_seconds', 'Capture sample time (RealTime read done) minus scheduled time')
+_m_cap_missed   = _Counter('capture_missed_ticks_total', 'High-rate capture ticks skipped because the sampler fell behind', ('device',))
+
+def _fb_request(method: str, path: str, **kw):
+    t0, tpl = time.perf_counter(), _path_template(path)
+    try: r = _fb_session.request(method, f'{DB_URL}/{path}.json', **kw)
+    except Exception as e:
+        _m_fb_errors.inc(method, tpl, 'timeout' if isinstance(e, http_requests.Timeout) else 'connection'); raise
+    finally: _m_fb_latency.observe(time.perf_counter() - t0, method, tpl)
+    if not r.ok and r.status_code != 304: _m_fb_errors.inc(method, tpl, f'http_{r.status_code}')
+    return r
+
+# --- GET response cache -------------------------------------------------------
+# ETag revalidation cache shared by every thread: an LRU bounded by
+# FB_CACHE_BYTES (response size), with optional freshness windows per path
+# pattern (FB_CACHE_TTL="devices/*/meta=10,devices=30") during which entries
+# are served without a request. Concurrent GETs of the same path share one
+# HTTP request. A 304 returns the cached object itself, which the change
+# tracker relies on to recognise unchanged data without hashing.
+FB_CACHE_BYTES     = int(os.environ.get('FB_CACHE_BYTES', 32 * 1024 * 1024))
+FB_CACHE_MAX_ENTRY = int(os.environ.get('FB_CACHE_MAX_ENTRY', 0)) or FB_CACHE_BYTES // 8
+FB_CACHE_TTL       = [(k.strip(), float(v)) for k, v in (p.split('=', 1) for p in (os.environ.get('FB_CACHE_TTL') or '').split(',') if '=' in p)]
+
+class _CacheEntry:
+    __slots__ = ('path', 'etag', 'data', 'size', 'fresh_until')
+    def __init__(self, path, etag, data, size, fresh_until):
+        self.path = path; self.etag = etag; self.data = data; self.size = size; self.fresh_until = fresh_until
+class _Flight:
+    __slots__ = ('done', 'result')
+    def __init__(self): self.done = threading.Event(); self.result = None
+
+class _ResponseCache:
+    def __init__(self, budget: int):
+        self._lock     = threading.Lock()
+        self._entries  = OrderedDict()
+        self._inflight = {}
+        self._bytes    = 0
+        self.budget    = budget
+        self.stats     = {'hits': 0, 'misses': 0, 'not_modified': 0, 'coalesced': 0, 'evictions': 0,
+                          'invalidations': 0, 'uncacheable': 0, 'errors': 0}
+    @staticmethod
+    def ttl(path: str) -> float:
+        return next((t for pat, t in FB_CACHE_TTL if fnmatch.fnmatchcase(path, pat)), 0.0)
+    def get(self, path: str, params: dict | None = None):
+        params = dict(params or {})
+        key    = f'{path}_shallow' if params.get('shallow') else path
+        with self._lock:
+            e = self._entries.get(key)
+            if e is not None and e.fresh_until > time.monotonic():
+                self._entries.move_to_end(key); self.stats['hits'] += 1
+                return e.data
+            fl = self._inflight.get(key)
+            leader = fl is None
+            if leader: fl = self._inflight[key] = _Flight()
+            else: self.stats['coalesced'] += 1
+        if not leader:
+            fl.done.wait(12)
+            return fl.result
+        try: fl.result = self._fetch(path, key, params, e)
+        finally:
+            with self._lock: self._inflight.pop(key, None)
+            fl.done.set()
+        return fl.result
+    def _fetch(self, path: str, key: str, params: dict, e: _CacheEntry | None):
+        headers = {'X-Firebase-ETag': 'true'}
+        if e is not None: headers['If-None-Match'] = e.etag
+        params['x-header'] = 'etag'
+        try: r = _fb_request('GET', path, timeout=6, headers=headers, params=params)
+        except Exception:
+            with self._lock: self.stats['errors'] += 1
+            return None
+        ttl = self.ttl(path)
+        if r.status_code == 304 and e is not None:
+            with self._lock:
+                self.stats['not_modified'] += 1
+                e.fresh_until = time.monotonic() + ttl if ttl else 0.0
+                if self._entries.get(key) is e: self._entries.move_to_end(key)
+                else: self._store(key, e)
+            return e.data
+        if not r.ok:
+            with self._lock: self.stats['errors'] += 1
+            return None
+        data, etag = r.json(), r.headers.get('ETag')
+        with self._lock:
+            self.stats['misses'] += 1
+            if etag and len(r.content) <= FB_CACHE_MAX_ENTRY:
+                self._store(key, _CacheEntry(path, etag, data, len(r.content), time.monotonic() + ttl if ttl else 0.0))
+            else:
+                self.stats['uncacheable'] += 1
+                self._drop(key)
+        return data
+    def _store(self, key: str, e: _CacheEntry) -> None:
+        self._drop(key)
+        self._entries[key] = e; self._bytes += e.size
+        while self._bytes > self.budget and len(self._entries) > 1:
+            _, old = self._entries.popitem(last=False); self._bytes -= old.size; self.stats['evictions'] += 1
+    def _drop(self, key: str) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None: self._bytes -= old.size
+    def invalidate(self, paths) -> None:
+        # Only entries inside a freshness window can go stale; the rest revalidate anyway
+        if not FB_CACHE_TTL: return
+        paths = [p.strip('/') for p in paths]
+        with self._lock:
+            for key, e in list(self._entries.items()):
+                if e.fresh_until and any(e.path == p or e.path.startswith(p + '/') or p.startswith(e.path + '/') for p in paths):
+                    self._drop(key); self.stats['invalidations'] += 1
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {**self.stats, 'entries': len(self._entries), 'bytes': self._bytes, 'budget': self.budget,
+                    'inflight': len(self._inflight), 'ttl': dict(FB_CACHE_TTL)}
+_fb_cache = _ResponseCache(FB_CACHE_BYTES)
 
 def _fb(method: str, path: str, **kw):
     try:
-        url = f'{DB_URL}/{path}.json'
-        # Add ETag caching only for GET requests
-        if method == 'GET':
-            headers = kw.get('headers', {})
-            params = kw.get('params', {})
-            
-            # Extract or set params
-            shallow = params.get('shallow')
-            cache_key = f'{path}_shallow' if shallow else path
-            
-            if cache_key in _fb_etags:
-                headers['If-None-Match'] = _fb_etags[cache_key]
-            
-            params['x-header'] = 'etag'
-            kw['headers'] = headers
-            kw['params'] = params
-            
-            r = _fb_session.request(method, url, timeout=6, **kw)
-            if r.status_code == 304:
-                return _fb_cache.get(cache_key)
-            if r.ok:
-                resp_etag = r.headers.get('ETag')
-                data = r.json()
-                if resp_etag:
-                    _fb_etags[cache_key] = resp_etag
-                    _fb_cache[cache_key] = data
-                return data
-            return None
-        
-        # For non-GET requests
-        r = _fb_session.request(method, url, timeout=6, **kw)
+        # GETs go through the shared cache (paged/one-off reads opt out)
+        if method == 'GET' and kw.pop('cache', True):
+            return _fb_cache.get(path, kw.get('params'))
+        r = _fb_request(method, path, timeout=6, **kw)
+        if r.ok and method != 'GET': _fb_cache.invalidate([path])
         return r.json() if r.ok else None
     except Exception: return None
 
 fb_get    = lambda p:    _fb('GET',    p)
 def fb_get_shallow(path: str):
     return _fb('GET', path, params={'shallow': 'true'})
+def fb_get_page(path: str, start_at: str | None = None, end_at: str | None = None, limit: int = 500) -> dict:
+    params = {'orderBy': '"$key"', 'limitToFirst': limit}
+    if start_at is not None: params['startAt'] = json.dumps(start_at)
+    if end_at is not None:   params['endAt']   = json.dumps(end_at)
+    data = _fb('GET', path, params=params, cache=False)
+    return data if isinstance(data, dict) else {}
 fb_put    = lambda p, d: _fb('PUT',    p, json=d) is not None
 fb_patch  = lambda p, d: _fb('PATCH',  p, json=d) is not None
 fb_delete = lambda p:    _fb('DELETE', p) is not None
+# --- Write-behind queue -------------------------------------------------------
+# Background writes are collected into root-level multi-path PATCH requests.
+# A path that is an ancestor/descendant of a pending path starts a new batch
+# (RTDB rejects overlapping paths in one update), so write order is kept.
+# Batches are numbered; flush() waits only for the batches that were pending
+# when it was called, so steady new writes cannot hold it up.
+FB_WRITE_BATCH_MAX = int(os.environ.get('FB_WRITE_BATCH_MAX', 500))
+FB_WRITE_BATCH_AGE = float(os.environ.get('FB_WRITE_BATCH_AGE', 0.5))
+FB_WRITE_QUEUE_MAX = int(os.environ.get('FB_WRITE_QUEUE_MAX', 50000))
+FB_WRITE_RETRIES   = int(os.environ.get('FB_WRITE_RETRIES', 5))
+
+class _WriteBatch:
+    __slots__ = ('seq', 'updates', 'prefixes', 'first_at')
+    def __init__(self, seq: int): self.seq = seq; self.updates = {}; self.prefixes = set(); self.first_at = None
+    def conflicts(self, path: str) -> bool:
+        if path in self.prefixes: return True
+        parts = path.split('/')
+        return any('/'.join(parts[:i]) in self.updates for i in range(1, len(parts)))
+    def add(self, path: str, value) -> None:
+        if self.first_at is None: self.first_at = time.monotonic()
+        self.updates[path] = value
+        parts = path.split('/')
+        self.prefixes.update('/'.join(parts[:i]) for i in range(1, len(parts)))
+
+class _WriteQueue:
+    def __init__(self):
+        self._cond    = threading.Condition()
+        self._batches = deque([_WriteBatch(1)])
+        self._depth   = 0
+        self._done    = 0          # seq of the last batch sent (or given up on)
+        self._urgent  = 0          # batches up to this seq are sent without waiting
+        self.stats    = {'enqueued': 0, 'written': 0, 'requests': 0, 'retries': 0,
+                         'dropped': 0, 'failed': 0, 'last_error': None}
+        threading.Thread(target=self._run, daemon=True).start()
+    def _enqueue(self, items: list) -> bool:
+        with self._cond:
+            if self._depth + len(items) > FB_WRITE_QUEUE_MAX:
+                self.stats['dropped'] += len(items); return False
+            for path, value in items:
+                path = path.strip('/'); b = self._batches[-1]
+                if path in b.updates: b.updates[path] = value; continue
+                if b.conflicts(path) or len(b.updates) >= FB_WRITE_BATCH_MAX:
+                    b = _WriteBatch(b.seq + 1); self._batches.append(b)
+                b.add(path, value); self._depth += 1
+            self.stats['enqueued'] += len(items)
+            self._cond.notify_all()
+        return True
+    def put(self, path: str, value) -> bool: return self._enqueue([(path, value)])
+    def patch(self, path: str, data: dict) -> bool: return self._enqueue([(f'{path}/{k}', v) for k, v in data.items()])
+    def delete(self, path: str) -> bool: return self._enqueue([(path, None)])
+    def flush(self, timeout: float = 30) -> bool:
+        with self._cond:
+            b = self._batches[-1]
+            target = b.seq if b.updates else b.seq - 1
+            if target <= self._done: return True
+            self._urgent = max(self._urgent, target); self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._done >= target, timeout)
+    def snapshot(self) -> dict:
+        with self._cond: return {**self.stats, 'depth': self._depth, 'batches': len(self._batches)}
+    def _ready(self, b: _WriteBatch) -> bool:
+        return bool(b.updates) and (b.seq <= self._urgent or len(self._batches) > 1 or len(b.updates) >= FB_WRITE_BATCH_MAX
+                                    or time.monotonic() - b.first_at >= FB_WRITE_BATCH_AGE)
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._ready(self._batches[0]):
+                    b = self._batches[0]
+                    self._cond.wait(None if not b.updates else max(0.01, FB_WRITE_BATCH_AGE - (time.monotonic() - b.first_at)))
+                b = self._batches.popleft()
+                if not self._batches: self._batches.append(_WriteBatch(b.seq + 1))
+            ok = self._send(b.updates)
+            with self._cond:
+                self._depth -= len(b.updates)
+                self.stats['written' if ok else 'failed'] += len(b.updates)
+                self._done = b.seq
+                self._cond.notify_all()
+    def _send(self, updates: dict) -> bool:
+        delay = 0.5
+        for attempt in range(FB_WRITE_RETRIES + 1):
+            try:
+                r = _fb_request('PATCH', '', json=updates, timeout=15)
+                with self._cond: self.stats['requests'] += 1
+                if r.ok: _fb_cache.invalidate(updates); return True
+                err = f'HTTP {r.status_code}'
+                if r.status_code < 500 and r.status_code not in (408, 429): break
+            except Exception as e: err = type(e).__name__
+            with self._cond: self.stats['last_error'] = err
+            if attempt == FB_WRITE_RETRIES: break
+            with self._cond: self.stats['retries'] += 1
+            time.sleep(delay * (0.5 + random.random() / 2)); delay = min(delay * 2, 30)
+        print(f"Firebase write batch failed ({len(updates)} paths): {err}")
+        return False
+_fb_writes = _WriteQueue()
+# --- Background scheduler ---------------------------------------------------
+# All short-lived background work goes through one bounded pool. Tasks may
+# carry a key: a second submit while the key is queued/running is skipped
+# ('skip') or folded into a single re-run after the current one ('merge').
+# `deadline` is how many seconds after its scheduled time a task may still
+# start; later than that it is dropped and counted as expired.
+# Long blocking jobs (finalize, archive, shift, retention, prune) pass
+# bulk=True and run on a small pool of their own, so they cannot hold the
+# workers that deadline-bound capture ticks and live polls need.
+BG_WORKERS      = int(os.environ.get('BG_WORKERS', 32))
+BG_BULK_WORKERS = int(os.environ.get('BG_BULK_WORKERS', 4))
+
+class _Scheduler:
+    def __init__(self, workers: int, bulk_workers: int):
+        self._pool   = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bg')
+        self._bulk   = ThreadPoolExecutor(max_workers=bulk_workers, thread_name_prefix='bulk')
+        self._cond   = threading.Condition()
+        self._timers = []
+        self._seq    = itertools.count()
+        self._keys   = {}
+        self._rerun  = {}
+        self.workers, self.bulk_workers = workers, bulk_workers
+        self.stats   = {'submitted': 0, 'completed': 0, 'failed': 0, 'collapsed': 0, 'merged': 0, 'expired': 0,
+                        'queued': 0, 'running': 0, 'lateness_last': 0.0, 'lateness_max': 0.0, 'lateness_avg': 0.0}
+        threading.Thread(target=self._timer_loop, daemon=True).start()
+    def submit(self, fn, *args, key=None, deadline: float | None = None, overlap: str = 'skip',
+               sched: float | None = None, bulk: bool = False, **kw):
+        with self._cond:
+            if key is not None and key in self._keys:
+                if overlap == 'merge' and self._keys[key] == 'running':
+                    self._rerun[key] = (fn, args, kw, deadline, bulk); self.stats['merged'] += 1
+                else: self.stats['collapsed'] += 1
+                return None
+            if key is not None: self._keys[key] = 'queued'
+            self.stats['submitted'] += 1; self.stats['queued'] += 1
+        return (self._bulk if bulk else self._pool).submit(self._run, fn, args, kw, key, deadline,
+                                                          time.monotonic() if sched is None else sched)
+    def call_later(self, delay: float, fn, *args, **kw) -> None:
+        self._arm(time.monotonic() + delay, None, fn, args, kw)
+    def every(self, interval: float, fn, *args, first: float | None = None, **kw) -> None:
+        self._arm(time.monotonic() + (interval if first is None else first), interval, fn, args, kw)
+    def _arm(self, when: float, period, fn, args, kw) -> None:
+        with self._cond:
+            heapq.heappush(self._timers, (when, next(self._seq), period, fn, args, kw))
+            self._cond.notify()
+    def _timer_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._timers or self._timers[0][0] > time.monotonic():
+                    self._cond.wait(self._timers[0][0] - time.monotonic() if self._timers else None)
+                when, _, period, fn, args, kw = heapq.heappop(self._timers)
+                if period:
+                    nxt = when + period
+                    while nxt <= time.monotonic(): nxt += period
+                    heapq.heappush(self._timers, (nxt, next(self._seq), period, fn, args, kw))
+            self.submit(fn, *args, sched=when, **kw)
+    def _run(self, fn, args, kw, key, deadline, sched) -> None:
+        late = max(0.0, time.monotonic() - sched)
+        with self._cond:
+            st = self.stats
+            st['queued'] -= 1
+            st['lateness_last'] = late; st['lateness_max'] = max(st['lateness_max'], late)
+            st['lateness_avg'] = late if not st['completed'] else st['lateness_avg'] * 0.95 + late * 0.05
+            if deadline is not None and late > deadline:
+                st['expired'] += 1
+                if key is not None: self._keys.pop(key, None); self._cond.notify_all()
+                return
+            st['running'] += 1
+            if key is not None: self._keys[key] = 'running'
+        ok = True
+        try: fn(*args, **kw)
+        except Exception: ok = False
+        finally:
+            with self._cond:
+                self.stats['running'] -= 1; self.stats['completed' if ok else 'failed'] += 1
+                rerun = self._rerun.pop(key, None) if key is not None else None
+                if key is not None: self._keys.pop(key, None); self._cond.notify_all()
+            if rerun:
+                rfn, rargs, rkw, rdl, rbulk = rerun
+                self.submit(rfn, *rargs, key=key, deadline=rdl, overlap='merge', bulk=rbulk, **rkw)
+    def wait_idle(self, pred, timeout: float | None = None) -> bool:
+        # Block until no queued/running task has a key matching `pred`
+        with self._cond: return self._cond.wait_for(lambda: not any(pred(k) for k in self._keys), timeout)
+    def snapshot(self) -> dict:
+        with self._cond: return {**self.stats, 'workers': self.workers, 'bulk_workers': self.bulk_workers, 'timers': len(self._timers), 'keys': len(self._keys)}
+_scheduler = _Scheduler(BG_WORKERS, BG_BULK_WORKERS)
+
+# --- Single-leader ingestion (LEADER_MODE) ----------------------------------
+# Under gunicorn every worker imports this module. With LEADER_MODE=1 one
+# process holds an flock on SHARED_DIR/leader.lock and runs the pollers, the
+# capture sampler and the periodic jobs; it publishes live rings and capture
+# state as memory-mapped files in SHARED_DIR. The other workers serve reads
+# from those files and forward writes to the leader over SHARED_DIR/leader.sock.
+LEADER_MODE          = (os.environ.get('LEADER_MODE') or '').strip().lower() in ('1', 'true', 'yes', 'on')
+SHARED_DIR           = os.environ.get('SHARED_DIR') or os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'sem-shared')
+SHARED_MAX_PHASES    = int(os.environ.get('SHARED_MAX_PHASES', 4))
+SHARED_STATE_BYTES   = int(os.environ.get('SHARED_STATE_BYTES', 4 * 1024 * 1024))
+SHARED_PUBLISH_S     = float(os.environ.get('SHARED_PUBLISH_S', 0.5))
+LEADER_RETRY_S       = float(os.environ.get('LEADER_RETRY_S', 2))
+LEADER_PROXY_TIMEOUT = float(os.environ.get('LEADER_PROXY_TIMEOUT', 60))
+if LEADER_MODE and fcntl is None:
+    print('LEADER_MODE needs fcntl (POSIX); running as a single process'); LEADER_MODE = False
+_leader = {'role': 'follower' if LEADER_MODE else 'single', 'fd': None, 'since': None}
+_ingest_fns = []
+
+def _ingest_start(fn) -> None:
+    # Background ingestion runs only in the elected process (see _leader_promote)
+    _ingest_fns.append(fn)
+    if _leader['role'] != 'follower': fn()
+def _is_follower() -> bool: return _leader['role'] == 'follower'
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout); self._sock_path = path
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout); self.sock.connect(self._sock_path)
+def _via_leader(fn):
+    # Routes that change or report ingestion state run in the leader process
+    @functools.wraps(fn)
+    def wrapper(*a, **kw):
+        if not _is_follower():
+            res = fn(*a, **kw)
+            if LEADER_MODE: _shared_publish()
+            return res
+        conn = _UnixHTTPConnection(os.path.join(SHARED_DIR, 'leader.sock'), LEADER_PROXY_TIMEOUT)
+        try:
+            headers = {k: v for k, v in request.headers.items() if k.lower() in ('content-type', 'accept', 'if-none-match')}
+            conn.request(request.method, request.full_path if request.query_string else request.path,
+                         body=request.get_data(), headers=headers)
+            r = conn.getresponse(); body = r.read()
+        except (OSError, http.client.HTTPException):
+            return jsonify({'ok': False, 'error': 'Leader tidak tersedia'}), 503
+        finally: conn.close()
+        return app.response_class(body, status=r.status, headers=[(k, v) for k, v in r.getheaders()
+                                                                   if k.lower() in ('content-type', 'etag', 'cache-control')])
+    return wrapper
+
 def normalize(raw: dict | None) -> dict | None:
     if not raw: return None
     try:
@@ -111,28 +493,189 @@ def validate_device_name(name: str) -> tuple[bool, str]:
     if any(c in name for c in '/.$#[]'): return False, 'Karakter tidak diizinkan: / . $ # [ ]'
     return True, ''
 def validate_phase_key(phase: str) -> bool: return bool(_PHASE_RE.match(phase))
-_capture_lock  = threading.Lock()
-_capture_state = {
-    'active': False, 'device_id': None, 'device_name': None,
-    'session_id': None, 'session_name': None, 'interval': 3,
-    'count': 0, 'started_at': None, 'enabled_phases': None,
-    '_thread': None, '_stop_event': None, '_wake_event': None, '_finalizing': False, 'time_offset_ms': 0,
-}
-def _data_hash(raw): return hashlib.md5(json.dumps(raw, sort_keys=True).encode()).hexdigest() if raw else None
-_hourly_stop = threading.Event()
-_device_hourly_hash = {}
+_RECORD_FIELDS = (
+    ('Voltage', 'Voltage (V)'), ('Current', 'Current (A)'), ('Power', 'Power (W)'),
+    ('Apparent', 'Apparent Power (kVA)'), ('Reactive', 'Reactive Power (kVAR)'),
+    ('Energy', 'Active Energy (kWh)'), ('Frequency', 'Frequency (Hz)'),
+    ('PowerFactor', 'Power Factor'), ('Phase1', 'Phase Angle (°)'),
+    ('EnergyApparent', 'Apparent Energy (kVAh)'), ('EnergyReactive', 'Reactive Energy (kVARh)'),
+)
+def _phase_record(pd: dict | None) -> dict:
+    def f(k):
+        try: return float((pd or {}).get(k) or 0)
+        except: return 0.0
+    return {name: f(k) for name, k in _RECORD_FIELDS}
+# Capture sessions keyed by session id. A device may have several live sessions;
+# they share its RealTime reads and only the first one sends resetEnergy.
+_capture_lock     = threading.Lock()
+_capture_sessions = {}
+_capture_defaults = {'interval': 3}
+_capture_wake     = threading.Event()
+# --- Change detection ---------------------------------------------------------
+# One tracker per device, fed by every RealTime read (live buffer, hourly and
+# session capture). A 304 or an untouched stream snapshot hands back the very
+# object seen last time, so identity alone means "unchanged" and nothing is
+# serialised or hashed. Otherwise values are diffed field by field against the
+# last accepted ones into a change record; CHANGE_DEADBAND ("Power (W)=5,...")
+# sets per-field thresholds below which a numeric move is not a change.
+# Consumers remember the last `seq` they acted on.
+CHANGE_DEADBAND = {k.strip(): float(v) for k, _, v in (p.partition('=') for p in os.environ.get('CHANGE_DEADBAND', '').split(','))
+                   if k.strip() and v.strip()}
+CHANGE_LOG_MAX  = int(os.environ.get('CHANGE_LOG_MAX', 64))
+_MISSING = object()
+
+class _DeviceChanges:
+    __slots__ = ('raw', 'values', 'seq', 'last_change_ms', 'log', 'reads', 'same', 'diffed')
+    def __init__(self):
+        self.raw = None; self.values = {}; self.seq = 0; self.last_change_ms = None
+        self.log = deque(maxlen=CHANGE_LOG_MAX); self.reads = 0; self.same = 0; self.diffed = 0
+    def diff(self, raw: dict) -> dict:
+        changes = {}
+        for k, v in raw.items():
+            fields, old = (v if isinstance(v, dict) else {'': v}), self.values.setdefault(k, {})
+            for f, nv in fields.items():
+                ov = old.get(f, _MISSING)
+                if ov == nv: continue
+                if type(nv) in (int, float) and type(ov) in (int, float):
+                    dv = nv - ov
+                    if abs(dv) < CHANGE_DEADBAND.get(f, 0.0): continue
+                else: dv = None
+                changes.setdefault(k, {})[f] = dv; old[f] = nv
+            for f in [f for f in old if f not in fields]: old.pop(f); changes.setdefault(k, {})[f] = None
+        for k in [k for k in self.values if k not in raw]: self.values.pop(k); changes[k] = None
+        return changes
+
+class _ChangeTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dev  = {}
+    def observe(self, did: str, raw, now_ms: int) -> dict | None:
+        if not raw or not isinstance(raw, dict): return None
+        with self._lock:
+            d = self._dev.get(did)
+            if d is None: d = self._dev[did] = _DeviceChanges()
+            d.reads += 1
+            if raw is d.raw: d.same += 1; return None
+            d.raw = raw; d.diffed += 1
+            changes = d.diff(raw)
+            if not changes: return None
+            d.seq += 1; d.last_change_ms = now_ms
+            rec = {'seq': d.seq, 'ts': now_ms, 'phases': sorted(k for k in changes if _PHASE_RE.match(k)), 'changes': changes}
+            d.log.append(rec)
+            return rec
+    def seq(self, did: str) -> int:
+        d = self._dev.get(did)
+        return d.seq if d else 0
+    def last_change_ms(self, did: str) -> int | None:
+        d = self._dev.get(did)
+        return d.last_change_ms if d else None
+    def since(self, did: str, seq: int = 0) -> list:
+        with self._lock:
+            d = self._dev.get(did)
+            return [r for r in d.log if r['seq'] > seq] if d else []
+    def stats(self) -> dict:
+        with self._lock:
+            return {did: {'seq': d.seq, 'last_change_ms': d.last_change_ms, 'reads': d.reads,
+                          'unchanged_identity': d.same, 'diffed': d.diffed} for did, d in self._dev.items()}
+_changes = _ChangeTracker()
+_device_hourly_seq = {}
+
+# --- Running day aggregates ----------------------------------------------------
+# Per (device, phase, day). The newest 5-minute bucket is held apart as the
+# "tail" because it is re-written while its bucket is open; everything older
+# is folded into count/sum/min/max, so replacing the tail stays exact.
+# Consumed energy follows _counter_delta: positive steps add up, and after a
+# drop (resetEnergy) the new counter value itself is added.
+_DAY_FIELDS = ('Voltage', 'Current', 'Power', 'Apparent', 'Reactive', 'Energy', 'Frequency', 'PowerFactor', 'Phase1')
+_DAY_E, _DAY_P = _DAY_FIELDS.index('Energy'), _DAY_FIELDS.index('Power')
+
+class _DayAgg:
+    __slots__ = ('n', 'sum', 'min', 'max', 'peak', 'peak_key', 'first_key', 'energy_first', 'consumed', 'energy_prev',
+                 'tail_key', 'tail', 'dirty')
+    def __init__(self):
+        self.n = 0; self.sum = [0.0] * len(_DAY_FIELDS)
+        self.min = [float('inf')] * len(_DAY_FIELDS); self.max = [float('-inf')] * len(_DAY_FIELDS)
+        self.peak = None; self.peak_key = None; self.first_key = None; self.energy_first = None
+        self.consumed = 0.0; self.energy_prev = None
+        self.tail_key = None; self.tail = None; self.dirty = False
+    def _fold(self, key: str, vals: tuple) -> None:
+        self.n += 1
+        for i, v in enumerate(vals):
+            self.sum[i] += v
+            if v < self.min[i]: self.min[i] = v
+            if v > self.max[i]: self.max[i] = v
+        if self.peak is None or vals[_DAY_P] > self.peak: self.peak, self.peak_key = vals[_DAY_P], key
+        self.consumed = self._step(self.consumed, vals[_DAY_E]); self.energy_prev = vals[_DAY_E]
+    def _step(self, consumed: float, e: float) -> float:
+        if self.energy_prev is None: return consumed
+        return consumed + (e - self.energy_prev if e >= self.energy_prev else e)
+    def add(self, key: str, rec: dict) -> None:
+        vals = []
+        for f in _DAY_FIELDS:
+            try: vals.append(float(rec.get(f) or 0))
+            except (TypeError, ValueError): vals.append(0.0)
+        vals = tuple(vals)
+        if self.tail_key is not None and key != self.tail_key: self._fold(self.tail_key, self.tail)
+        self.tail_key, self.tail = key, vals
+        if self.first_key is None or key <= self.first_key: self.first_key, self.energy_first = key, vals[_DAY_E]
+        self.dirty = True
+    def record(self, date: str) -> dict:
+        n, sm, mn, mx = self.n, list(self.sum), list(self.min), list(self.max)
+        peak, peak_key = self.peak, self.peak_key
+        if self.tail is not None:
+            n += 1
+            for i, v in enumerate(self.tail): sm[i] += v; mn[i] = min(mn[i], v); mx[i] = max(mx[i], v)
+            if peak is None or self.tail[_DAY_P] > peak: peak, peak_key = self.tail[_DAY_P], self.tail_key
+        e_last = self.tail[_DAY_E] if self.tail is not None else 0.0
+        e_first = self.energy_first or 0.0
+        consumed = self._step(self.consumed, e_last) if self.tail is not None else self.consumed
+        rec = {'date': date, 'sampleCount': n}
+        rec.update({f: round(sm[i] / n, 4) if n else 0.0 for i, f in enumerate(_DAY_FIELDS)})
+        rec.update({
+            'Min': {f: round(mn[i], 4) for i, f in enumerate(_DAY_FIELDS)} if n else {},
+            'Max': {f: round(mx[i], 4) for i, f in enumerate(_DAY_FIELDS)} if n else {},
+            'EnergyFirst': round(e_first, 4), 'EnergyLast': round(e_last, 4),
+            'EnergyConsumed': round(consumed, 4),
+            'PeakPower': round(peak or 0.0, 4), 'PeakPowerKey': peak_key,
+        })
+        return rec
+_day_aggs = {}
+_day_aggs_warm = set()
+_day_aggs_lock = threading.Lock()
+
+def _day_agg_warm(device_id: str, date_str: str) -> None:
+    # Cold start only: seed today's aggregates from what is already in Firebase
+    with _day_aggs_lock:
+        if (device_id, date_str) in _day_aggs_warm: return
+    hourly = fb_get(f'devices/{device_id}/HourlyCapture/{date_str}') or {}
+    with _day_aggs_lock:
+        if (device_id, date_str) in _day_aggs_warm: return
+        _day_aggs_warm.add((device_id, date_str))
+        yday = (datetime.strptime(date_str, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+        for k in [k for k in _day_aggs if k[0] == device_id and k[2] < yday]: del _day_aggs[k]
+        _day_aggs_warm.difference_update({k for k in _day_aggs_warm if k[0] == device_id and k[1] < yday})
+        if not isinstance(hourly, dict): return
+        for ph, entries in hourly.items():
+            if not _PHASE_RE.match(ph) or not isinstance(entries, dict): continue
+            agg = _day_aggs.setdefault((device_id, ph, date_str), _DayAgg())
+            for key in sorted(entries):
+                e = entries[key]
+                if isinstance(e, dict) and e.get('date') == date_str: agg.add(key, e)
+def _day_agg_add(device_id: str, ph: str, date_str: str, key: str, rec: dict) -> None:
+    with _day_aggs_lock: _day_aggs.setdefault((device_id, ph, date_str), _DayAgg()).add(key, rec)
 
 def _do_hourly_capture_device(device_id: str) -> None:
     try:
-        raw = fb_get(f'devices/{device_id}/RealTime')
+        raw = fb_get_realtime(device_id)
         if not raw or not isinstance(raw, dict): return
         
-        h = _data_hash(raw)
-        was_empty = (device_id not in _device_hourly_hash)
-        if _device_hourly_hash.get(device_id) == h:
+        _changes.observe(device_id, raw, int(time.time() * 1000))
+        seq  = _changes.seq(device_id)
+        prev = _device_hourly_seq.get(device_id)
+        if prev == seq:
             return
-        _device_hourly_hash[device_id] = h
-        if was_empty:
+        _device_hourly_seq[device_id] = seq
+        if prev is None:
             return
         
         now = datetime.now(_WIB)
@@ -142,170 +685,970 @@ def _do_hourly_capture_device(device_id: str) -> None:
         ts  = f'{now.strftime("%H")}:{str(m).zfill(2)} {now.strftime("%d/%m/%Y")}'
         phases = sorted([k for k in raw if _PHASE_RE.match(k)], key=lambda x: int(x[1:]))
         if not phases: return
-        def _w(ph: str) -> None:
+        _day_agg_warm(device_id, date_str)
+        for ph in phases:
             pd = raw.get(ph) or {}
             def f(k):
                 try: return float(pd.get(k) or 0)
                 except: return 0.0
-            fb_put(f'devices/{device_id}/HourlyCapture/{date_str}/{ph}/{key}', {
+            rec = {
                 'date': date_str, 'key': key, 'timestamp': ts,
                 'Voltage': f('Voltage (V)'), 'Current': f('Current (A)'), 'Power': f('Power (W)'),
                 'Apparent': f('Apparent Power (kVA)'), 'Reactive': f('Reactive Power (kVAR)'),
                 'Energy': f('Active Energy (kWh)'), 'Frequency': f('Frequency (Hz)'),
                 'PowerFactor': f('Power Factor'), 'Phase1': f('Phase Angle (°)'),
-            })
-        ts_list = [threading.Thread(target=_w, args=(ph,), daemon=True) for ph in phases]
-        for t in ts_list: t.start()
-        for t in ts_list: t.join(timeout=8)
-        
-        all_hourly_dates = fb_get_shallow(f'devices/{device_id}/HourlyCapture') or {}
-        if isinstance(all_hourly_dates, dict):
-            old_dates = sorted([k for k in all_hourly_dates.keys() if '-' in k])
-            for old_date in old_dates[:-30]:
-                fb_delete(f'devices/{device_id}/HourlyCapture/{old_date}')
-
+            }
+            _fb_writes.put(f'devices/{device_id}/HourlyCapture/{date_str}/{ph}/{key}', rec)
+            _day_agg_add(device_id, ph, date_str, key, rec)
     except Exception: pass
 def _do_day_capture_device(device_id: str) -> None:
     try:
         today  = datetime.now(_WIB).strftime('%Y-%m-%d')
-        hourly = fb_get(f'devices/{device_id}/HourlyCapture/{today}') or {}
-        phases = sorted([k for k in hourly if _PHASE_RE.match(k)], key=lambda x: int(x[1:]))
-        for ph in phases:
-            entries = [v for v in (hourly.get(ph) or {}).values() if isinstance(v, dict) and v.get('date') == today]
-            if not entries: continue
-            def avg(field: str) -> float:
-                vals = [float(e[field]) for e in entries if field in e and e[field] is not None]
-                return round(sum(vals) / len(vals), 4) if vals else 0.0
-            fb_put(f'devices/{device_id}/DayCapture/{ph}/{today}', {
-                'date': today, 'sampleCount': len(entries),
-                'Voltage': avg('Voltage'), 'Current': avg('Current'), 'Power': avg('Power'),
-                'Apparent': avg('Apparent'), 'Reactive': avg('Reactive'), 'Energy': avg('Energy'),
-                'Frequency': avg('Frequency'), 'PowerFactor': avg('PowerFactor'), 'Phase1': avg('Phase1'),
-            })
-            all_days = fb_get_shallow(f'devices/{device_id}/DayCapture/{ph}') or {}
-            for old in sorted(all_days)[:-30]:
-                fb_delete(f'devices/{device_id}/DayCapture/{ph}/{old}')
+        _day_agg_warm(device_id, today)
+        with _day_aggs_lock:
+            changed = []
+            for (did, ph, day), agg in _day_aggs.items():
+                if did == device_id and day == today and agg.dirty and (agg.n or agg.tail is not None):
+                    changed.append((ph, agg.record(today))); agg.dirty = False
+        for ph, rec in sorted(changed, key=lambda x: int(x[0][1:])):
+            _fb_writes.put(f'devices/{device_id}/DayCapture/{ph}/{today}', rec)
     except Exception: pass
 def _chain_capture_and_day(device_id: str) -> None:
     _do_hourly_capture_device(device_id)
-    time.sleep(3)
-    _do_day_capture_device(device_id)
+    _scheduler.call_later(3, _do_day_capture_device, device_id, key=f'day:{device_id}', overlap='merge', deadline=120)
 def _do_hourly_capture_all() -> None:
     try:
         devices_shallow = fb_get_shallow('devices') or {}
         for did in devices_shallow.keys():
-            threading.Thread(target=_chain_capture_and_day, args=(did,), daemon=True).start()
+            _scheduler.submit(_chain_capture_and_day, did, key=f'hourly:{did}', deadline=240)
     except Exception: pass
 def _hourly_worker() -> None:
     INTERVAL = 300
     now = datetime.now(_WIB)
     ns  = now.replace(minute=((now.minute // 5) + 1) * 5 % 60, second=0, microsecond=0)
     if ns <= now: ns += timedelta(hours=1)
-    if not _hourly_stop.wait(timeout=(ns - now).total_seconds()):
-        _do_hourly_capture_all()
-    while not _hourly_stop.is_set():
-        if _hourly_stop.wait(timeout=INTERVAL): break
-        _do_hourly_capture_all()
-threading.Thread(target=_hourly_worker, daemon=True).start()
-
-_device_live_hash = {}
-_device_last_change_ms = {}
+    _scheduler.every(INTERVAL, _do_hourly_capture_all, first=(ns - now).total_seconds(), key='hourly-all', deadline=240)
+_ingest_start(_hourly_worker)
+
+# --- Retention ----------------------------------------------------------------
+# Runs once a day at RETENTION_AT (WIB) instead of inside the 5-minute cycle.
+# RETENTION holds days to keep per node type, optionally per device:
+# "HourlyCapture=30,DayCapture=30,History=365,dev7:History=90" (0 = keep all).
+# Expired date / session nodes are removed as null entries through the write
+# queue, i.e. batched multi-path PATCHes. A dry run deletes nothing and reads
+# each candidate once to report the bytes and leaf nodes it would reclaim.
+RETENTION = dict({'HourlyCapture': 30, 'DayCapture': 30, 'History': 0}, **{
+    k.strip(): float(v) for k, v in (p.split('=', 1) for p in (os.environ.get('RETENTION') or '').split(',') if '=' in p)})
+RETENTION_AT = os.environ.get('RETENTION_AT', '02:30')
+_retention_last = {}
+
+def _retention_days(did: str, node: str) -> float:
+    return RETENTION.get(f'{did}:{node}', RETENTION.get(node, 0))
+def _retention_plan(did: str) -> dict:
+    plan, now = {}, datetime.now(_WIB)
+    days = _retention_days(did, 'HourlyCapture')
+    if days:
+        cut = (now - timedelta(days=days)).strftime('%Y-%m-%d')
+        plan['HourlyCapture'] = [f'devices/{did}/HourlyCapture/{d}'
+                                 for d in sorted(fb_get_shallow(f'devices/{did}/HourlyCapture') or {}) if '-' in d and d < cut]
+    days = _retention_days(did, 'DayCapture')
+    if days:
+        cut = (now - timedelta(days=days)).strftime('%Y-%m-%d')
+        plan['DayCapture'] = [f'devices/{did}/DayCapture/{ph}/{d}'
+                              for ph in sorted(fb_get_shallow(f'devices/{did}/DayCapture') or {})
+                              for d in sorted(fb_get_shallow(f'devices/{did}/DayCapture/{ph}') or {}) if '-' in d and d < cut]
+    days = _retention_days(did, 'History')
+    if days:
+        # Session ids are session_<start ms>; live and finalizing sessions are never touched
+        lim = int(time.time() * 1000 - days * 86400000)
+        with _capture_lock: live = set(_capture_sessions)
+        old = lambda s: s.startswith('session_') and s[8:].isdigit() and int(s[8:]) < lim and s not in live
+        paths, sids = [], set()
+        for ph in sorted(p for p in (fb_get_shallow(f'devices/{did}/History') or {}) if _PHASE_RE.match(p)):
+            for s in sorted(fb_get_shallow(f'devices/{did}/History/{ph}') or {}):
+                if old(s): paths.append(f'devices/{did}/History/{ph}/{s}'); sids.add(s)
+        sids.update(s for s in (fb_get_shallow(f'devices/{did}/Sessions') or {}) if old(s))
+        paths += [f'devices/{did}/Archive/{s}' for s in sorted(fb_get_shallow(f'devices/{did}/Archive') or {}) if old(s)]
+        plan['History'] = paths + [f'devices/{did}/Sessions/{s}' for s in sorted(sids)]
+    return plan
+def _node_size(path: str) -> tuple[int, int]:
+    def leaves(v): return sum(leaves(x) for x in v.values()) if isinstance(v, dict) else sum(leaves(x) for x in v) if isinstance(v, list) else 1
+    try:
+        r = _fb_request('GET', path, timeout=60)
+        return (len(r.content), leaves(r.json())) if r.ok else (0, 0)
+    except Exception: return 0, 0
+def _retention_run(dry_run: bool = False, device_id: str | None = None) -> None:
+    rep = _retention_last['report'] = {'dry_run': dry_run, 'device_id': device_id, 'state': 'running', 'started_at': _ts_now(),
+                                       'finished_at': None, 'policy': RETENTION, 'devices': {}, 'totals': {}, 'error': None}
+    try:
+        for did in ([device_id] if device_id else sorted(fb_get_shallow('devices') or {})):
+            for node, paths in _retention_plan(did).items():
+                ent = {'paths': len(paths)}
+                if dry_run:
+                    sizes = [_node_size(p) for p in paths]
+                    ent.update(bytes=sum(b for b, _ in sizes), nodes=sum(n for _, n in sizes))
+                else:
+                    for path in paths:
+                        _fb_writes.delete(path)
+                        if node == 'History': _stats_invalidate(did, path.rsplit('/', 1)[1])
+                rep['devices'].setdefault(did, {})[node] = ent
+                tot = rep['totals'].setdefault(node, {})
+                for k, v in ent.items(): tot[k] = tot.get(k, 0) + v
+            if not dry_run: _fb_writes.flush(timeout=120)
+        rep['state'] = 'done'
+    except Exception as e:
+        rep.update(state='error', error=str(e))
+    finally:
+        rep['finished_at'] = _ts_now()
+def _retention_worker() -> None:
+    now = datetime.now(_WIB)
+    h, m = (int(x) for x in RETENTION_AT.split(':'))
+    first = now.replace(hour=h, minute=m, second=0, microsecond=0)
+    if first <= now: first += timedelta(days=1)
+    _scheduler.every(86400, _retention_run, first=(first - now).total_seconds(), key='retention', deadline=3600, bulk=True)
+_ingest_start(_retention_worker)
+@app.route('/api/retention', methods=['GET'])
+@_via_leader
+def retention_status():
+    return jsonify({'policy': RETENTION, 'run_at': RETENTION_AT, 'last': _retention_last.get('report')})
+@app.route('/api/retention/run', methods=['POST'])
+@_via_leader
+def retention_trigger():
+    body    = request.get_json(silent=True) or {}
+    dry_run = bool(body.get('dryRun', request.args.get('dry_run') in ('1', 'true')))
+    did     = (body.get('deviceId') or request.args.get('device_id') or '').strip() or None
+    if (_retention_last.get('report') or {}).get('state') in ('queued', 'running') or \
+            not _scheduler.submit(_retention_run, dry_run, did, key='retention', bulk=True):
+        return jsonify({'ok': False, 'error': 'Retensi sedang berjalan'}), 409
+    return jsonify({'ok': True, 'dry_run': dry_run, 'device_id': did, 'triggered_at': _ts_now()}), 202
+
+# --- Local tiered time-series store -----------------------------------------
+# SQLite (WAL) fed only by live-buffer changes, one row per RealTime change;
+# capture sessions re-read the same samples and are not added again. Raw samples
+# plus 1m/5m/1h/1d rollups (count, sum, min, max per field), each tier with
+# its own retention in days (0 = keep forever). Buckets align to WIB.
+SERIES_DB_PATH   = os.environ.get('SERIES_DB_PATH', 'series.db')
+SERIES_RETENTION = dict({'raw': 2, '1m': 14, '5m': 90, '1h': 730, '1d': 0}, **{
+    k.strip(): float(v) for k, v in (p.split('=', 1) for p in (os.environ.get('SERIES_RETENTION') or '').split(',') if '=' in p)})
+_SERIES_FIELDS = tuple(name for name, _ in _RECORD_FIELDS)
+_SERIES_TIERS  = (('raw', 0), ('1m', 60), ('5m', 300), ('1h', 3600), ('1d', 86400))
+_WIB_OFFSET_MS = 7 * 3600 * 1000
+
+class _SeriesStore:
+    def __init__(self, path: str):
+        self.path  = path
+        self._q    = deque()
+        self._cond = threading.Condition()
+        self._tls  = threading.local()
+        self.stats = {'queued': 0, 'written': 0, 'duplicates': 0, 'dropped': 0, 'pruned': 0}
+        db = self._conn()
+        db.execute('PRAGMA journal_mode=WAL')
+        cols = ', '.join(f'{f} REAL' for f in _SERIES_FIELDS)
+        db.execute(f'CREATE TABLE IF NOT EXISTS raw (did TEXT, ph TEXT, ts INTEGER, {cols}, PRIMARY KEY (did, ph, ts)) WITHOUT ROWID')
+        agg = ', '.join(f's_{f} REAL, mn_{f} REAL, mx_{f} REAL' for f in _SERIES_FIELDS)
+        for tier, _ in _SERIES_TIERS[1:]:
+            db.execute(f'CREATE TABLE IF NOT EXISTS r_{tier} (did TEXT, ph TEXT, bucket INTEGER, n INTEGER, {agg}, '
+                       f'PRIMARY KEY (did, ph, bucket)) WITHOUT ROWID')
+        db.commit()
+        marks = ', '.join('?' * len(_SERIES_FIELDS))
+        self._ins_raw = f'INSERT OR IGNORE INTO raw (did, ph, ts, {", ".join(_SERIES_FIELDS)}) VALUES (?, ?, ?, {marks})'
+        self._ins_agg = {tier: (
+            f'INSERT INTO r_{tier} (did, ph, bucket, n, ' + ', '.join(f's_{f}, mn_{f}, mx_{f}' for f in _SERIES_FIELDS) +
+            ') VALUES (?, ?, ?, 1, ' + ', '.join('?, ?, ?' for _ in _SERIES_FIELDS) + ') ON CONFLICT (did, ph, bucket) DO UPDATE SET n = n + 1, ' +
+            ', '.join(f's_{f} = s_{f} + excluded.s_{f}, mn_{f} = min(mn_{f}, excluded.mn_{f}), mx_{f} = max(mx_{f}, excluded.mx_{f})'
+                      for f in _SERIES_FIELDS)) for tier, _ in _SERIES_TIERS[1:]}
+        threading.Thread(target=self._run, daemon=True).start()
+    def _conn(self) -> sqlite3.Connection:
+        db = getattr(self._tls, 'db', None)
+        if db is None: db = self._tls.db = sqlite3.connect(self.path, timeout=30)
+        return db
+    def add(self, did: str, ph: str, ts_ms: int, rec: dict) -> None:
+        with self._cond:
+            if len(self._q) >= 200000: self.stats['dropped'] += 1; return
+            self._q.append((did, ph, ts_ms, tuple(float(rec.get(f) or 0) for f in _SERIES_FIELDS)))
+            self.stats['queued'] += 1; self._cond.notify()
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._q: self._cond.wait()
+                batch = [self._q.popleft() for _ in range(min(len(self._q), 5000))]
+            try: self._write(batch)
+            except Exception as e: print(f"Series store write failed: {e}")
+    def _write(self, batch: list) -> None:
+        db = self._conn(); cur = db.cursor(); written = 0
+        for did, ph, ts, vals in batch:
+            cur.execute(self._ins_raw, (did, ph, ts, *vals))
+            if not cur.rowcount: continue
+            written += 1
+            trip = [x for v in vals for x in (v, v, v)]
+            for tier, size in _SERIES_TIERS[1:]:
+                ms = size * 1000
+                cur.execute(self._ins_agg[tier], (did, ph, (ts + _WIB_OFFSET_MS) // ms * ms - _WIB_OFFSET_MS, *trip))
+        db.commit()
+        with self._cond: self.stats['written'] += written; self.stats['duplicates'] += len(batch) - written
+    def prune(self) -> None:
+        db = self._conn(); now = int(time.time() * 1000); n = 0
+        for tier, _ in _SERIES_TIERS:
+            days = SERIES_RETENTION.get(tier, 0)
+            if not days: continue
+            col = 'ts' if tier == 'raw' else 'bucket'
+            n += db.execute(f'DELETE FROM {"raw" if tier == "raw" else "r_" + tier} WHERE {col} < ?', (now - int(days * 86400000),)).rowcount
+        db.commit()
+        with self._cond: self.stats['pruned'] += n
+    def pick_tier(self, did: str, start: int, end: int, points: int) -> str:
+        now = int(time.time() * 1000)
+        for tier, size in _SERIES_TIERS:
+            days = SERIES_RETENTION.get(tier, 0)
+            if days and start < now - days * 86400000: continue
+            if tier == 'raw':
+                n = self._conn().execute('SELECT COUNT(*) FROM raw WHERE did = ? AND ts BETWEEN ? AND ? GROUP BY ph ORDER BY 1 DESC LIMIT 1',
+                                         (did, start, end)).fetchone()
+                if (n[0] if n else 0) <= points: return tier
+            elif (end - start) / (size * 1000) <= points: return tier
+        return _SERIES_TIERS[-1][0]
+    def query(self, did: str, start: int, end: int, points: int, phases=None, fields=None, tier=None, minmax=False) -> dict:
+        tier   = tier if tier in dict(_SERIES_TIERS) else self.pick_tier(did, start, end, points)
+        fields = [f for f in (fields or _SERIES_FIELDS) if f in _SERIES_FIELDS]
+        if tier == 'raw':
+            sql = f'SELECT ph, ts, {", ".join(fields)} FROM raw WHERE did = ? AND ts BETWEEN ? AND ? ORDER BY ph, ts'
+        else:
+            cols = [f's_{f} / n' for f in fields] + ([c for f in fields for c in (f'mn_{f}', f'mx_{f}')] if minmax else [])
+            sql = f'SELECT ph, bucket, {", ".join(cols)} FROM r_{tier} WHERE did = ? AND bucket BETWEEN ? AND ? ORDER BY ph, bucket'
+        out = {}
+        for row in self._conn().execute(sql, (did, start, end)):
+            if phases and row[0] not in phases: continue
+            col = out.get(row[0])
+            if col is None:
+                col = out[row[0]] = {'t': [], **{f: [] for f in fields}}
+                if minmax and tier != 'raw': col.update({f'{f}_{m}': [] for f in fields for m in ('min', 'max')})
+            col['t'].append(row[1])
+            for i, f in enumerate(fields): col[f].append(row[2 + i])
+            if minmax and tier != 'raw':
+                for i, f in enumerate(fields):
+                    col[f'{f}_min'].append(row[2 + len(fields) + 2 * i]); col[f'{f}_max'].append(row[3 + len(fields) + 2 * i])
+        return {'device_id': did, 'tier': tier, 'bucket_s': dict(_SERIES_TIERS)[tier], 'from': start, 'to': end,
+                'phases': dict(sorted(out.items(), key=lambda x: int(x[0][1:])))}
+    def snapshot(self) -> dict:
+        with self._cond: return {**self.stats, 'pending': len(self._q), 'path': self.path}
+_series = _SeriesStore(SERIES_DB_PATH) if SERIES_DB_PATH else None
+if _series: _ingest_start(lambda: _scheduler.every(3600, _series.prune, first=60, key='series-prune', bulk=True))
+
+# --- Live buffer: per-device columnar ring ----------------------------------
+# One typed array per (phase, field) plus a timestamp column and an offline
+# bitmap. Window length is in seconds; capacity grows by doubling up to
+# LIVE_BUFFER_MAX_ENTRIES and old entries fall off by age.
+LIVE_BUFFER_SECONDS     = float(os.environ.get('LIVE_BUFFER_SECONDS', 1800))
+LIVE_BUFFER_MAX_ENTRIES = int(os.environ.get('LIVE_BUFFER_MAX_ENTRIES', 0)) or max(64, int(LIVE_BUFFER_SECONDS * 2))
+_LIVE_FIELDS = (
+    ('Voltage (V)', 'f', 'v'), ('Current (A)', 'f', 'i'), ('Power (W)', 'f', 'p'), ('Frequency (Hz)', 'f', 'f'),
+    ('Apparent Power (kVA)', 'f', 's'), ('Reactive Power (kVAR)', 'f', 'q'), ('Active Energy (kWh)', 'd', 'e'),
+    ('Power Factor', 'f', 'pf'), ('Phase Angle (°)', 'f', 'a'), ('Apparent Energy (kVAh)', 'd', 'es'), ('Reactive Energy (kVARh)', 'd', 'eq'),
+)
+_NAN = float('nan')
+
+class _LiveRing:
+    def __init__(self, window_s: float = LIVE_BUFFER_SECONDS, max_entries: int = LIVE_BUFFER_MAX_ENTRIES):
+        self.window_ms   = int(window_s * 1000)
+        self.max_entries = max_entries
+        self._lock  = threading.Lock()
+        self._cond  = threading.Condition(self._lock)
+        self._cap   = min(64, max_entries)
+        self._start = 0
+        self._n     = 0
+        self._ts    = array('q', bytes(8 * self._cap))
+        self._off   = bytearray((self._cap + 7) // 8)
+        self._cols  = {}
+        self.mirror = None
+    def __len__(self) -> int: return self._n
+    def _new_col(self, tc: str, cap: int) -> array: return array(tc, [_NAN]) * cap
+    def _idx(self, j: int) -> int: return (self._start + j) % self._cap
+    def _get_off(self, i: int) -> bool: return bool(self._off[i >> 3] & (1 << (i & 7)))
+    def _set_off(self, i: int, v: bool) -> None:
+        if v: self._off[i >> 3] |= 1 << (i & 7)
+        else: self._off[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+    def _grow(self) -> None:
+        cap, new = self._cap, min(self._cap * 2, self.max_entries)
+        order = [self._idx(j) for j in range(self._n)]
+        def lin(a, fill): b = array(a.typecode, (a[i] for i in order)); b.extend(array(a.typecode, [fill]) * (new - len(b))); return b
+        self._ts   = lin(self._ts, 0)
+        self._cols = {ph: [lin(c, _NAN) for c in cols] for ph, cols in self._cols.items()}
+        off = bytearray((new + 7) // 8)
+        for j, i in enumerate(order):
+            if self._get_off(i): off[j >> 3] |= 1 << (j & 7)
+        self._off, self._cap, self._start = off, new, 0
+    def _slot(self, ts_ms: int) -> int:
+        cutoff = ts_ms - self.window_ms
+        while self._n and self._ts[self._start] < cutoff:
+            self._start = (self._start + 1) % self._cap; self._n -= 1
+        if self._n == self._cap:
+            if self._cap < self.max_entries: self._grow()
+            else: self._start = (self._start + 1) % self._cap; self._n -= 1
+        i = self._idx(self._n); self._n += 1
+        self._ts[i] = ts_ms
+        return i
+    def append(self, ts_ms: int, raw: dict) -> None:
+        with self._lock:
+            i = self._slot(ts_ms)
+            self._set_off(i, False)
+            for ph in raw:
+                if ph not in self._cols and _PHASE_RE.match(ph):
+                    self._cols[ph] = [self._new_col(tc, self._cap) for _, tc, _ in _LIVE_FIELDS]
+            for ph, cols in self._cols.items():
+                pd = raw.get(ph)
+                pd = pd if isinstance(pd, dict) else {}
+                for (k, _, _), col in zip(_LIVE_FIELDS, cols):
+                    v = pd.get(k)
+                    try: col[i] = _NAN if v is None else float(v)
+                    except (TypeError, ValueError): col[i] = _NAN
+            if self.mirror: self.mirror(ts_ms, False, {ph: [c[i] for c in cols] for ph, cols in self._cols.items()})
+            self._cond.notify_all()
+    def append_offline(self, ts_ms: int) -> None:
+        with self._lock:
+            i = self._slot(ts_ms)
+            self._set_off(i, True)
+            for cols in self._cols.values():
+                for col in cols: col[i] = _NAN
+            if self.mirror: self.mirror(ts_ms, True, {})
+            self._cond.notify_all()
+    def _first_after(self, ts_ms: int) -> int:
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._ts[self._idx(mid)] > ts_ms: hi = mid
+            else: lo = mid + 1
+        return lo
+    def last_ts(self) -> int | None:
+        with self._lock: return self._ts[self._idx(self._n - 1)] if self._n else None
+    def wait_newer(self, ts_ms: int, timeout: float) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self._n and self._ts[self._idx(self._n - 1)] > ts_ms, timeout)
+    def window(self, since_ms: int | None = None, seconds: float | None = None, compact: bool = False) -> list[dict]:
+        with self._lock:
+            if not self._n: return []
+            lo_ms = self._ts[self._idx(self._n - 1)] - int(seconds * 1000) - 1 if seconds else -1
+            j0  = self._first_after(max(lo_ms, since_ms if since_ms is not None else -1))
+            out = []
+            for j in range(j0, self._n):
+                i = self._idx(j)
+                if self._get_off(i):
+                    out.append({'t': self._ts[i], 'off': 1} if compact else {'timestamp': self._ts[i], 'data': {'offline': True}}); continue
+                data = {}
+                for ph, cols in self._cols.items():
+                    pd = {}
+                    for (k, tc, ck), col in zip(_LIVE_FIELDS, cols):
+                        v = col[i]
+                        if v == v: pd[ck if compact else k] = float(f'{v:.7g}') if tc == 'f' else v
+                    if pd: data[ph] = pd
+                out.append({'t': self._ts[i], 'd': data} if compact else {'timestamp': self._ts[i], 'data': data})
+            return out
+    def dump(self, since_ms: int | None = None, seconds: float | None = None, compact: bool = False) -> str:
+        return json.dumps(self.window(since_ms, seconds, compact), separators=(',', ':'), ensure_ascii=False)
+    def nbytes(self) -> int:
+        with self._lock:
+            return (self._ts.itemsize * len(self._ts) + len(self._off) +
+                    sum(c.itemsize * len(c) for cols in self._cols.values() for c in cols))
+    def stats(self) -> dict:
+        with self._lock: n, cap, phases = self._n, self._cap, sorted(self._cols, key=lambda x: int(x[1:]))
+        return {'entries': n, 'capacity': cap, 'max_entries': self.max_entries, 'window_s': self.window_ms / 1000,
+                'phases': phases, 'bytes': self.nbytes()}
+
+# --- Shared segments (LEADER_MODE) ------------------------------------------
+# live/<device>.ring: 64-byte header [seq, head, cap, window_ms, phase mask,
+# phases, fields, 0] then fixed slots (ts, offline, phases x fields f64), one
+# per _LiveRing append. state.blob: [seq, len] then a JSON document. Both are
+# seqlocks: the leader makes seq odd while writing and readers retry.
+_RING_HDR   = 64
+_RING_DTYPE = np.dtype([('t', '<i8'), ('off', '<u8'), ('v', '<f8', (SHARED_MAX_PHASES, len(_LIVE_FIELDS)))])
+
+def _shared_path(*parts) -> str: return os.path.join(SHARED_DIR, *parts)
+def _ring_path(did: str) -> str: return _shared_path('live', quote(did, safe='') + '.ring')
+def _shm_create(path: str, size: int, stale=None) -> mmap.mmap:
+    # A compatible segment is reused; anything else is replaced by rename so a
+    # reader holding the old mapping never sees the file shrink under it
+    try:
+        fd = os.open(path, os.O_RDWR)
+        try:
+            if os.fstat(fd).st_size == size:
+                mm = mmap.mmap(fd, size)
+                if stale is None or not stale(mm): return mm
+                mm.close()
+        finally: os.close(fd)
+    except OSError: pass
+    tmp = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+    try: os.ftruncate(fd, size); mm = mmap.mmap(fd, size)
+    finally: os.close(fd)
+    os.replace(tmp, path)
+    return mm
+def _shm_open(path: str) -> tuple[mmap.mmap | None, int | None]:
+    try: fd = os.open(path, os.O_RDONLY)
+    except OSError: return None, None
+    try:
+        st = os.fstat(fd)
+        return (mmap.mmap(fd, st.st_size, access=mmap.ACCESS_READ), st.st_ino) if st.st_size else (None, None)
+    finally: os.close(fd)
+class _SeqBlob:
+    def __init__(self, mm: mmap.mmap): self.mm = mm
+    def write(self, data: bytes) -> bool:
+        if len(data) > len(self.mm) - 16: return False
+        seq = struct.unpack_from('<Q', self.mm, 0)[0] | 1
+        struct.pack_into('<Q', self.mm, 0, seq)
+        struct.pack_into('<Q', self.mm, 8, len(data)); self.mm[16:16 + len(data)] = data
+        struct.pack_into('<Q', self.mm, 0, seq + 1)
+        return True
+    def read(self, known: int | None = None) -> tuple[int | None, bytes | None]:
+        for _ in range(200):
+            seq = struct.unpack_from('<Q', self.mm, 0)[0]
+            if seq & 1: time.sleep(0.0005); continue
+            if seq == known or not seq: return seq, None
+            n = min(struct.unpack_from('<Q', self.mm, 8)[0], len(self.mm) - 16)
+            data = self.mm[16:16 + n]
+            if struct.unpack_from('<Q', self.mm, 0)[0] == seq: return seq, data
+        return None, None
+class _SharedRing:
+    def __init__(self, mm: mmap.mmap):
+        self.mm    = mm
+        self.hdr   = np.ndarray((8,), '<i8', mm, 0)
+        self.cap   = int(self.hdr[2])
+        slots      = np.ndarray((self.cap,), _RING_DTYPE, mm, _RING_HDR)
+        self.t, self.off, self.v = slots['t'], slots['off'], slots['v']
+    @classmethod
+    def create(cls, did: str, window_ms: int, cap: int) -> '_SharedRing':
+        layout = (cap, SHARED_MAX_PHASES, len(_LIVE_FIELDS))
+        mm  = _shm_create(_ring_path(did), _RING_HDR + cap * _RING_DTYPE.itemsize,
+                          lambda m: struct.unpack_from('<q', m, 16) + struct.unpack_from('<qq', m, 40) != layout)
+        hdr = np.ndarray((8,), '<i8', mm, 0)
+        hdr[2], hdr[5], hdr[6], hdr[3] = cap, SHARED_MAX_PHASES, len(_LIVE_FIELDS), window_ms
+        if hdr[0] & 1: hdr[0] += 1
+        return cls(mm)
+    def put(self, ts_ms: int, offline: bool, values: dict) -> None:
+        h = self.hdr; j = int(h[1]) % self.cap
+        h[0] += 1
+        self.t[j], self.off[j], self.v[j] = ts_ms, offline, _NAN
+        for ph, vals in values.items():
+            k = int(ph[1:]) - 1
+            if 0 <= k < SHARED_MAX_PHASES: self.v[j, k] = vals; h[4] |= 1 << k
+        h[1] += 1
+        h[0] += 1
+class _SharedRingView:
+    # Read side of a _SharedRing with the _LiveRing query interface
+    def __init__(self, did: str):
+        self.path = _ring_path(did)
+        self.ring, self.ino = None, None
+    def _current(self) -> _SharedRing | None:
+        try: ino = os.stat(self.path).st_ino
+        except OSError: return None
+        if ino != self.ino:
+            mm, self.ino = _shm_open(self.path)
+            self.ring = _SharedRing(mm) if mm is not None and len(mm) > _RING_HDR else None
+        return self.ring
+    def _read(self, last_only: bool = False):
+        r = self._current()
+        if r is None: return None
+        h = r.hdr
+        for _ in range(200):
+            seq = int(h[0])
+            if seq & 1: time.sleep(0.0005); continue
+            head = int(h[1]); n = min(head, r.cap, 1 if last_only else r.cap)
+            idx  = np.arange(head - n, head) % r.cap
+            snap = (r.t[idx], r.off[idx], None if last_only else r.v[idx], int(h[4]), int(h[3]))
+            if int(h[0]) == seq: return snap
+        return None
+    def last_ts(self) -> int | None:
+        snap = self._read(True)
+        return int(snap[0][-1]) if snap and len(snap[0]) else None
+    def wait_newer(self, ts_ms: int, timeout: float) -> bool:
+        end = time.monotonic() + timeout
+        while True:
+            last = self.last_ts()
+            if last is not None and last > ts_ms: return True
+            if time.monotonic() >= end: return False
+            time.sleep(0.25)
+    def window(self, since_ms: int | None = None, seconds: float | None = None, compact: bool = False) -> list[dict]:
+        snap = self._read()
+        if not snap or not len(snap[0]): return []
+        t, off, v, mask, window_ms = snap
+        lo_ms  = int(t[-1]) - int(seconds * 1000) - 1 if seconds else -1
+        keep   = (t >= t[-1] - window_ms) & (t > max(lo_ms, since_ms if since_ms is not None else -1))
+        phases = [k for k in range(SHARED_MAX_PHASES) if mask >> k & 1]
+        out = []
+        for j in np.flatnonzero(keep):
+            ts = int(t[j])
+            if off[j]:
+                out.append({'t': ts, 'off': 1} if compact else {'timestamp': ts, 'data': {'offline': True}}); continue
+            data = {}
+            for k in phases:
+                pd = {}
+                for (name, tc, ck), x in zip(_LIVE_FIELDS, v[j, k].tolist()):
+                    if x == x: pd[ck if compact else name] = float(f'{x:.7g}') if tc == 'f' else x
+                if pd: data[f'L{k + 1}'] = pd
+            out.append({'t': ts, 'd': data} if compact else {'timestamp': ts, 'data': data})
+        return out
+    def dump(self, since_ms: int | None = None, seconds: float | None = None, compact: bool = False) -> str:
+        return json.dumps(self.window(since_ms, seconds, compact), separators=(',', ':'), ensure_ascii=False)
+    def nbytes(self) -> int:
+        r = self._current()
+        return len(r.mm) if r else 0
+    def stats(self) -> dict:
+        snap, r = self._read(True), self._current()
+        if not snap or r is None: return {'entries': 0, 'capacity': 0, 'max_entries': 0, 'window_s': 0, 'phases': [], 'bytes': 0}
+        head, mask = int(r.hdr[1]), snap[3]
+        return {'entries': min(head, r.cap), 'capacity': r.cap, 'max_entries': r.cap, 'window_s': snap[4] / 1000,
+                'phases': [f'L{k + 1}' for k in range(SHARED_MAX_PHASES) if mask >> k & 1], 'bytes': len(r.mm)}
+_shared_views: dict[str, _SharedRingView] = {}
+
+def _new_live_ring(did: str) -> _LiveRing:
+    ring = _LiveRing()
+    if LEADER_MODE: ring.mirror = _SharedRing.create(did, ring.window_ms, ring.max_entries).put
+    return ring
+def _live_rings() -> dict:
+    if not _is_follower(): return dict(_device_live_buffer)
+    try: names = os.listdir(_shared_path('live'))
+    except OSError: names = []
+    return {did: _live_ring(did) for did in (unquote(n[:-5]) for n in names if n.endswith('.ring'))}
+def _live_ring(did: str):
+    if not _is_follower(): return _device_live_buffer.get(did)
+    view = _shared_views.get(did)
+    if view is None: view = _shared_views.setdefault(did, _SharedRingView(did))
+    return view if view._current() is not None else None
+
+_device_live_seq = {}
 _device_is_offline = {}
-_device_live_buffer = {}
+_device_live_buffer: dict[str, _LiveRing] = {}
+_live_lock = threading.Lock()
+
+def _live_ingest(did: str, raw, now_ms: int) -> None:
+    if not raw or not isinstance(raw, dict): return
+    _changes.observe(did, raw, now_ms)
+    seq = _changes.seq(did)
+    with _live_lock:
+        if did not in _device_live_buffer:
+            _device_live_buffer[did] = _new_live_ring(did)
+        changed = _device_live_seq.get(did) != seq
+        if changed:
+            _device_live_seq[did] = seq
+            _device_is_offline[did] = False
+            _device_live_buffer[did].append(now_ms, raw)
+    if not changed: _live_check_offline(did, now_ms); return
+    if _series:
+        for ph, pd in raw.items():
+            if _PHASE_RE.match(ph) and isinstance(pd, dict): _series.add(did, ph, now_ms, _phase_record(pd))
+def _live_check_offline(did: str, now_ms: int) -> None:
+    with _live_lock:
+        if did not in _device_live_buffer: return
+        last_ms = _changes.last_change_ms(did) or now_ms
+        if now_ms - last_ms > 15000:
+            if not _device_is_offline.get(did, False):
+                _device_is_offline[did] = True
+                _device_live_buffer[did].append_offline(now_ms)
 
+# --- Streaming ingestion (RTDB REST event stream) ---------------------------
+# INGEST_MODE=stream keeps one text/event-stream subscription per device on
+# devices/{id}/RealTime (RTDB has no wildcard listeners; streaming the whole
+# `devices` node would replay every History record on each reconnect).
+# Devices whose stream is down are polled as before until it reconnects.
+INGEST_MODE          = (os.environ.get('INGEST_MODE') or 'poll').strip().lower()
+STREAM_READ_TIMEOUT  = float(os.environ.get('STREAM_READ_TIMEOUT', 75))   # RTDB sends keep-alive every 30 s
+STREAM_BACKOFF_MAX   = float(os.environ.get('STREAM_BACKOFF_MAX', 60))
+_rt_streams = {}
+_rt_streams_lock = threading.Lock()
+
+def _tree_set(node, parts: list, value):
+    if not parts: return value
+    node = dict(node) if isinstance(node, dict) else {}
+    child = _tree_set(node.get(parts[0]), parts[1:], value)
+    if child is None: node.pop(parts[0], None)
+    else: node[parts[0]] = child
+    return node or None
+def _sse_lines(r):
+    read1 = getattr(r.raw, 'read1', None)
+    if read1 is None:
+        yield from r.iter_lines(chunk_size=1, decode_unicode=True); return
+    r.raw.decode_content = True
+    buf = b''
+    while True:
+        chunk = read1(8192)
+        if not chunk: return
+        *lines, buf = (buf + chunk).split(b'\n')
+        for ln in lines: yield ln.rstrip(b'\r').decode('utf-8', 'replace')
+class _RealtimeStream:
+    def __init__(self, device_id: str):
+        self.device_id = device_id
+        self.path      = f'devices/{device_id}/RealTime'
+        self.data      = None
+        self.healthy   = False
+        self.failures  = 0
+        self.events    = 0
+        self._stop     = threading.Event()
+        self._thread   = threading.Thread(target=self._run, daemon=True)
+    def start(self) -> '_RealtimeStream':
+        self._thread.start(); return self
+    def stop(self) -> None: self._stop.set()
+    def _on_event(self, event: str, payload: str) -> None:
+        if event in ('cancel', 'auth_revoked'): raise ConnectionError(event)
+        if event not in ('put', 'patch'): return
+        msg   = json.loads(payload) if payload else {}
+        parts = [p for p in (msg.get('path') or '/').split('/') if p]
+        data  = msg.get('data')
+        # Copy-on-write so readers holding the previous snapshot never see it mutate
+        if event == 'put': root = _tree_set(self.data, parts, data)
+        else:
+            root = self.data
+            for k, v in (data or {}).items(): root = _tree_set(root, parts + [p for p in k.split('/') if p], v)
+        self.data = root; self.healthy = True; self.failures = 0; self.events += 1
+        _live_ingest(self.device_id, root, int(time.time() * 1000))
+    def _run(self) -> None:
+        sess = http_requests.Session()
+        while not self._stop.is_set():
+            try:
+                with sess.get(f'{DB_URL}/{self.path}.json', headers={'Accept': 'text/event-stream'},
+                              stream=True, timeout=(6, STREAM_READ_TIMEOUT)) as r:
+                    if r.status_code != 200: raise ConnectionError(r.status_code)
+                    event, data = None, []
+                    for line in _sse_lines(r):
+                        if self._stop.is_set(): return
+                        if line:
+                            if line.startswith('event:'):  event = line[6:].strip()
+                            elif line.startswith('data:'): data.append(line[5:].strip())
+                            continue
+                        if event: self._on_event(event, '\n'.join(data))
+                        event, data = None, []
+            except Exception: pass
+            self.healthy = False; self.failures += 1
+            delay = min(STREAM_BACKOFF_MAX, 2 ** min(self.failures - 1, 10))
+            self._stop.wait(delay * (0.5 + random.random() / 2))
+def _ensure_stream(device_id: str) -> _RealtimeStream:
+    with _rt_streams_lock:
+        st = _rt_streams.get(device_id)
+        if st is None: st = _rt_streams[device_id] = _RealtimeStream(device_id).start()
+        return st
+def _stream_snapshot(device_id: str):
+    st = _rt_streams.get(device_id)
+    return st.data if st is not None and st.healthy else None
+def fb_get_realtime(device_id: str):
+    if INGEST_MODE == 'stream':
+        raw = _stream_snapshot(device_id)
+        if raw is not None: return raw
+    return fb_get(f'devices/{device_id}/RealTime')
+
+def _live_poll_device(did: str, now_ms: int) -> None:
+    _live_ingest(did, fb_get(f'devices/{did}/RealTime'), now_ms)
+LIVE_CYCLE_BUDGET = 3.0
 def _live_buffer_worker() -> None:
     time.sleep(2)
     while True:
+        t0 = time.monotonic()
         try:
             now_ms = int(time.time() * 1000)
             devices_meta = fb_get_shallow('devices') or {}
             
+            pending = []
             for did in devices_meta.keys():
-                raw = fb_get(f'devices/{did}/RealTime')
-                if not raw or not isinstance(raw, dict): continue
-                
-                h = _data_hash(raw)
-                if did not in _device_live_buffer:
-                    _device_live_buffer[did] = deque(maxlen=600)
-                
-                if _device_live_hash.get(did) != h:
-                    _device_live_hash[did] = h
-                    _device_last_change_ms[did] = now_ms
-                    _device_is_offline[did] = False
-                    _device_live_buffer[did].append({'timestamp': now_ms, 'data': raw})
-                else:
-                    last_ms = _device_last_change_ms.get(did, now_ms)
-                    if now_ms - last_ms > 15000:
-                        if not _device_is_offline.get(did, False):
-                            _device_is_offline[did] = True
-                            _device_live_buffer[did].append({'timestamp': now_ms, 'data': {"offline": True}})
+                if INGEST_MODE == 'stream' and _ensure_stream(did).healthy:
+                    _live_check_offline(did, now_ms)
+                    continue
+                fut = _scheduler.submit(_live_poll_device, did, now_ms, key=f'live:{did}', deadline=3)
+                if fut: pending.append(fut)
+            if pending: _futures_wait(pending, timeout=6)
         except Exception: pass
+        dur = time.monotonic() - t0
+        _m_live_cycle.observe(dur)
+        if dur > LIVE_CYCLE_BUDGET: _m_live_overrun.inc()
         time.sleep(3)
-threading.Thread(target=_live_buffer_worker, daemon=True).start()
+_ingest_start(lambda: threading.Thread(target=_live_buffer_worker, daemon=True).start())
 
 @app.route('/api/live-buffer/<device_id>')
 def get_live_buffer(device_id: str):
-    buf = _device_live_buffer.get(device_id)
+    buf = _live_ring(device_id)
     if not buf: return jsonify([])
-    return jsonify(list(buf))
-def _do_capture_io(device_id, session_id, sched_ts, interval, last_hash, last_change, enabled_phases, time_offset_ms):
+    since   = request.args.get('since', type=int)
+    seconds = request.args.get('seconds', type=float)
+    compact = request.args.get('compact') in ('1', 'true')
+    return app.response_class(buf.dump(since, seconds, compact), mimetype='application/json')
+def _delta_entry(entry: dict, last: dict) -> dict:
+    if entry.get('off'): last.clear(); return entry
+    # Only changed fields are sent; a field or phase that disappeared is sent as null
+    d = {ph: None for ph in list(last) if ph not in entry['d']}
+    for ph in d: del last[ph]
+    for ph, pd in entry['d'].items():
+        prev = last.setdefault(ph, {})
+        ch = {k: v for k, v in pd.items() if k not in prev or prev[k] != v}
+        ch.update({k: None for k in prev if k not in pd})
+        for k, v in ch.items():
+            if v is None and k not in pd: prev.pop(k, None)
+            else: prev[k] = v
+        if ch: d[ph] = ch
+    return {'t': entry['t'], 'd': d}
+@app.route('/api/live-buffer/<device_id>/stream')
+def stream_live_buffer(device_id: str):
+    since = request.args.get('since', type=int)
+    if since is None: since = request.headers.get('Last-Event-ID', type=int)
+    delta = request.args.get('delta') in ('1', 'true')
+    def gen():
+        cursor, last = since, {}
+        yield 'event: fields\ndata: ' + json.dumps({ck: k for k, _, ck in _LIVE_FIELDS}, ensure_ascii=False) + '\n\n'
+        while True:
+            buf = _live_ring(device_id)
+            if buf is None:
+                time.sleep(3); yield ': waiting\n\n'; continue
+            if cursor is None: cursor = buf.last_ts() or 0
+            entries = buf.window(since_ms=cursor, compact=True)
+            if not entries:
+                if not buf.wait_newer(cursor, 15): yield ': keep-alive\n\n'
+                continue
+            for e in entries:
+                cursor = e['t']
+                if delta: e = _delta_entry(e, last)
+                yield f'id: {cursor}\ndata: ' + json.dumps(e, separators=(',', ':')) + '\n\n'
+    return app.response_class(gen(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+@app.route('/api/live-buffer-stats')
+def live_buffer_stats():
+    per = {did: buf.stats() for did, buf in _live_rings().items() if buf is not None}
+    return jsonify({'devices': per, 'device_count': len(per), 'total_bytes': sum(s['bytes'] for s in per.values())})
+@app.route('/api/series/<device_id>')
+def get_series(device_id: str):
+    if not _series: return jsonify({'ok': False, 'error': 'Series store tidak aktif'}), 503
+    now_ms = int(time.time() * 1000)
+    end    = request.args.get('to', now_ms, type=int)
+    start  = request.args.get('from', end - 3600 * 1000, type=int)
+    points = max(1, min(request.args.get('points', 500, type=int), 20000))
+    phases = [p for p in (request.args.get('phases') or '').split(',') if _PHASE_RE.match(p)] or None
+    fields = [f for f in (request.args.get('fields') or '').split(',') if f] or None
+    if start >= end: return jsonify({'ok': False, 'error': 'Rentang waktu tidak valid'}), 400
+    return jsonify(_series.query(device_id, start, end, points, phases, fields, request.args.get('tier'),
+                                 request.args.get('minmax') in ('1', 'true')))
+@app.route('/api/changes/<device_id>')
+@_via_leader
+def get_changes(device_id: str):
+    try: since = int(request.args.get('since', 0))
+    except ValueError: since = 0
+    return jsonify({'device_id': device_id, 'seq': _changes.seq(device_id), 'changes': _changes.since(device_id, since)})
+@app.route('/api/change-stats')
+@_via_leader
+def change_stats(): return jsonify(_changes.stats())
+@app.route('/api/scheduler')
+@_via_leader
+def scheduler_stats(): return jsonify(_scheduler.snapshot())
+def _prom_gauge(name: str, help: str, samples, labels: tuple = (), kind: str = 'gauge') -> list:
+    return [f'# HELP {name} {help}', f'# TYPE {name} {kind}'] + [f'{name}{_prom_labels(labels, lv)} {v}' for lv, v in samples]
+@app.route('/metrics')
+@_via_leader
+def metrics():
+    out = []
+    for m in _METRICS: out += m.render()
+    with _capture_lock:
+        caps = [((s['device_id'], s['session_id']), s['count'], s['_expected'], s['missed']) for s in _capture_sessions.values()]
+    out += _prom_gauge('capture_records_written', 'Ticks written per live capture session', [(lv, w) for lv, w, _, _ in caps], ('device', 'session'))
+    out += _prom_gauge('capture_records_expected', 'Ticks scheduled per live capture session', [(lv, e) for lv, _, e, _ in caps], ('device', 'session'))
+    out += _prom_gauge('capture_ticks_missed', 'High-rate ticks skipped per live capture session', [(lv, m) for lv, _, _, m in caps], ('device', 'session'))
+    bufs = list(_device_live_buffer.items())
+    out += _prom_gauge('live_buffer_bytes', 'Memory held by live ring buffers', [((did,), b.nbytes()) for did, b in bufs], ('device',))
+    out += _prom_gauge('process_threads', 'Active Python threads', [((), threading.active_count())])
+    sch, wq, fc = _scheduler.snapshot(), _fb_writes.snapshot(), _fb_cache.snapshot()
+    out += _prom_gauge('scheduler_tasks', 'Scheduler tasks by state', [((k,), sch[k]) for k in ('queued', 'running')], ('state',))
+    out += _prom_gauge('scheduler_tasks_total', 'Scheduler task outcomes',
+                       [((k,), sch[k]) for k in ('submitted', 'completed', 'failed', 'collapsed', 'merged', 'expired')], ('outcome',), 'counter')
+    out += _prom_gauge('scheduler_lateness_max_seconds', 'Largest task start lateness', [((), sch['lateness_max'])])
+    out += _prom_gauge('write_queue_depth', 'Paths waiting in the write queue', [((), wq['depth'])])
+    out += _prom_gauge('write_queue_paths_total', 'Write-queue path outcomes',
+                       [((k,), wq[k]) for k in ('enqueued', 'written', 'dropped', 'failed')], ('outcome',), 'counter')
+    out += _prom_gauge('fb_cache_events_total', 'Response cache events',
+                       [((k,), fc[k]) for k in ('hits', 'misses', 'not_modified', 'coalesced', 'evictions', 'invalidations')], ('event',), 'counter')
+    out += _prom_gauge('fb_cache_bytes', 'Bytes held by the response cache', [((), fc['bytes'])])
+    if INGEST_MODE == 'stream':
+        out += _prom_gauge('realtime_streams', 'RealTime event streams by health',
+                           [((h,), sum(1 for st in list(_rt_streams.values()) if st.healthy == (h == 'up'))) for h in ('up', 'down')], ('state',))
+    return app.response_class('\n'.join(out) + '\n', mimetype='text/plain; version=0.0.4')
+@app.route('/api/fb-cache')
+@_via_leader
+def fb_cache_stats(): return jsonify(_fb_cache.snapshot())
+@app.route('/api/write-queue')
+@_via_leader
+def write_queue_stats(): return jsonify(_fb_writes.snapshot())
+@app.route('/api/series-stats')
+@_via_leader
+def series_stats(): return jsonify(_series.snapshot() if _series else {'enabled': False})
+def _capture_public(s: dict) -> dict:
+    return {
+        'active': s['active'], 'device_id': s['device_id'], 'device_name': s['device_name'],
+        'session_id': s['session_id'], 'session_name': s['session_name'], 'interval': s['interval'],
+        'count': s['count'], 'started_at': s['started_at'], 'finalizing': s['_finalizing'],
+        'enabled_phases': s['enabled_phases'], 'time_offset_ms': s['time_offset_ms'],
+        'highrate': s['highrate'], 'missed': s['missed'],
+    }
+def _capture_view() -> tuple[list, dict]:
+    if _is_follower():
+        st = _shared_state() or {}
+        return ([{k: v for k, v in s.items() if not k.startswith('_')} for s in st.get('capture', [])],
+                st.get('defaults') or dict(_capture_defaults))
+    with _capture_lock: return [_capture_public(s) for s in _capture_sessions.values()], dict(_capture_defaults)
+def _capture_find(sid: str | None = None, did: str | None = None) -> dict | None:
+    if sid: return _capture_sessions.get(sid)
+    if did:
+        found = [s for s in _capture_sessions.values() if s['device_id'] == did]
+        return next((s for s in found if s['active']), found[0] if found else None)
+    return None
+def _capture_records(sched_ts, raw, offline, enabled_phases, time_offset_ms, sampled_ts=None) -> tuple[str, dict]:
+    sched_shifted = sched_ts + (time_offset_ms / 1000.0)
+    ts  = datetime.fromtimestamp(sched_shifted, tz=_WIB).strftime('%H:%M:%S %d/%m/%Y')
+    key = f'capture_{round(sched_ts * 1000)}'
+    all_ph = sorted([k for k in (raw or {}) if _PHASE_RE.match(k)], key=lambda x: int(x[1:]))
+    phases = ([p for p in all_ph if p in enabled_phases] or enabled_phases) if enabled_phases else all_ph
+    out = {}
+    for ph in phases:
+        pd  = {} if offline else ((raw or {}).get(ph) if isinstance((raw or {}).get(ph), dict) else {})
+        out[ph] = {'timestamp': ts, 'offline': offline, **_phase_record(pd)}
+        if sampled_ts is not None:
+            out[ph].update(scheduled_ms=round(sched_shifted * 1000), sampled_ms=round(sampled_ts * 1000) + time_offset_ms)
+    return key, out
+def _write_capture_records(device_id, session_id, sched_ts, raw, offline, enabled_phases, time_offset_ms) -> bool:
+    key, recs = _capture_records(sched_ts, raw, offline, enabled_phases, time_offset_ms)
+    for ph, rec in recs.items():
+        _fb_writes.put(f'devices/{device_id}/History/{ph}/{session_id}/{key}', rec)
+    return bool(recs)
+def _do_capture_io(device_id: str, jobs: list) -> None:
+    # One RealTime read per device per tick, fanned out to every session recording it
     try:
-        raw = fb_get(f'devices/{device_id}/RealTime')
-        h   = _data_hash(raw); now = time.time()
-        if h != last_hash[0]: last_hash[0] = h; last_change[0] = now
-        stale   = (now - last_change[0]) if last_change[0] else float('inf')
-        offline = raw is None or normalize(raw) is None or stale > max(interval * 2, 6)
-        sched_shifted = sched_ts + (time_offset_ms / 1000.0)
-        ts  = datetime.fromtimestamp(sched_shifted, tz=_WIB).strftime('%H:%M:%S %d/%m/%Y')
-        key = f'capture_{int(sched_ts * 1000)}'
-        all_ph = sorted([k for k in (raw or {}) if _PHASE_RE.match(k)], key=lambda x: int(x[1:]))
-        phases = ([p for p in all_ph if p in enabled_phases] or enabled_phases) if enabled_phases else all_ph
-        if not phases: return
-        def _w(ph: str) -> None:
-            pd = {} if offline else ((raw or {}).get(ph) if isinstance((raw or {}).get(ph), dict) else {})
-            def f(k):
-                try: return float((pd or {}).get(k) or 0)
-                except: return 0.0
-            fb_put(f'devices/{device_id}/History/{ph}/{session_id}/{key}', {
-                'timestamp': ts, 'offline': offline,
-                'Voltage': f('Voltage (V)'), 'Current': f('Current (A)'), 'Power': f('Power (W)'),
-                'Apparent': f('Apparent Power (kVA)'), 'Reactive': f('Reactive Power (kVAR)'),
-                'Energy': f('Active Energy (kWh)'), 'Frequency': f('Frequency (Hz)'),
-                'PowerFactor': f('Power Factor'), 'Phase1': f('Phase Angle (°)'),
-                'EnergyApparent': f('Apparent Energy (kVAh)'), 'EnergyReactive': f('Reactive Energy (kVARh)'),
-            })
-        ts_list = [threading.Thread(target=_w, args=(ph,), daemon=True) for ph in phases]
-        for t in ts_list: t.start()
-        for t in ts_list: t.join(timeout=8)
-        with _capture_lock: _capture_state['count'] += 1
+        t0  = time.time()
+        raw = fb_get_realtime(device_id)
+        now = time.time()
+        for j in jobs: _m_cap_late.observe(max(0.0, t0 - j[1])); _m_cap_drift.observe(now - j[1])
+        _changes.observe(device_id, raw, int(now * 1000))
+        last_change = _changes.last_change_ms(device_id)
+        stale = (now - last_change / 1000) if last_change else float('inf')
+        bad   = raw is None or normalize(raw) is None
+        for sid, sched, iv, ep, to_ms in jobs:
+            try:
+                offline = bad or stale > max(iv * 2, 6)
+                with _capture_lock:
+                    # A finalized session takes no more records: its count and endTime are written
+                    s = _capture_sessions.get(sid)
+                    if not s or s.get('_closed'): continue
+                    if _write_capture_records(device_id, sid, sched, raw, offline, ep, to_ms): s['count'] += 1
+            except Exception: pass
     except Exception: pass
-def _capture_worker(stop: threading.Event, wake: threading.Event) -> None:
-    stop.wait(3.5)
-    last_hash: list = [None]; last_change: list = [None]; nxt = time.time()
-    while not stop.is_set():
-        if stop.wait(timeout=min(max(0., nxt - time.time()), 0.2)): break
-        if wake.is_set():
-            wake.clear()
-            with _capture_lock: nxt = _capture_state.get('started_at', time.time())
-            continue
-        if time.time() < nxt: continue
+def _capture_sampler() -> None:
+    while True:
+        due, nearest = {}, None
+        with _capture_lock:
+            now = time.time()
+            for s in _capture_sessions.values():
+                if not s['active'] or s['highrate']: continue
+                if s['_next'] <= now:
+                    sched = s['_next']; s['_next'] += float(s['interval']); s['_expected'] += 1
+                    due.setdefault(s['device_id'], []).append(
+                        (s['session_id'], sched, float(s['interval']), s['enabled_phases'], s['time_offset_ms']))
+                nearest = s['_next'] if nearest is None else min(nearest, s['_next'])
+        for did, jobs in due.items():
+            sched = min(j[1] for j in jobs)
+            _scheduler.submit(_do_capture_io, did, jobs, key=f'capture:{did}:{int(sched * 1000)}',
+                              deadline=max(min(j[2] for j in jobs) * 2, 5),
+                              sched=time.monotonic() - max(0.0, time.time() - sched))
+        _capture_wake.wait(timeout=min(max(0.0, nearest - time.time()), 1.0) if nearest else 1.0)
+        _capture_wake.clear()
+_ingest_start(lambda: threading.Thread(target=_capture_sampler, daemon=True).start())
+
+# --- High-rate capture (interval < 1 s) -------------------------------------
+# Sub-second sessions get their own sampler thread on a monotonic-clock grid.
+# Records keep the scheduled key and also carry scheduled_ms / sampled_ms
+# (wall time of the actual read). They are buffered and handed to the write
+# queue as one multi-path update per phase every HIGHRATE_FLUSH_S. Ticks the
+# sampler could not serve in time are skipped, never bunched, and counted.
+HIGHRATE_MIN_INTERVAL = float(os.environ.get('HIGHRATE_MIN_INTERVAL', 0.1))
+HIGHRATE_FLUSH_S      = float(os.environ.get('HIGHRATE_FLUSH_S', 2))
+_highrate: dict[str, '_HighRateSampler'] = {}
+
+class _HighRateSampler:
+    def __init__(self, sid: str, did: str):
+        self.sid, self.did = sid, did
+        self._lock    = threading.Lock()   # held from taking a tick until its records are buffered
+        self._buf     = {}
+        self._pending = 0
+        self._stop    = threading.Event()
+        self._thread  = threading.Thread(target=self._run, daemon=True, name=f'highrate-{sid}')
+    def start(self) -> '_HighRateSampler':
+        # RealTime is read from an event stream when one is up, so ticks cost no request
+        _ensure_stream(self.did); self._thread.start(); return self
+    def stop(self, timeout: float = 10) -> None:
+        self._stop.set()
+        if self._thread is not threading.current_thread(): self._thread.join(timeout)
+    def _tick(self, sched: float, iv: float, ep: list, to_ms: int) -> bool:
+        raw = _stream_snapshot(self.did)
+        if raw is None: raw = fb_get(f'devices/{self.did}/RealTime')
+        now = time.time()
+        _m_cap_drift.observe(now - sched)
+        _changes.observe(self.did, raw, int(now * 1000))
+        last_change = _changes.last_change_ms(self.did)
+        stale   = (now - last_change / 1000) if last_change else float('inf')
+        offline = raw is None or normalize(raw) is None or stale > max(iv * 2, 6)
+        key, recs = _capture_records(sched, raw, offline, ep, to_ms, now)
+        for ph, rec in recs.items(): self._buf.setdefault(ph, {})[key] = rec
+        return bool(recs)
+    def flush(self) -> None:
+        with self._lock:
+            buf, n, self._buf, self._pending = self._buf, self._pending, {}, 0
+            ok = True
+            for ph, recs in buf.items():
+                ok = _fb_writes.patch(f'devices/{self.did}/History/{ph}/{self.sid}', recs) and ok
+            if n and ok:
+                with _capture_lock:
+                    s = _capture_sessions.get(self.sid)
+                    if s: s['count'] += n
+    def _run(self) -> None:
         with _capture_lock:
-            if not _capture_state['active']: break
-            sid = _capture_state['session_id']; did = _capture_state['device_id']
-            iv  = float(_capture_state['interval']); ep = _capture_state.get('enabled_phases')
-            to_ms = _capture_state.get('time_offset_ms', 0)
-        sched = nxt; nxt += iv
-        threading.Thread(target=_do_capture_io, args=(did, sid, sched, iv, last_hash, last_change, ep, to_ms), daemon=True).start()
-def _start_thread() -> None:
-    se, we = threading.Event(), threading.Event()
-    t = threading.Thread(target=_capture_worker, args=(se, we), daemon=True)
-    t.start()
-    _capture_state.update({'_thread': t, '_stop_event': se, '_wake_event': we})
-def _finalize_bg(sid, did, count, se, th, enabled_phases, time_offset_ms) -> None:
+            s = _capture_sessions.get(self.sid)
+            if not s: return
+            iv, next_wall = float(s['interval']), max(s['_next'], s['_shift_floor'])
+        next_mono, last_flush = time.monotonic() + (next_wall - time.time()), time.monotonic()
+        while not self._stop.wait(max(0.0, next_mono - time.monotonic())):
+            with self._lock:
+                with _capture_lock:
+                    s = _capture_sessions.get(self.sid)
+                    if not s or not s['active']: break
+                    if float(s['interval']) != iv:
+                        # New interval: restart the grid, never below a pending time-shift boundary
+                        iv = float(s['interval']); next_wall = max(time.time() + iv, s['_shift_floor'])
+                        next_mono = time.monotonic() + (next_wall - time.time()); s['_next'] = next_wall
+                        continue
+                    late   = time.monotonic() - next_mono
+                    missed = int(late // iv) if late >= iv else 0
+                    sched  = next_wall + missed * iv
+                    next_wall, next_mono = sched + iv, next_mono + (missed + 1) * iv
+                    s['_next'] = next_wall; s['_expected'] += missed + 1; s['missed'] += missed
+                    ep, to_ms = s['enabled_phases'], s['time_offset_ms']
+                if missed: _m_cap_missed.inc(self.did, n=missed)
+                try:
+                    if self._tick(sched, iv, ep, to_ms): self._pending += 1
+                except Exception: pass
+            if time.monotonic() - last_flush >= HIGHRATE_FLUSH_S:
+                self.flush(); last_flush = time.monotonic()
+        self.flush()
+        if INGEST_MODE != 'stream':
+            # The stream is shared by every high-rate session on the device; the last one closes it
+            with _capture_lock:
+                if any(o['active'] and o['highrate'] and o['device_id'] == self.did and o['session_id'] != self.sid
+                       for o in _capture_sessions.values()): return
+                with _rt_streams_lock: st = _rt_streams.pop(self.did, None)
+            if st: st.stop()
+def _highrate_start(sid: str, did: str) -> None:
+    _highrate[sid] = _HighRateSampler(sid, did).start()
+def _capture_iv(value, default: int = 3):
+    try: iv = float(value)
+    except (TypeError, ValueError): iv = default
+    return max(1, int(iv)) if iv >= 1 else max(HIGHRATE_MIN_INTERVAL, round(iv, 3))
+def _finalize_bg(sid, did, enabled_phases) -> None:
     try:
-        if se: se.set()
-        if th and th.is_alive(): th.join(timeout=5)
-        time.sleep(1.5)
+        hr = _highrate.pop(sid, None)
+        if hr: hr.stop()
+        # Ticks dispatched before the stop are keyed below its drain bound; let them
+        # land (or expire), then close the session so nothing is written after the count
+        with _capture_lock:
+            s = _capture_sessions.get(sid) or {}
+            bound, iv = int((s.get('_drain') or time.time()) * 1000), float(s.get('interval') or 1)
+        _scheduler.wait_idle(lambda k: k.startswith(f'capture:{did}:') and int(k.rsplit(':', 1)[1]) < bound, max(iv * 2, 5) + 30)
+        with _capture_lock:
+            if sid in _capture_sessions: _capture_sessions[sid]['_closed'] = True
         if sid and did:
             phases = enabled_phases
             if not phases:
@@ -313,68 +1656,128 @@ def _finalize_bg(sid, did, count, se, th, enabled_phases, time_offset_ms) -> Non
                     'RealTime': fb_get_shallow(f'devices/{did}/RealTime'),
                     'meta': {'sensors': fb_get_shallow(f'devices/{did}/meta/sensors')}
                 })
+            # Records still queued must land before the session is marked ended
+            _fb_writes.flush()
+            with _capture_lock:
+                s = _capture_sessions.get(sid) or {}
+                count, time_offset_ms = s.get('count', 0), s.get('time_offset_ms', 0)
             ended_ts = time.time() + (time_offset_ms / 1000.0)
             end_time_str = datetime.fromtimestamp(ended_ts, tz=_WIB).strftime('%H:%M:%S %d/%m/%Y')
             payload = {'endTime': end_time_str, 'recordCount': count}
             # Update metadata in History for each phase
             for ph in phases:
-                fb_patch(f'devices/{did}/History/{ph}/{sid}/_meta', payload)
+                _fb_writes.patch(f'devices/{did}/History/{ph}/{sid}/_meta', payload)
             # Also update the centralized Sessions metadata node
-            fb_patch(f'devices/{did}/Sessions/{sid}', payload)
+            _fb_writes.patch(f'devices/{did}/Sessions/{sid}', payload)
+            _fb_writes.flush()
+            if ARCHIVE_AUTO: _archive_submit(did, sid, ARCHIVE_DELETE_RAW)
     except Exception: pass
     finally:
-        with _capture_lock: _capture_state['_finalizing'] = False
-def _stop_and_respond() -> None:
+        with _capture_lock: _capture_sessions.pop(sid, None)
+def _stop_session(sid: str) -> bool:
     with _capture_lock:
-        if not _capture_state['active']: return
-        _capture_state.update({'active': False, '_finalizing': True})
-        sid = _capture_state['session_id']; did = _capture_state['device_id']
-        cnt = _capture_state['count'];      se  = _capture_state.get('_stop_event')
-        th  = _capture_state.get('_thread'); ep = _capture_state.get('enabled_phases')
-        to_ms = _capture_state.get('time_offset_ms', 0)
-        _capture_state.update({
-            'device_id': None, 'device_name': None, 'session_id': None, 'session_name': None,
-            'count': 0, 'started_at': None, 'enabled_phases': None,
-            '_thread': None, '_stop_event': None, '_wake_event': None,
-        })
-    threading.Thread(target=_finalize_bg, args=(sid, did, cnt, se, th, ep, to_ms), daemon=True).start()
+        s = _capture_sessions.get(sid)
+        if not s or not s['active']: return False
+        s.update({'active': False, '_finalizing': True, '_drain': s['_next']})
+        did, ep = s['device_id'], s['enabled_phases']
+    _scheduler.submit(_finalize_bg, sid, did, ep, key=f'finalize:{sid}', bulk=True)
+    return True
 @app.route('/')
 def index(): return render_template('index.html', firebase_config=FIREBASE_CONFIG)
 @app.route('/health', methods=['GET'])
 def health(): return jsonify({"status": "ok", "message": "Service is alive"}), 200
 @app.route('/api/config')
 def get_config(): return jsonify(FIREBASE_CONFIG)
+# --- Device registry --------------------------------------------------------
+# /api/devices is served from memory. The registry is filled by a shallow read
+# of `devices` plus bounded parallel meta reads, refreshed in the background,
+# and updated in place by the rename/sensor routes so edits show immediately.
+DEVICE_REFRESH_S     = float(os.environ.get('DEVICE_REFRESH_S', 30))
+DEVICE_FETCH_WORKERS = int(os.environ.get('DEVICE_FETCH_WORKERS', 8))
+_device_fetch_pool   = ThreadPoolExecutor(max_workers=DEVICE_FETCH_WORKERS, thread_name_prefix='devmeta')
+
+def _device_entry(did: str, meta: dict) -> dict:
+    sensors = meta.get('sensors') or {}
+    detected = []
+    if isinstance(sensors, dict):
+        detected = sorted([k for k in sensors if _PHASE_RE.match(k)], key=lambda x: int(x[1:]))
+    phases = []
+    for ph in detected:
+        s = sensors.get(ph) or {}
+        phases.append({'phase': ph, 'name': s.get('name', ph), 'properties': s.get('properties', []), 'enabled': s.get('enabled', True)})
+    return {
+        'id': did,
+        'name': meta.get('name', did),
+        'online': meta.get('online', False),
+        'lastSeen': meta.get('lastSeen', '---'),
+        'phases': phases,
+        'phaseCount': len(phases)
+    }
+class _DeviceRegistry:
+    def __init__(self):
+        self._lock  = threading.Lock()
+        self._meta  = {}
+        self._body  = None
+        self._etag  = None
+        self._touch = {}
+        self._at    = 0.0          # monotonic start of the last refresh attempt
+        self.stats  = {'refreshes': 0, 'failed': 0, 'rebuilds': 0, 'refreshed_at': None}
+    def refresh(self) -> None:
+        started = self._at = time.monotonic()
+        ids = fb_get_shallow('devices')
+        if not isinstance(ids, dict):
+            with self._lock: self.stats['failed'] += 1
+            return
+        ids   = list(ids)
+        metas = dict(zip(ids, _device_fetch_pool.map(lambda d: fb_get(f'devices/{d}/meta'), ids)))
+        with self._lock:
+            # A failed read keeps the last known meta; so does a write-through that
+            # landed while this refresh was reading (its read may predate the write)
+            self._meta = {d: (self._meta.get(d) or {}) if not isinstance(m, dict) or self._touch.get(d, 0) > started else m
+                          for d, m in metas.items()}
+            self._touch = {d: t for d, t in self._touch.items() if t > started}
+            self.stats['refreshes'] += 1; self.stats['refreshed_at'] = _ts_now()
+            self._rebuild()
+    def _rebuild(self) -> None:
+        body = json.dumps(sorted((_device_entry(d, m) for d, m in self._meta.items()), key=lambda x: x['id'])).encode()
+        if body != self._body:
+            self._body, self._etag = body, f'{zlib.crc32(body):08x}-{len(body)}'; self.stats['rebuilds'] += 1
+    def update(self, did: str, data: dict, phase: str | None = None) -> None:
+        with self._lock:
+            if self._body is None: return
+            meta = dict(self._meta.get(did) or {})
+            if phase:
+                sensors = dict(meta.get('sensors') or {})
+                sensors[phase] = {**(sensors.get(phase) or {}), **data}
+                meta['sensors'] = sensors
+            else: meta.update(data)
+            self._meta[did] = meta; self._touch[did] = time.monotonic()
+            self._rebuild()
+    def response(self) -> tuple[bytes, str]:
+        if self._body is None: self.refresh()
+        elif time.monotonic() - self._at > DEVICE_REFRESH_S:
+            # No periodic refresh here (a follower whose leader is unreachable): refresh on demand
+            _scheduler.submit(self.refresh, key='devices-refresh')
+        with self._lock: return self._body or b'[]', self._etag or '0'
+    def peek(self) -> tuple[bytes | None, str | None]:
+        with self._lock: return self._body, self._etag
+    def snapshot(self) -> dict:
+        with self._lock: return {**self.stats, 'devices': len(self._meta), 'etag': self._etag}
+_devices = _DeviceRegistry()
+_ingest_start(lambda: _scheduler.every(DEVICE_REFRESH_S, _devices.refresh, first=0, key='devices-refresh', deadline=DEVICE_REFRESH_S))
+
 @app.route('/api/devices')
 def list_devices():
-    devices = []
-    try:
-        devices_shallow = fb_get_shallow('devices') or {}
-        for did in devices_shallow.keys():
-            # Only fetch meta node to avoid large data downloads (History, RealTime, etc.)
-            meta = fb_get(f'devices/{did}/meta') or {}
-            sensors = meta.get('sensors') or {}
-            detected = []
-            if isinstance(sensors, dict):
-                detected = sorted([k for k in sensors if _PHASE_RE.match(k)], key=lambda x: int(x[1:]))
-            
-            phases = []
-            for ph in detected:
-                s = sensors.get(ph) or {} if isinstance(sensors, dict) else {}
-                phases.append({'phase': ph, 'name': s.get('name', ph), 'properties': s.get('properties', []), 'enabled': s.get('enabled', True)})
-            
-            devices.append({
-                'id': did, 
-                'name': meta.get('name', did), 
-                'online': meta.get('online', False),
-                'lastSeen': meta.get('lastSeen', '---'), 
-                'phases': phases, 
-                'phaseCount': len(phases)
-            })
-    except Exception as e:
-        print(f"Error listing devices: {e}")
-        
-    return jsonify(sorted(devices, key=lambda d: d['id']))
+    st = _shared_state() if _is_follower() else None
+    body, etag = (st['devices'].encode(), st['etag']) if st and st.get('devices') else _devices.response()
+    resp = app.response_class(body, mimetype='application/json', headers={'Cache-Control': 'no-cache'})
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+@app.route('/api/device-registry')
+@_via_leader
+def device_registry_stats(): return jsonify(_devices.snapshot())
 @app.route('/api/devices/<device_id>/init-sensors', methods=['POST'])
+@_via_leader
 def init_device_sensors(device_id: str):
     dd = {
         'RealTime': fb_get_shallow(f'devices/{device_id}/RealTime'),
@@ -383,20 +1786,24 @@ def init_device_sensors(device_id: str):
     detected = _detect_phases(dd); count = 0
     for ph in detected:
         if fb_get(f'devices/{device_id}/meta/sensors/{ph}') is None:
-            if fb_put(f'devices/{device_id}/meta/sensors/{ph}',
-                      {'name': ph, 'phase': ph, 'properties': [], 'enabled': True,
-                       'created_at': _ts_now(), 'updated_at': _ts_now()}):
+            data = {'name': ph, 'phase': ph, 'properties': [], 'enabled': True,
+                    'created_at': _ts_now(), 'updated_at': _ts_now()}
+            if fb_put(f'devices/{device_id}/meta/sensors/{ph}', data):
+                _devices.update(device_id, data, ph)
                 count += 1
     return jsonify({'ok': True, 'initialized': count, 'device_id': device_id, 'phases': detected})
 @app.route('/api/devices/<device_id>/rename', methods=['POST'])
+@_via_leader
 def rename_device(device_id: str):
     name = ((request.get_json(silent=True) or {}).get('name') or '').strip()
     ok, err = validate_device_name(name)
     if not ok: return jsonify({'ok': False, 'error': err}), 400
     if fb_patch(f'devices/{device_id}/meta', {'name': name}):
+        _devices.update(device_id, {'name': name})
         return jsonify({'ok': True, 'name': name, 'timestamp': int(time.time() * 1000)})
     return jsonify({'ok': False, 'error': 'Gagal menyimpan ke Firebase'}), 500
 @app.route('/api/devices/<device_id>/sensors/<phase>/rename', methods=['POST'])
+@_via_leader
 def rename_sensor(device_id: str, phase: str):
     phase = phase.upper()
     if not validate_phase_key(phase): return jsonify({'ok': False, 'error': f'Phase tidak valid: {phase}.'}), 400
@@ -407,9 +1814,11 @@ def rename_sensor(device_id: str, phase: str):
     data = {'name': name, 'phase': phase, 'properties': cur.get('properties', []),
             'enabled': cur.get('enabled', True), 'created_at': cur.get('created_at', _ts_now()), 'updated_at': _ts_now()}
     if fb_patch(f'devices/{device_id}/meta/sensors/{phase}', data):
+        _devices.update(device_id, data, phase)
         return jsonify({'ok': True, 'name': name, 'phase': phase, 'timestamp': int(time.time() * 1000)})
     return jsonify({'ok': False, 'error': 'Gagal menyimpan ke Firebase'}), 500
 @app.route('/api/devices/<device_id>/sensors/<phase>/init', methods=['POST'])
+@_via_leader
 def init_sensor(device_id: str, phase: str):
     phase = phase.upper()
     if not validate_phase_key(phase): return jsonify({'ok': False, 'error': f'Phase tidak valid: {phase}.'}), 400
@@ -417,58 +1826,77 @@ def init_sensor(device_id: str, phase: str):
     if ex: return jsonify({'ok': True, 'exists': True, 'sensor': ex})
     data = {'name': f'Phase {phase[1:]}', 'phase': phase, 'properties': [], 'enabled': True, 'created_at': _ts_now()}
     if fb_put(f'devices/{device_id}/meta/sensors/{phase}', data):
+        _devices.update(device_id, data, phase)
         return jsonify({'ok': True, 'sensor': data, 'timestamp': int(time.time() * 1000)})
     return jsonify({'ok': False, 'error': 'Gagal membuat sensor'}), 500
 @app.route('/api/devices/<device_id>/sensors/<phase>/enabled', methods=['POST'])
+@_via_leader
 def set_phase_enabled(device_id: str, phase: str):
     phase = phase.upper()
     if not validate_phase_key(phase): return jsonify({'ok': False, 'error': f'Phase tidak valid: {phase}.'}), 400
     enabled = bool((request.get_json(silent=True) or {}).get('enabled', True))
     if fb_patch(f'devices/{device_id}/meta/sensors/{phase}', {'enabled': enabled, 'updated_at': _ts_now()}):
+        _devices.update(device_id, {'enabled': enabled}, phase)
         return jsonify({'ok': True, 'phase': phase, 'enabled': enabled})
     return jsonify({'ok': False, 'error': 'Gagal menyimpan'}), 500
 @app.route('/api/devices/<device_id>/hourly-capture', methods=['POST'])
+@_via_leader
 def trigger_hourly_capture(device_id: str):
-    threading.Thread(target=_chain_capture_and_day, args=(device_id,), daemon=True).start()
+    _scheduler.submit(_chain_capture_and_day, device_id, key=f'hourly:{device_id}')
     return jsonify({'ok': True, 'device_id': device_id, 'triggered_at': _ts_now()})
 @app.route('/api/hourly-capture/trigger-all', methods=['POST'])
+@_via_leader
 def trigger_hourly_all():
-    threading.Thread(target=_do_hourly_capture_all, daemon=True).start()
+    _scheduler.submit(_do_hourly_capture_all, key='hourly-all')
     return jsonify({'ok': True, 'triggered_at': _ts_now()})
 @app.route('/api/capture/status')
 def capture_status():
-    with _capture_lock:
-        s = _capture_state
-        return jsonify({
-            'active': s['active'], 'device_id': s['device_id'], 'device_name': s['device_name'],
-            'session_id': s['session_id'], 'session_name': s['session_name'], 'interval': s['interval'],
-            'count': s['count'], 'started_at': s['started_at'], 'finalizing': s.get('_finalizing', False),
-        })
+    sid = request.args.get('session_id'); did = request.args.get('device_id')
+    sessions, defaults = _capture_view()
+    sessions.sort(key=lambda x: x['session_id'])
+    if sid or did:
+        key, val = ('session_id', sid) if sid else ('device_id', did)
+        found = [x for x in sessions if x[key] == val]
+        # A device can have several sessions: report its newest active one
+        s = next((x for x in reversed(found) if x['active']), found[-1] if found else None)
+    else: s = sessions[-1] if sessions else None
+    if s: return jsonify({**s, 'sessions': sessions})
+    return jsonify({
+        'active': False, 'device_id': did, 'device_name': None, 'session_id': sid, 'session_name': None,
+        'interval': defaults['interval'], 'count': 0, 'started_at': None, 'finalizing': False,
+        'sessions': sessions,
+    })
 @app.route('/api/capture/start', methods=['POST'])
+@_via_leader
 def capture_start():
     body  = request.get_json(silent=True) or {}
     did   = (body.get('deviceId')    or '').strip()
     dname = (body.get('deviceName')  or '').strip()
     sname = (body.get('sessionName') or '').strip() or f'Rekaman {_ts_now()}'
-    iv    = max(1, int(body.get('interval', 3)))
+    iv    = _capture_iv(body.get('interval', 3))
     hints = sorted([p for p in (body.get('phases') or []) if _PHASE_RE.match(p)], key=lambda x: int(x[1:]))
     if not did: return jsonify({'ok': False, 'error': 'deviceId harus diisi'}), 400
     if not hints: return jsonify({'ok': False, 'error': 'Minimal 1 phase harus diaktifkan'}), 400
     with _capture_lock:
-        if _capture_state['active'] or _capture_state.get('_finalizing'):
-            return jsonify({'ok': False, 'error': 'Capture sudah berjalan atau sedang finalisasi'}), 409
-        sid    = f'session_{int(time.time() * 1000)}'
+        # Sessions on one device share its energy counter: only the first one resets it
+        first = not any(s['active'] and s['device_id'] == did for s in _capture_sessions.values())
+        start_ms = int(time.time() * 1000)
+        while f'session_{start_ms}' in _capture_sessions: start_ms += 1
+        sid    = f'session_{start_ms}'
         now_s  = _ts_now()
         phases = hints
         ep     = hints
-        _capture_state.update({
+        _capture_sessions[sid] = {
             'active': True, 'device_id': did, 'device_name': dname or did,
             'session_id': sid, 'session_name': sname, 'interval': iv,
             'count': 0, 'started_at': now_s, 'enabled_phases': ep, 'time_offset_ms': 0,
-        })
+            'highrate': iv < 1, 'missed': 0,
+            '_finalizing': False, '_next': time.time() + 3.5, '_shift_floor': 0.0, '_expected': 0,
+        }
+        if iv < 1: _highrate_start(sid, did)
         meta = {
             'id': sid, 'name': sname, 'deviceId': did, 'deviceName': dname or did,
-            'startTime': now_s, 'startTimestamp': int(time.time() * 1000),
+            'startTime': now_s, 'startTimestamp': start_ms,
             'endTime': None, 'recordCount': 0, 'phaseNames': {ph: ph for ph in phases},
         }
         def _meta_bg():
@@ -478,43 +1906,845 @@ def capture_start():
             except: pass
             # Update metadata in History for each phase
             for ph in phases:
-                fb_put(f'devices/{did}/History/{ph}/{sid}/_meta', meta)
+                _fb_writes.put(f'devices/{did}/History/{ph}/{sid}/_meta', meta)
             # Also update the centralized Sessions metadata node for efficient frontend listing
-            fb_put(f'devices/{did}/Sessions/{sid}', meta)
-        threading.Thread(target=_meta_bg, daemon=True).start()
-        def _energy_bg():
-            try:
-                fb_put(f'devices/{did}/Commands/resetEnergy', {'command': True, 'timestamp': int(time.time()*1000)})
-                time.sleep(5); fb_delete(f'devices/{did}/Commands/resetEnergy')
-            except: pass
-        threading.Thread(target=_energy_bg, daemon=True).start()
-        _start_thread()
+            _fb_writes.put(f'devices/{did}/Sessions/{sid}', meta)
+        _scheduler.submit(_meta_bg, key=f'meta:{sid}')
+        if first: _scheduler.submit(_reset_energy, did, key=f'reset:{did}')
+    _capture_wake.set()
     return jsonify({'ok': True, 'session_id': sid, 'session_name': sname, 'device_id': did})
+def _reset_energy(did: str) -> None:
+    # Written directly, not through _fb_writes: a queued put and the delayed
+    # delete could land in one batch, and the delete would replace the command
+    path = f'devices/{did}/Commands/resetEnergy'
+    if fb_put(path, {'command': True, 'timestamp': int(time.time()*1000)}): _scheduler.call_later(5, fb_delete, path)
+def _capture_target(body: dict) -> tuple[dict | None, str | None]:
+    sid = body.get('sessionId'); did = body.get('deviceId')
+    if not sid and did and sum(s['active'] and s['device_id'] == did for s in _capture_sessions.values()) > 1:
+        return None, 'sessionId harus diisi (lebih dari satu capture aktif di device ini)'
+    if sid or did: return _capture_find(sid, did), None
+    active = [s for s in _capture_sessions.values() if s['active']]
+    if len(active) > 1: return None, 'sessionId harus diisi (lebih dari satu capture aktif)'
+    return (active[0] if active else None), None
 @app.route('/api/capture/stop', methods=['POST'])
+@_via_leader
 def capture_stop():
     with _capture_lock:
-        if not _capture_state['active']: return jsonify({'ok': False, 'error': 'Tidak ada capture aktif'}), 400
-    _stop_and_respond()
-    return jsonify({'ok': True})
+        s, err = _capture_target(request.get_json(silent=True) or {})
+        if err: return jsonify({'ok': False, 'error': err}), 400
+        if not s or not s['active']: return jsonify({'ok': False, 'error': 'Tidak ada capture aktif'}), 400
+        sid = s['session_id']
+    _stop_session(sid)
+    return jsonify({'ok': True, 'session_id': sid})
 @app.route('/api/capture/interval', methods=['POST'])
+@_via_leader
 def capture_interval():
-    iv = max(1, int((request.get_json(silent=True) or {}).get('interval', 3)))
+    body = request.get_json(silent=True) or {}
+    iv = _capture_iv(body.get('interval', 3))
     with _capture_lock:
-        _capture_state['interval'] = iv
-        ev = _capture_state.get('_wake_event')
-        if ev: ev.set()
-    return jsonify({'ok': True, 'interval': iv})
+        s, err = _capture_target(body)
+        if err: return jsonify({'ok': False, 'error': err}), 400
+        if s and s['active'] and iv < 1 and not s['highrate']:
+            return jsonify({'ok': False, 'error': 'Interval di bawah 1 detik hanya untuk sesi high-rate'}), 400
+        if s and s['active'] and s['highrate']: s['interval'] = iv   # its sampler re-anchors on the next tick
+        elif s and s['active']:
+            # Never schedule below a pending time-shift boundary (see _shift_job)
+            s['interval'] = iv; s['_next'] = max(min(s['_next'], time.time() + iv), s['_shift_floor'])
+        elif not (body.get('sessionId') or body.get('deviceId')):
+            _capture_defaults['interval'] = iv
+    _capture_wake.set()
+    return jsonify({'ok': True, 'interval': iv, 'session_id': s['session_id'] if s else None})
 
-@app.route('/api/capture/shift_time', methods=['POST'])
-def capture_shift_time():
+# --- Leader election and state publishing -----------------------------------
+_shared = {'lock': threading.Lock(), 'writer': None, 'reader': None, 'ino': None, 'seq': None, 'state': None}
+
+def _shared_state() -> dict | None:
+    # Last state the leader published, re-parsed only when its seq moves
+    path = _shared_path('state.blob')
+    with _shared['lock']:
+        try: ino = os.stat(path).st_ino
+        except OSError: return _shared['state']
+        if ino != _shared['ino']:
+            mm, _shared['ino'] = _shm_open(path)
+            _shared['reader'], _shared['seq'] = (_SeqBlob(mm) if mm is not None else None), None
+        if _shared['reader'] is None: return _shared['state']
+        seq, data = _shared['reader'].read(_shared['seq'])
+        if data is not None:
+            try: _shared['state'], _shared['seq'] = json.loads(data), seq
+            except ValueError: pass
+        return _shared['state']
+def _shared_publish() -> None:
+    blob = _shared['writer']
+    if blob is None: return
+    with _capture_lock:
+        caps = [{**_capture_public(s), '_next': s['_next'], '_expected': s['_expected'], '_shift_floor': s['_shift_floor']}
+                for s in _capture_sessions.values()]
+        defaults = dict(_capture_defaults)
+    body, etag = _devices.peek()
+    state = {'pid': os.getpid(), 'since': _leader['since'], 'at': time.time(), 'capture': caps, 'defaults': defaults,
+             'devices': body.decode() if body else None, 'etag': etag, 'stats_epoch': _stats_epoch[0]}
+    with _shared['lock']:
+        if not blob.write(json.dumps(state, separators=(',', ':')).encode()):
+            print(f'Shared state exceeds SHARED_STATE_BYTES ({SHARED_STATE_BYTES}); not published')
+def _shared_publish_loop() -> None:
+    while True:
+        try: _shared_publish()
+        except Exception: pass
+        time.sleep(SHARED_PUBLISH_S)
+def _live_seed() -> None:
+    # A new leader continues the rings the previous one left in SHARED_DIR
+    try: names = [n for n in os.listdir(_shared_path('live')) if n.endswith('.ring')]
+    except OSError: return
+    for n in names:
+        did = unquote(n[:-5])
+        try:
+            ring, offline = _LiveRing(), False
+            for e in _SharedRingView(did).window():
+                offline = bool(e['data'].get('offline'))
+                if offline: ring.append_offline(e['timestamp'])
+                else: ring.append(e['timestamp'], e['data'])
+            ring.mirror = _SharedRing.create(did, ring.window_ms, ring.max_entries).put
+        except Exception: continue
+        with _live_lock:
+            _device_live_buffer.setdefault(did, ring); _device_is_offline[did] = offline
+def _capture_restore(state: dict | None) -> None:
+    # Sessions keep their grid; ticks missed during the hand-over count as expected but unwritten
+    now, finalize, highrate = time.time(), [], []
+    with _capture_lock:
+        for s in (state or {}).get('capture', []):
+            sid, iv = s['session_id'], float(s['interval'])
+            if sid in _capture_sessions: continue
+            nxt, expected, skipped = s.get('_next') or now, s.get('_expected', 0), s.get('missed', 0)
+            if s['active'] and nxt < now:
+                missed = int((now - nxt) // iv) + 1
+                nxt += missed * iv; expected += missed
+                if s.get('highrate'): skipped += missed
+            _capture_sessions[sid] = {
+                'active': s['active'], 'device_id': s['device_id'], 'device_name': s['device_name'],
+                'session_id': sid, 'session_name': s['session_name'], 'interval': s['interval'],
+                'count': s['count'], 'started_at': s['started_at'], 'enabled_phases': s['enabled_phases'],
+                'time_offset_ms': s['time_offset_ms'], 'highrate': s.get('highrate', False), 'missed': skipped,
+                '_finalizing': s['finalizing'], '_next': nxt, '_shift_floor': s.get('_shift_floor', 0.0), '_expected': expected,
+            }
+            if s['finalizing']: finalize.append((sid, s['device_id'], s['enabled_phases']))
+            elif s['active'] and s.get('highrate'): highrate.append((sid, s['device_id']))
+        _capture_defaults.update((state or {}).get('defaults') or {})
+    for sid, did, ep in finalize: _scheduler.submit(_finalize_bg, sid, did, ep, key=f'finalize:{sid}', bulk=True)
+    for sid, did in highrate: _highrate_start(sid, did)
+def _leader_serve() -> None:
+    path = _shared_path('leader.sock')
+    try: os.unlink(path)
+    except OSError: pass
+    make_server('unix://' + path, 0, app, threaded=True).serve_forever()
+def _leader_promote() -> None:
+    previous = _shared_state()
+    _leader.update(role='leader', since=_ts_now())
+    _live_seed()
+    _capture_restore(previous)
+    _shared['writer'] = _SeqBlob(_shm_create(_shared_path('state.blob'), SHARED_STATE_BYTES))
+    _shared_publish()
+    threading.Thread(target=_leader_serve, daemon=True).start()
+    threading.Thread(target=_shared_publish_loop, daemon=True).start()
+    for fn in _ingest_fns: fn()
+    print(f'Ingestion leader: pid {os.getpid()} ({SHARED_DIR})')
+def _leader_try() -> bool:
+    try:
+        os.makedirs(_shared_path('live'), exist_ok=True)
+        if _leader['fd'] is None: _leader['fd'] = os.open(_shared_path('leader.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(_leader['fd'], fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError: return False
+    _leader_promote()
+    return True
+def _leader_elect() -> None:
+    while not _leader_try(): time.sleep(LEADER_RETRY_S)
+def _leader_start() -> None:
+    if LEADER_MODE and not _leader_try(): threading.Thread(target=_leader_elect, daemon=True).start()
+def _leader_after_fork() -> None:
+    # A forked worker (gunicorn --preload) shares the parent's lock, not its threads
+    if not LEADER_MODE: return
+    _leader.update(role='follower', fd=None, since=None)
+    _shared.update(lock=threading.Lock(), writer=None)
+    threading.Thread(target=_leader_elect, daemon=True).start()
+os.register_at_fork(after_in_child=_leader_after_fork)
+@app.route('/api/leader')
+def leader_status():
+    st = _shared_state() if LEADER_MODE else None
+    return jsonify({'leader_mode': LEADER_MODE, 'role': _leader['role'], 'pid': os.getpid(), 'since': _leader['since'],
+                    'shared_dir': SHARED_DIR if LEADER_MODE else None, 'leader_pid': (st or {}).get('pid'),
+                    'leader_since': (st or {}).get('since'),
+                    'state_age_s': round(time.time() - st['at'], 3) if st else None})
+
+# --- Session export (streamed CSV / XLSX) -----------------------------------
+# History is read in ordered key pages (capture_<ms>) and written through a
+# generator, so memory stays flat regardless of session length. Columns and
+# rounding are those of the dashboard's former in-browser SheetJS export.
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', 1000))
+_EXPORT_COLUMNS = (
+    ('Voltage (V)', 'Voltage', 2), ('Current (A)', 'Current', 2), ('Power (W)', 'Power', 2),
+    ('Apparent Power (kVA)', 'Apparent', 4), ('Reactive Power (kVAR)', 'Reactive', 4),
+    ('Power Factor', 'PowerFactor', 4), ('Phase Angle (°)', 'Phase1', 3), ('Frequency (Hz)', 'Frequency', 1),
+    ('Active Energy (kWh)', 'Energy', 4), ('Apparent Energy (kVAh)', 'EnergyApparent', 4),
+    ('Reactive Energy (kVARh)', 'EnergyReactive', 4),
+)
+_EXPORT_HEADER = ['Device Name', 'Timestamp', 'Status'] + [c for c, _, _ in _EXPORT_COLUMNS]
+_EXPORT_WIDTHS = (20, 20, 20, 10, 13, 13, 13, 20, 20, 14, 16, 14, 20, 22, 22)
+
+def _iter_history_records(did: str, sid: str, ph: str, page: int = EXPORT_PAGE_SIZE, start: str = 'capture_'):
+    path = f'devices/{did}/History/{ph}/{sid}'
+    while True:
+        chunk = fb_get_page(path, start, 'capture_\uf8ff', page + 1)
+        keys  = sorted(k for k in chunk if k > start)
+        for k in keys:
+            if isinstance(chunk[k], dict): yield k, chunk[k]
+        if len(chunk) < page + 1 or not keys: return
+        start = keys[-1]
+def _session_meta(did: str, sid: str) -> dict:
+    meta = fb_get(f'devices/{did}/Sessions/{sid}')
+    if isinstance(meta, dict) and meta: return meta
+    for ph in sorted((fb_get_shallow(f'devices/{did}/History') or {}), key=lambda x: int(x[1:]) if _PHASE_RE.match(x) else 0):
+        if not _PHASE_RE.match(ph): continue
+        m = fb_get(f'devices/{did}/History/{ph}/{sid}/_meta')
+        if isinstance(m, dict): return m
+    return {}
+def _session_phases(did: str, meta: dict) -> list[str]:
+    phases = [p for p in (meta.get('phaseNames') or {}) if _PHASE_RE.match(p)]
+    if not phases: phases = [p for p in (fb_get_shallow(f'devices/{did}/History') or {}) if _PHASE_RE.match(p)]
+    return sorted(phases, key=lambda x: int(x[1:]))
+def _export_row(rec: dict, device_name: str) -> list:
+    ts = rec.get('timestamp') or ''
+    if isinstance(rec.get('scheduled_ms'), int):   # high-rate records: keep the milliseconds
+        ts = datetime.fromtimestamp(rec['scheduled_ms'] / 1000, tz=_WIB).strftime('%H:%M:%S.%f')[:-3] + ts[8:]
+    row = [device_name, ts, 'OFFLINE' if rec.get('offline') else 'online']
+    for _, k, nd in _EXPORT_COLUMNS:
+        v = rec.get(k)
+        row.append(round(float(v), nd) if isinstance(v, (int, float)) else '')
+    return row
+class _ExportSummary:
+    _AVG = (('Voltage', 'Voltage', 2, 'V'), ('Current', 'Current', 2, 'A'), ('Power', 'Power', 2, 'W'),
+            ('Apparent Power', 'Apparent', 4, 'kVA'), ('Reactive Power', 'Reactive', 4, 'kVAR'),
+            ('Power Factor', 'PowerFactor', 4, ''), ('Phase Angle', 'Phase1', 3, '°'), ('Frequency', 'Frequency', 1, 'Hz'))
+    _SUM = (('Total Active Energy', 'Energy', 'kWh'), ('Total Apparent Energy', 'EnergyApparent', 'kVAh'),
+            ('Total Reactive Energy', 'EnergyReactive', 'kVARh'))
+    def __init__(self): self.total = 0; self.online = 0; self.sums = {}
+    def add(self, rec: dict) -> None:
+        self.total += 1
+        if rec.get('offline'): return
+        self.online += 1
+        for k in [a[1] for a in self._AVG] + [a[1] for a in self._SUM]:
+            v = rec.get(k)
+            if isinstance(v, (int, float)): self.sums[k] = self.sums.get(k, 0.0) + v
+    def rows(self, meta: dict, device_name: str, phases: list) -> list:
+        avg = lambda k, nd: round(self.sums.get(k, 0.0) / self.online, nd) if self.online else 0
+        return [
+            ['Smart Energy Monitor - Session Export'], [''],
+            ['Nama Sesi', meta.get('name') or ''], ['Export Date', _ts_now()],
+            ['Device Name', device_name], ['Phases', ', '.join(phases)],
+            ['Waktu Mulai', meta.get('startTime') or '---'], ['Waktu Selesai', meta.get('endTime') or 'Berlangsung'],
+            ['Total Records', self.total], ['Records Online', self.online], ['Records Offline', self.total - self.online], [''],
+            ['Summary Statistics (semua phase, online saja)'], [''],
+            ['Parameter', 'Rata-rata', 'Satuan'],
+            *[[label, avg(k, nd), unit] for label, k, nd, unit in self._AVG],
+            *[[label, round(self.sums.get(k, 0.0), 4), unit] for label, k, unit in self._SUM],
+        ]
+class _ChunkSink(io.RawIOBase):
+    def __init__(self): self.chunks = []
+    def writable(self) -> bool: return True
+    def write(self, b) -> int: self.chunks.append(bytes(b)); return len(b)
+    def drain(self) -> bytes:
+        out = b''.join(self.chunks); self.chunks = []; return out
+def _xlsx_col(i: int) -> str:
+    s = ''
+    while True:
+        s = chr(65 + i % 26) + s; i = i // 26 - 1
+        if i < 0: return s
+class _XlsxStream:
+    # Minimal SpreadsheetML writer: inline strings, one part per sheet, streamed
+    def __init__(self, dst):
+        self.zf = zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED); self.sheets = []; self._fh = None; self._r = 0
+    def _safe_name(self, name: str) -> str:
+        base = re.sub(r'[\[\]:*?/\\]', '_', name or 'Sheet')[:31] or 'Sheet'; n, i = base, 2
+        while n.lower() in (s.lower() for s in self.sheets): n = f'{base[:28]}~{i}'; i += 1
+        return n
+    def begin(self, name: str, widths=()) -> None:
+        self.sheets.append(self._safe_name(name)); self._r = 0
+        self._fh = self.zf.open(f'xl/worksheets/sheet{len(self.sheets)}.xml', 'w')
+        cols = ''.join(f'<col min="{i + 1}" max="{i + 1}" width="{w}" customWidth="1"/>' for i, w in enumerate(widths))
+        self._fh.write(('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                        + (f'<cols>{cols}</cols>' if cols else '') + '<sheetData>').encode())
+    def row(self, values: list) -> None:
+        self._r += 1; cells = []
+        for i, v in enumerate(values):
+            ref = f'{_xlsx_col(i)}{self._r}'
+            if isinstance(v, bool) or not isinstance(v, (int, float)):
+                if v == '' or v is None: continue
+                cells.append(f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{_xml_escape(str(v))}</t></is></c>')
+            else: cells.append(f'<c r="{ref}"><v>{v!r}</v></c>')
+        self._fh.write(f'<row r="{self._r}">{"".join(cells)}</row>'.encode())
+    def end(self) -> None:
+        self._fh.write(b'</sheetData></worksheet>'); self._fh.close(); self._fh = None
+    def close(self) -> None:
+        n = len(self.sheets)
+        sheets = ''.join(f'<sheet name="{_xml_escape(s, {chr(34): "&quot;"})}" sheetId="{i + 1}" r:id="rId{i + 1}"/>' for i, s in enumerate(self.sheets))
+        rels = ''.join(f'<Relationship Id="rId{i + 1}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet{i + 1}.xml"/>' for i in range(n))
+        over = ''.join(f'<Override PartName="/xl/worksheets/sheet{i + 1}.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>' for i in range(n))
+        hdr = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        self.zf.writestr('xl/workbook.xml', hdr + '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+                         f'<sheets>{sheets}</sheets></workbook>')
+        self.zf.writestr('xl/_rels/workbook.xml.rels', hdr + f'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">{rels}</Relationships>')
+        self.zf.writestr('_rels/.rels', hdr + '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                         '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/></Relationships>')
+        self.zf.writestr('[Content_Types].xml', hdr + '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                         '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                         '<Default Extension="xml" ContentType="application/xml"/>'
+                         '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                         f'{over}</Types>')
+        self.zf.close()
+class _CsvPart:
+    def __init__(self, zf: zipfile.ZipFile, name: str):
+        self._fh = zf.open(name, 'w'); self._tw = io.TextIOWrapper(self._fh, encoding='utf-8-sig', newline='')
+        self._w = csv.writer(self._tw)
+    def row(self, values: list) -> None: self._w.writerow(values)
+    def end(self) -> None: self._tw.close()
+def _safe_filename(name: str) -> str: return re.sub(r'[\\/:*?"<>|]', '_', name or 'export').strip() or 'export'
+def _export_session(did: str, sid: str, fmt: str, dst=None, zf: zipfile.ZipFile | None = None, prefix: str = ''):
+    # Generator: writes into `dst` (xlsx) or `zf` (csv parts) and yields after
+    # each page so the caller can hand buffered bytes to the client.
+    meta   = _session_meta(did, sid)
+    phases = _session_phases(did, meta)
+    dname  = meta.get('deviceName') or did
+    names  = meta.get('phaseNames') or {}
+    summ   = _ExportSummary(); done = []
+    book   = _XlsxStream(dst) if fmt == 'xlsx' else None
+    for ph in phases:
+        part = None
+        for i, (_, rec) in enumerate(_iter_session_records(did, sid, ph, meta)):
+            if part is None:
+                if book: book.begin(names.get(ph) or ph, _EXPORT_WIDTHS); part = book
+                else: part = _CsvPart(zf, f'{prefix}{_safe_filename(names.get(ph) or ph)}.csv')
+                part.row(_EXPORT_HEADER); done.append(ph)
+            part.row(_export_row(rec, dname)); summ.add(rec)
+            if i % 200 == 199: yield
+        if part is not None: part.end(); yield
+    rows = summ.rows(meta, dname, done)
+    part = (book.begin('Summary', (28, 28, 10)) or book) if book else _CsvPart(zf, f'{prefix}Summary.csv')
+    for r in rows: part.row(r)
+    part.end()
+    if book: book.close()
+    yield
+def _export_stream(did: str, sids: list, fmt: str, single: bool):
+    sink = _ChunkSink()
+    if single and fmt == 'xlsx':
+        for _ in _export_session(did, sids[0], fmt, dst=sink): yield sink.drain()
+    else:
+        outer, used = zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED), set()
+        for sid in sids:
+            name = _safe_filename((_session_meta(did, sid).get('name') if not single else '') or sid)
+            while name in used: name += '_'
+            used.add(name)
+            if fmt == 'xlsx':
+                with outer.open(f'{name}.xlsx', 'w') as fh:
+                    for _ in _export_session(did, sid, fmt, dst=fh): yield sink.drain()
+            else:
+                for _ in _export_session(did, sid, fmt, zf=outer, prefix='' if single else f'{name}/'): yield sink.drain()
+        outer.close()
+    yield sink.drain()
+def _export_response(did: str, sids: list, fmt: str, filename: str):
+    single = len(sids) == 1
+    fmt    = fmt if fmt in ('xlsx', 'csv') else 'xlsx'
+    ext, mime = ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet') if single and fmt == 'xlsx' else ('zip', 'application/zip')
+    fname = f'{_safe_filename(filename)}.{ext}'
+    return app.response_class(_export_stream(did, sids, fmt, single), mimetype=mime, headers={
+        'Content-Disposition': f"attachment; filename=\"{fname.encode('ascii', 'replace').decode()}\"; filename*=UTF-8''{quote(fname)}",
+        'X-Accel-Buffering': 'no',
+    })
+@app.route('/api/sessions/<device_id>/<session_id>/export')
+def export_session(device_id: str, session_id: str):
+    meta = _session_meta(device_id, session_id)
+    if not meta: return jsonify({'ok': False, 'error': 'Sesi tidak ditemukan'}), 404
+    return _export_response(device_id, [session_id], request.args.get('format', 'xlsx'), meta.get('name') or session_id)
+@app.route('/api/sessions/<device_id>/export')
+def export_sessions(device_id: str):
+    sids = [s for s in (request.args.get('ids') or '').split(',') if s.strip()]
+    if not sids: return jsonify({'ok': False, 'error': 'ids harus diisi'}), 400
+    return _export_response(device_id, list(dict.fromkeys(sids)), request.args.get('format', 'xlsx'), f'{device_id}_sessions')
+# --- Session time shift -------------------------------------------------------
+# Moves one session so its oldest record starts at `newStartTime`. Records are
+# read in key pages and their `timestamp` rewritten with one bounded multi-path
+# PATCH per page. For a live session the capture offset is bumped first: ticks
+# scheduled from the current `_next` on are written already shifted, so only
+# keys below that boundary are rewritten, after in-flight ticks have landed.
+SHIFT_PAGE_SIZE = int(os.environ.get('SHIFT_PAGE_SIZE', 500))
+_shift_jobs = {}
+_shift_lock = threading.Lock()
+
+def _parse_ts(s) -> int | None:
+    try: return int(datetime.strptime(s, '%H:%M:%S %d/%m/%Y').replace(tzinfo=_WIB).timestamp() * 1000)
+    except Exception: return None
+def _fmt_ts(ms: int) -> str: return datetime.fromtimestamp(ms / 1000, tz=_WIB).strftime('%H:%M:%S %d/%m/%Y')
+def _shift_patch(path: str, updates: dict) -> None:
+    for attempt in range(FB_WRITE_RETRIES + 1):
+        if fb_patch(path, updates): return
+        time.sleep(min(0.5 * 2 ** attempt, 10))
+    raise RuntimeError(f'PATCH {path} gagal')
+def _shift_job(job: dict, new_start_ms: int) -> None:
+    did, sid = job['device_id'], job['session_id']
+    try:
+        job['state'] = 'running'
+        meta   = _session_meta(did, sid)
+        phases = _session_phases(did, meta)
+        oldest = None
+        for ph in phases:
+            for _, rec in _iter_history_records(did, sid, ph, 1):
+                t = _parse_ts(rec.get('timestamp'))
+                if t is not None: oldest = t if oldest is None else min(oldest, t)
+                break
+        archived = (meta.get('archived') or {}).get('phases') or []
+        for ph in archived if oldest is None else ():
+            arc = _archive_read(did, sid, ph, meta)
+            if arc is not None and arc['display_ms'].size: oldest = min(oldest or 2 ** 62, int(arc['display_ms'][0]))
+        if oldest is None: oldest = _parse_ts(meta.get('startTime')) or meta.get('startTimestamp') or new_start_ms
+        delta = new_start_ms - oldest
+        job.update(delta_ms=delta, phases=len(phases))
+        bound = None
+        with _capture_lock:
+            s = _capture_sessions.get(sid)
+            if s and s['_finalizing']: raise RuntimeError('Sesi sedang finalisasi')
+            if s and s['active'] and delta:
+                s['time_offset_ms'] += delta; s['started_at'] = _fmt_ts(new_start_ms)
+                s['_shift_floor'] = s['_next']; bound = int(s['_next'] * 1000)
+        if bound is not None:
+            # Ticks dispatched before the bump carry the old offset; let them land
+            _scheduler.wait_idle(lambda k: k.startswith(f'capture:{did}:') and int(k.rsplit(':', 1)[1]) < bound, 30)
+            hr = _highrate.get(sid)
+            if hr: hr.flush()
+            _fb_writes.flush()
+        latest = None
+        for i, ph in enumerate(phases):
+            job['phase'] = ph
+            path, updates = f'devices/{did}/History/{ph}/{sid}', {}
+            for key, rec in (_iter_history_records(did, sid, ph, SHIFT_PAGE_SIZE) if delta else ()):
+                if bound is not None and key[8:].isdigit() and int(key[8:]) >= bound: break
+                job['scanned'] += 1
+                t = _parse_ts(rec.get('timestamp'))
+                if t is None: continue
+                updates[f'{key}/timestamp'] = _fmt_ts(t + delta); latest = max(latest or 0, t + delta)
+                for f in ('scheduled_ms', 'sampled_ms'):
+                    if isinstance(rec.get(f), int): updates[f'{key}/{f}'] = rec[f] + delta
+                if len(updates) >= SHIFT_PAGE_SIZE:
+                    _shift_patch(path, updates); job['updated'] += len(updates); updates = {}
+            if updates: _shift_patch(path, updates); job['updated'] += len(updates)
+            if ph in archived and delta:
+                last = _archive_shift(did, sid, ph, delta)
+                if last is not None: latest = max(latest or 0, last)
+            job['phases_done'] = i + 1
+        mp = {'startTime': _fmt_ts(new_start_ms)}
+        if meta.get('startTimestamp'): mp['startTimestamp'] = meta['startTimestamp'] + delta
+        if meta.get('endTime') and meta['endTime'] != '---' and latest: mp['endTime'] = _fmt_ts(latest)
+        for ph in phases: _shift_patch(f'devices/{did}/History/{ph}/{sid}/_meta', mp)
+        if fb_get_shallow(f'devices/{did}/Sessions/{sid}'): _shift_patch(f'devices/{did}/Sessions/{sid}', mp)
+        _stats_invalidate(did, sid)
+        job['state'] = 'done'
+    except Exception as e:
+        job.update(state='error', error=str(e))
+    finally:
+        job['phase'] = None; job['finished_at'] = _ts_now()
+@app.route('/api/sessions/<device_id>/<session_id>/shift-time', methods=['POST'])
+@_via_leader
+def shift_session_time(device_id: str, session_id: str):
     body = request.get_json(silent=True) or {}
-    delta_ms = int(body.get('deltaMs', 0))
-    sid = body.get('sessionId')
+    new_str = (body.get('newStartTime') or '').strip()
+    if not new_str: return jsonify({'ok': False, 'error': 'newStartTime harus diisi'}), 400
+    new_ms = _parse_ts(new_str)
+    if new_ms is None: return jsonify({'ok': False, 'error': 'Format waktu tidak valid (HH:MM:SS DD/MM/YYYY)'}), 400
+    with _capture_lock:
+        s = _capture_sessions.get(session_id)
+        if s and s['_finalizing']: return jsonify({'ok': False, 'error': 'Sesi sedang finalisasi, coba lagi sebentar'}), 409
+    if (_archive_jobs.get(session_id) or {}).get('state') in ('queued', 'running'):
+        return jsonify({'ok': False, 'error': 'Sesi sedang diarsipkan, coba lagi sebentar'}), 409
+    with _shift_lock:
+        j = _shift_jobs.get(session_id)
+        if j and j['state'] in ('queued', 'running'):
+            return jsonify({'ok': False, 'error': 'Perubahan waktu sesi ini sedang berjalan'}), 409
+        if len(_shift_jobs) > 200:
+            for k in [k for k, v in _shift_jobs.items() if v['state'] in ('done', 'error')][:100]: _shift_jobs.pop(k)
+        job = _shift_jobs[session_id] = {
+            'device_id': device_id, 'session_id': session_id, 'state': 'queued', 'new_start_time': new_str,
+            'delta_ms': None, 'phase': None, 'phases': 0, 'phases_done': 0, 'scanned': 0, 'updated': 0,
+            'started_at': _ts_now(), 'finished_at': None, 'error': None,
+        }
+        _scheduler.submit(_shift_job, job, new_ms, key=f'shift:{session_id}', bulk=True)
+        return jsonify({'ok': True, **job}), 202
+@app.route('/api/sessions/<device_id>/<session_id>/shift-time')
+@_via_leader
+def shift_session_time_status(device_id: str, session_id: str):
+    with _shift_lock:
+        j = _shift_jobs.get(session_id)
+        if not j or j['device_id'] != device_id:
+            return jsonify({'ok': False, 'error': 'Tidak ada perubahan waktu untuk sesi ini'}), 404
+        return jsonify({'ok': j['state'] != 'error', **j})
+# --- Session analytics ----------------------------------------------------------
+# Columnar NumPy arrays per phase, loaded from History in key pages. Times are
+# the capture_<ms> schedule keys; online records only feed the electrical
+# figures. Results of ended sessions never change and are kept in an LRU.
+STATS_DEMAND_WINDOW_S = int(os.environ.get('STATS_DEMAND_WINDOW_S', 900))
+STATS_CACHE_MAX       = int(os.environ.get('STATS_CACHE_MAX', 512))
+_STATS_COLS = ('Voltage', 'Current', 'Power', 'PowerFactor', 'Energy', 'EnergyApparent', 'EnergyReactive')
+_PF_BINS    = (0.0, 0.5, 0.7, 0.8, 0.85, 0.9, 0.95, 1.0)
+_LF_BINS    = tuple(i / 10 for i in range(11))
+_stats_cache = OrderedDict()
+_stats_lock  = threading.Lock()
+
+def _load_columns(did: str, sid: str, ph: str, meta: dict | None = None, fields: tuple = _STATS_COLS) -> dict | None:
+    arc = _archive_read(did, sid, ph, meta)
+    if arc is not None: return arc
+    ts, off, cols, first_ts = [], [], {c: [] for c in fields}, None
+    for key, rec in _iter_history_records(did, sid, ph):
+        if not key[8:].isdigit(): continue
+        ts.append(int(key[8:])); off.append(bool(rec.get('offline')))
+        if first_ts is None: first_ts = (int(key[8:]), rec.get('timestamp'))
+        for c in fields:
+            v = rec.get(c); cols[c].append(float(v) if isinstance(v, (int, float)) else np.nan)
+    if not ts: return None
+    order = np.argsort(np.asarray(ts, dtype=np.int64), kind='stable')
+    out = {c: np.asarray(v, dtype=np.float64)[order] for c, v in cols.items()}
+    out['ts'] = np.asarray(ts, dtype=np.int64)[order]; out['offline'] = np.asarray(off, dtype=bool)[order]
+    t = _parse_ts(first_ts[1])
+    # Offset between schedule keys and displayed timestamps (capture offset / time shifts)
+    out['offset_ms'] = round((t - first_ts[0]) / 1000) * 1000 if t is not None else 0
+    return out
+def _counter_delta(e: np.ndarray) -> float:
+    # A drop means the meter counter was reset (resetEnergy): count from zero again
+    e = e[~np.isnan(e)]
+    if e.size < 2: return 0.0
+    d = np.diff(e)
+    return float(np.where(d >= 0, d, e[1:]).sum())
+def _demand(ts: np.ndarray, p: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    w = STATS_DEMAND_WINDOW_S * 1000
+    start, inv = np.unique(ts // w, return_inverse=True)
+    return start * w, np.bincount(inv, weights=p) / np.bincount(inv)
+def _hist(values: np.ndarray, bins: tuple) -> dict:
+    counts, _ = np.histogram(np.clip(values, bins[0], bins[-1]), bins=bins)
+    return {'bins': list(bins), 'counts': counts.tolist()}
+def _r(v, nd: int = 4):
+    return None if v is None or not np.isfinite(v) else round(float(v), nd)
+def _gaps(ts: np.ndarray, off: np.ndarray) -> dict:
+    dt = np.diff(ts).astype(np.float64)
+    step = float(np.median(dt)) if dt.size else 0.0
+    dur = np.append(dt, step)
+    starts = off & ~np.concatenate(([False], off[:-1]))
+    runs = np.bincount(np.cumsum(starts) * off, weights=dur)[1:] if off.any() else np.zeros(0)
+    holes = dt[dt > 2 * step] - step if step else np.zeros(0)
+    return {'offline_records': int(off.sum()), 'offline_seconds': _r(dur[off].sum() / 1000, 1), 'offline_gaps': int(starts.sum()),
+            'longest_gap_seconds': _r(runs.max() / 1000 if runs.size else 0.0, 1),
+            'missing_ticks_seconds': _r(holes.sum() / 1000, 1), 'interval_seconds': _r(step / 1000, 3)}
+def _phase_stats(c: dict) -> dict:
+    on = ~c['offline']
+    p  = c['Power'][on]; p = p[~np.isnan(p)]
+    out = {'records': int(c['ts'].size), 'online_records': int(on.sum()),
+           'energy_kwh': _r(_counter_delta(c['Energy'][on])), 'energy_kvah': _r(_counter_delta(c['EnergyApparent'][on])),
+           'energy_kvarh': _r(_counter_delta(c['EnergyReactive'][on])), **_gaps(c['ts'], c['offline'])}
+    if p.size:
+        starts, dem = _demand(c['ts'][on][~np.isnan(c['Power'][on])], p)
+        i = int(dem.argmax()); peak = float(dem[i])
+        out.update(avg_power_w=_r(p.mean(), 2), max_power_w=_r(p.max(), 2), peak_demand_w=_r(peak, 2),
+                   peak_demand_at=_fmt_ts(int(starts[i]) + c['offset_ms']),
+                   load_factor=_r(p.mean() / peak) if peak > 0 else None,
+                   load_distribution=_hist(p / peak, _LF_BINS) if peak > 0 else None)
+        c['_demand'] = dict(zip(starts.tolist(), dem.tolist()))
+    pf = np.abs(c['PowerFactor'][on]); pf = pf[~np.isnan(pf)]
+    if pf.size:
+        out['power_factor'] = {'mean': _r(pf.mean()), 'p5': _r(np.percentile(pf, 5)), 'p50': _r(np.percentile(pf, 50)),
+                               'p95': _r(np.percentile(pf, 95)), **_hist(pf, _PF_BINS)}
+    return out
+def _voltage_imbalance(cols: dict) -> dict | None:
+    # Max deviation from the phase mean, as % of the mean, at ticks where all phases are online
+    series = [(c['ts'][~c['offline']], c['Voltage'][~c['offline']]) for c in cols.values()]
+    if len(series) < 2: return None
+    common = series[0][0]
+    for ts, _ in series[1:]: common = np.intersect1d(common, ts, assume_unique=True)
+    if not common.size: return None
+    v  = np.vstack([vv[np.searchsorted(ts, common)] for ts, vv in series])
+    vm = v.mean(axis=0); ok = vm > 0
+    if not ok.any(): return None
+    imb = np.abs(v[:, ok] - vm[ok]).max(axis=0) / vm[ok] * 100
+    return {'samples': int(imb.size), 'mean_pct': _r(imb.mean(), 3), 'p95_pct': _r(np.percentile(imb, 95), 3),
+            'max_pct': _r(imb.max(), 3), 'over_2pct': int((imb > 2).sum())}
+def _session_stats(did: str, sid: str, meta: dict) -> dict:
+    cols = {ph: c for ph in _session_phases(did, meta) if (c := _load_columns(did, sid, ph, meta)) is not None}
+    phases = {ph: _phase_stats(c) for ph, c in cols.items()}
+    total = {k: _r(sum(s.get(k) or 0 for s in phases.values())) for k in ('energy_kwh', 'energy_kvah', 'energy_kvarh')}
+    dem = {}
+    for c in cols.values():
+        for t, v in c.get('_demand', {}).items(): dem[t] = dem.get(t, 0.0) + v
+    if dem:
+        t, peak = max(dem.items(), key=lambda x: x[1])
+        avg = sum(s.get('avg_power_w') or 0 for s in phases.values())
+        off = next(iter(cols.values()))['offset_ms']
+        total.update(peak_demand_w=_r(peak, 2), peak_demand_at=_fmt_ts(int(t) + off), avg_power_w=_r(avg, 2),
+                     load_factor=_r(avg / peak) if peak > 0 else None)
+    return {'device_id': did, 'session_id': sid, 'name': meta.get('name'), 'startTime': meta.get('startTime'),
+            'endTime': meta.get('endTime'), 'demand_window_seconds': STATS_DEMAND_WINDOW_S,
+            'phases': phases, 'total': total, 'voltage_imbalance': _voltage_imbalance(cols)}
+_stats_epoch = [0, 0]   # [this process's invalidations, leader epoch last applied]
+
+def _stats_key(meta: dict) -> str:
+    # Edits made from the dashboard bypass _stats_invalidate; they show up here
+    return json.dumps([meta.get(k) for k in ('recordCount', 'startTime', 'startTimestamp', 'endTime', 'archived')],
+                      sort_keys=True, default=str)
+def _stats_invalidate(did: str, sid: str) -> None:
+    with _stats_lock: _stats_cache.pop((did, sid), None); _stats_epoch[0] += 1
+@app.route('/api/sessions/<device_id>/<session_id>/stats')
+def session_stats(device_id: str, session_id: str):
+    epoch = (_shared_state() or {}).get('stats_epoch', 0) if _is_follower() else 0
+    with _stats_lock:
+        # The leader runs shift-time and retention; drop everything when it invalidated anything
+        if epoch != _stats_epoch[1]: _stats_cache.clear(); _stats_epoch[1] = epoch
+    meta = _session_meta(device_id, session_id)
+    with _stats_lock:
+        hit = _stats_cache.get((device_id, session_id))
+        if hit is not None and (not meta or hit[0] != _stats_key(meta)): _stats_cache.pop((device_id, session_id)); hit = None
+        if hit is not None: _stats_cache.move_to_end((device_id, session_id))
+    if not meta: return jsonify({'ok': False, 'error': 'Sesi tidak ditemukan'}), 404
+    if hit is not None: return jsonify({'ok': True, 'ended': True, 'cached': True, **hit[1]})
+    live  = any(s['session_id'] == session_id for s in _capture_view()[0])
+    ended = not live and meta.get('endTime') not in (None, '', '---')
+    try: res = _session_stats(device_id, session_id, meta)
+    except Exception as e: return jsonify({'ok': False, 'error': f'Gagal menghitung statistik: {e}'}), 500
+    if ended:
+        with _stats_lock:
+            _stats_cache[(device_id, session_id)] = (_stats_key(meta), res)
+            while len(_stats_cache) > STATS_CACHE_MAX: _stats_cache.popitem(last=False)
+    return jsonify({'ok': True, 'ended': ended, 'cached': False, **res})
+
+# --- Session archive ----------------------------------------------------------
+# A finished session is compacted into one blob per phase at
+# Archive/{sid}/{ph}. Columns (schedule key, displayed time, offline flag,
+# record fields) are stored as delta + zigzag int64 wherever the values allow
+# (floats through a per-column decimal scale), byte-shuffled and zlib'd, then
+# split into base64 chunks with a sha256. The archive is only marked in _meta
+# and Sessions once it decodes to exactly the raw records and reads back
+# intact; after that the raw capture_<ms> nodes may be dropped.
+ARCHIVE_AUTO        = (os.environ.get('ARCHIVE_AUTO') or '1').strip().lower() not in ('0', 'false', 'no', 'off')
+ARCHIVE_DELETE_RAW  = (os.environ.get('ARCHIVE_DELETE_RAW') or '').strip().lower() in ('1', 'true', 'yes', 'on')
+ARCHIVE_CHUNK_BYTES = int(os.environ.get('ARCHIVE_CHUNK_BYTES', 512 * 1024))
+_ARCHIVE_FIELDS = tuple(name for name, _ in _RECORD_FIELDS)
+_ARCHIVE_EXTRA  = ('scheduled_ms', 'sampled_ms')
+_archive_jobs = {}
+_archive_lock = threading.Lock()
+
+def _shuffle(a: np.ndarray) -> bytes: return a.view(np.uint8).reshape(-1, 8).T.tobytes()
+def _unshuffle(b: bytes, n: int, dtype: str) -> np.ndarray: return np.frombuffer(b, np.uint8).reshape(8, n).T.copy().view(dtype).ravel()
+def _zz_pack(a: np.ndarray) -> bytes:
+    d = np.diff(a.astype('<i8'), prepend=np.int64(0))
+    return _shuffle(((d << 1) ^ (d >> 63)).view('<u8'))
+def _zz_unpack(b: bytes, n: int) -> np.ndarray:
+    z = _unshuffle(b, n, '<u8')
+    return np.cumsum((z >> np.uint64(1)).view('<i8') ^ -(z & np.uint64(1)).view('<i8'))
+def _scale_dec(v: np.ndarray) -> int | None:
+    # Smallest decimal scale at which every value round-trips exactly through an int
+    for dec in range(7):
+        q = np.round(v * 10.0 ** dec)
+        if np.all(np.abs(q) < 2 ** 53) and np.array_equal(q / 10.0 ** dec, v): return dec
+    return None
+def _archive_encode(cols: dict) -> bytes:
+    spec, parts = [], []
+    for name, a in cols.items():
+        if a.dtype.kind == 'f' and (nan := np.isnan(a)).any():
+            # Missing values: a bit mask, and zeros in the column itself
+            spec.append((f'{name}:nan', 'bits', 0)); parts.append(np.packbits(nan).tobytes()); a = np.where(nan, 0.0, a)
+        if a.dtype == np.bool_: spec.append((name, 'bits', 0)); parts.append(np.packbits(a).tobytes())
+        elif a.dtype.kind == 'i': spec.append((name, 'int', 0)); parts.append(_zz_pack(a))
+        elif (dec := _scale_dec(a)) is not None:
+            spec.append((name, 'dec', dec)); parts.append(_zz_pack(np.round(a * 10.0 ** dec).astype(np.int64)))
+        else: spec.append((name, 'f8', 0)); parts.append(_shuffle(a.astype('<f8')))
+    head = json.dumps({'v': 1, 'n': len(cols['ts']), 'cols': spec}, separators=(',', ':')).encode()
+    return zlib.compress(struct.pack('<I', len(head)) + head + b''.join(parts), 9)
+def _archive_decode(blob: bytes) -> dict:
+    raw  = zlib.decompress(blob)
+    hlen = struct.unpack_from('<I', raw)[0]
+    head = json.loads(raw[4:4 + hlen]); n, pos, out = head['n'], 4 + hlen, {}
+    for name, enc, dec in head['cols']:
+        size = (n + 7) // 8 if enc == 'bits' else 8 * n
+        b = raw[pos:pos + size]; pos += size
+        if enc == 'bits':  out[name] = np.unpackbits(np.frombuffer(b, np.uint8), count=n).astype(bool)
+        elif enc == 'int': out[name] = _zz_unpack(b, n)
+        elif enc == 'dec': out[name] = _zz_unpack(b, n) / 10.0 ** dec
+        else:              out[name] = _unshuffle(b, n, '<f8')
+    for name in [k for k in out if k.endswith(':nan')]:
+        mask = out.pop(name); out[name[:-4]][mask] = np.nan
+    return out
+def _record_digest(h, key: str, rec: dict) -> None:
+    # Absent and null fields hash alike, as do a missing and a false offline flag
+    canon = {k: float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else v for k, v in rec.items() if v is not None}
+    canon['offline'] = bool(rec.get('offline'))
+    h.update(json.dumps([key, canon], sort_keys=True, separators=(',', ':')).encode())
+_ARCHIVE_KEYS = {'timestamp', 'offline', *_ARCHIVE_FIELDS, *_ARCHIVE_EXTRA}
+def _archivable(key: str, rec) -> bool:
+    num = lambda v: v is None or isinstance(v, (int, float)) and not isinstance(v, bool)
+    return (key[8:].isdigit() and isinstance(rec, dict) and rec.keys() <= _ARCHIVE_KEYS and _parse_ts(rec.get('timestamp')) is not None
+            and isinstance(rec.get('offline', False), bool) and all(num(rec.get(f)) for f in _ARCHIVE_FIELDS)
+            and all(rec.get(f) is None or type(rec[f]) is int for f in _ARCHIVE_EXTRA))
+def _archive_columns(records) -> tuple[dict, str, int, int]:
+    # Records the format cannot hold are left out (and in History) and counted as skipped
+    keys, disp, off, raw_bytes, skipped, h = [], [], [], 0, 0, hashlib.sha256()
+    vals = {f: [] for f in _ARCHIVE_FIELDS + _ARCHIVE_EXTRA}
+    for key, rec in records:
+        if not _archivable(key, rec): skipped += 1; continue
+        keys.append(int(key[8:])); disp.append(_parse_ts(rec['timestamp'])); off.append(bool(rec.get('offline')))
+        for f, v in vals.items(): v.append(np.nan if rec.get(f) is None else float(rec[f]))
+        _record_digest(h, key, rec); raw_bytes += len(key) + len(json.dumps(rec, separators=(',', ':')))
+    cols = {'ts': np.asarray(keys, np.int64), 'display_ms': np.asarray(disp, np.int64), 'offline': np.asarray(off, bool),
+            **{f: np.asarray(vals[f], np.float64) for f in _ARCHIVE_FIELDS}}
+    for f in _ARCHIVE_EXTRA:
+        v = np.asarray(vals[f], np.float64)
+        if not np.isnan(v).all(): cols[f] = v
+    return cols, h.hexdigest(), raw_bytes, skipped
+def _archive_records(cols: dict):
+    keys, disp, off = cols['ts'].tolist(), cols['display_ms'].tolist(), cols['offline'].tolist()
+    fields = [(f, cols[f].tolist()) for f in _ARCHIVE_FIELDS if f in cols]
+    extra  = [(f, cols[f].tolist()) for f in _ARCHIVE_EXTRA if f in cols]
+    for i, k in enumerate(keys):
+        rec = {'timestamp': _fmt_ts(disp[i]), 'offline': off[i]}
+        for f, v in fields:
+            if v[i] == v[i]: rec[f] = v[i]
+        for f, v in extra:
+            if v[i] == v[i]: rec[f] = int(v[i])
+        yield f'capture_{k}', rec
+def _archive_blob(node) -> bytes | None:
+    try:
+        if not isinstance(node, dict) or node.get('v') != 1: return None
+        chunks = node.get('chunks') or {}
+        blob = base64.b64decode(''.join(chunks[k] for k in sorted(chunks, key=lambda c: int(c[1:]))))
+        return blob if hashlib.sha256(blob).hexdigest() == node.get('sha256') else None
+    except Exception: return None
+def _archive_put(did: str, sid: str, ph: str, blob: bytes, records: int) -> bool:
+    path, b64 = f'devices/{did}/Archive/{sid}/{ph}', base64.b64encode(blob).decode()
+    node = {'v': 1, 'records': records, 'bytes': len(blob), 'sha256': hashlib.sha256(blob).hexdigest(),
+            'chunks': {f'c{i}': b64[o:o + ARCHIVE_CHUNK_BYTES] for i, o in enumerate(range(0, len(b64), ARCHIVE_CHUNK_BYTES))}}
+    try:
+        if not _fb_request('PUT', path, json=node, timeout=120).ok: return False
+        _fb_cache.invalidate([path])
+        r = _fb_request('GET', path, timeout=120)
+        return r.ok and _archive_blob(r.json()) == blob
+    except Exception: return False
+def _archive_read(did: str, sid: str, ph: str, meta: dict | None = None) -> dict | None:
+    # Decoded columns of an archived phase, or None (not archived / unreadable: use History)
+    if meta is not None and ph not in ((meta.get('archived') or {}).get('phases') or ()): return None
+    blob = _archive_blob(fb_get(f'devices/{did}/Archive/{sid}/{ph}'))
+    if blob is None: return None
+    cols = _archive_decode(blob)
+    cols['offset_ms'] = round((int(cols['display_ms'][0]) - int(cols['ts'][0])) / 1000) * 1000 if cols['ts'].size else 0
+    return cols
+def _iter_session_records(did: str, sid: str, ph: str, meta: dict | None = None, page: int = EXPORT_PAGE_SIZE):
+    cols = _archive_read(did, sid, ph, meta)
+    if cols is not None: yield from _archive_records(cols); return
+    yield from _iter_history_records(did, sid, ph, page)
+def _archive_shift(did: str, sid: str, ph: str, delta: int) -> int | None:
+    cols = _archive_read(did, sid, ph)
+    if cols is None or not cols['ts'].size: return None
+    cols.pop('offset_ms')
+    for f in ('display_ms',) + _ARCHIVE_EXTRA:
+        if f in cols: cols[f] = cols[f] + delta
+    if not _archive_put(did, sid, ph, _archive_encode(cols), int(cols['ts'].size)):
+        raise RuntimeError(f'Gagal memperbarui arsip {ph}')
+    return int(cols['display_ms'].max())
+def _archive_job(job: dict, delete_raw: bool) -> None:
+    did, sid = job['device_id'], job['session_id']
+    try:
+        job['state'] = 'running'
+        meta = _session_meta(did, sid)
+        if not meta: raise RuntimeError('Sesi tidak ditemukan')
+        if meta.get('endTime') in (None, '', '---'): raise RuntimeError('Sesi belum selesai')
+        info = dict(meta.get('archived') or {})
+        if not info.get('phases'):
+            info = {'at': _ts_now(), 'phases': [], 'records': 0, 'bytes': 0, 'raw_bytes': 0, 'skipped': 0, 'raw_deleted': False}
+            for ph in _session_phases(did, meta):
+                job['phase'] = ph
+                cols, digest, raw_bytes, skipped = _archive_columns(_iter_history_records(did, sid, ph))
+                info['skipped'] += skipped
+                if not cols['ts'].size: continue
+                blob = _archive_encode(cols); h = hashlib.sha256()
+                for key, rec in _archive_records(_archive_decode(blob)): _record_digest(h, key, rec)
+                if h.hexdigest() != digest: raise RuntimeError(f'Verifikasi arsip {ph} gagal')
+                if not _archive_put(did, sid, ph, blob, int(cols['ts'].size)): raise RuntimeError(f'Gagal menyimpan arsip {ph}')
+                info['phases'].append(ph); info['records'] += int(cols['ts'].size)
+                info['bytes'] += len(blob); info['raw_bytes'] += raw_bytes
+                job.update(records=info['records'], bytes=info['bytes'], raw_bytes=info['raw_bytes'], skipped=info['skipped'])
+            if not info['phases']: raise RuntimeError('Tidak ada record untuk diarsipkan')
+        if delete_raw and not info.get('raw_deleted'):
+            archived = {}
+            for ph in info['phases']:
+                cols = _archive_read(did, sid, ph)
+                if cols is None: raise RuntimeError(f'Arsip {ph} tidak terbaca, record asli tidak dihapus')
+                archived[ph] = cols['ts'].tolist()
+            for ph, keys in archived.items():
+                job['phase'] = ph; path = f'devices/{did}/History/{ph}/{sid}'
+                # Only keys the verified archive holds are removed; anything else stays in History
+                for i in range(0, len(keys), FB_WRITE_BATCH_MAX):
+                    _fb_request('PATCH', path, json={f'capture_{k}': None for k in keys[i:i + FB_WRITE_BATCH_MAX]},
+                                timeout=60).raise_for_status()
+                _fb_cache.invalidate([path])
+            info['raw_deleted'] = True
+        for ph in info['phases']: _fb_writes.put(f'devices/{did}/History/{ph}/{sid}/_meta/archived', info)
+        if fb_get_shallow(f'devices/{did}/Sessions/{sid}'): _fb_writes.put(f'devices/{did}/Sessions/{sid}/archived', info)
+        _fb_writes.flush(); _stats_invalidate(did, sid)
+        job.update(state='done', records=info['records'], bytes=info['bytes'], raw_bytes=info['raw_bytes'],
+                   skipped=info.get('skipped', 0), raw_deleted=info['raw_deleted'], ratio=_r(info['raw_bytes'] / info['bytes'], 1) if info['bytes'] else None)
+    except Exception as e:
+        job.update(state='error', error=str(e))
+    finally:
+        job['phase'] = None; job['finished_at'] = _ts_now()
+def _archive_submit(did: str, sid: str, delete_raw: bool) -> dict | None:
+    with _archive_lock:
+        j = _archive_jobs.get(sid)
+        if j and j['state'] in ('queued', 'running'): return None
+        if len(_archive_jobs) > 200:
+            for k in [k for k, v in _archive_jobs.items() if v['state'] in ('done', 'error')][:100]: _archive_jobs.pop(k)
+        job = _archive_jobs[sid] = {
+            'device_id': did, 'session_id': sid, 'state': 'queued', 'delete_raw': delete_raw, 'phase': None,
+            'records': 0, 'bytes': 0, 'raw_bytes': 0, 'skipped': 0, 'raw_deleted': False, 'ratio': None,
+            'started_at': _ts_now(), 'finished_at': None, 'error': None,
+        }
+    _scheduler.submit(_archive_job, job, delete_raw, key=f'archive:{sid}', bulk=True)
+    return job
+@app.route('/api/sessions/<device_id>/<session_id>/archive', methods=['POST'])
+@_via_leader
+def archive_session(device_id: str, session_id: str):
+    delete_raw = bool((request.get_json(silent=True) or {}).get('deleteRaw', ARCHIVE_DELETE_RAW))
     with _capture_lock:
-        if _capture_state['active'] and _capture_state['session_id'] == sid:
-            _capture_state['time_offset_ms'] = _capture_state.get('time_offset_ms', 0) + delta_ms
-            shift_epoch = time.time()
-            return jsonify({'ok': True, 'shift_epoch': shift_epoch})
-    return jsonify({'ok': False, 'error': 'Tidak ada capture aktif untuk sesi ini'})
+        if session_id in _capture_sessions: return jsonify({'ok': False, 'error': 'Sesi masih berjalan atau sedang finalisasi'}), 409
+    if (_shift_jobs.get(session_id) or {}).get('state') in ('queued', 'running'):
+        return jsonify({'ok': False, 'error': 'Perubahan waktu sesi ini sedang berjalan'}), 409
+    job = _archive_submit(device_id, session_id, delete_raw)
+    if job is None: return jsonify({'ok': False, 'error': 'Arsip sesi ini sedang dibuat'}), 409
+    return jsonify({'ok': True, **job}), 202
+@app.route('/api/sessions/<device_id>/<session_id>/archive')
+@_via_leader
+def archive_status(device_id: str, session_id: str):
+    job = _archive_jobs.get(session_id)
+    if job: return jsonify({'ok': True, **job})
+    meta = _session_meta(device_id, session_id)
+    if not meta: return jsonify({'ok': False, 'error': 'Sesi tidak ditemukan'}), 404
+    return jsonify({'ok': True, 'device_id': device_id, 'session_id': session_id, 'state': None, 'archived': meta.get('archived')})
+@app.route('/api/sessions/<device_id>/<session_id>/records')
+def session_records(device_id: str, session_id: str):
+    meta = _session_meta(device_id, session_id)
+    if not meta: return jsonify({'ok': False, 'error': 'Sesi tidak ditemukan'}), 404
+    phases = _session_phases(device_id, meta)
+    ph = (request.args.get('phase') or (phases[0] if phases else '')).upper()
+    if ph not in phases: return jsonify({'ok': False, 'error': f'Phase tidak valid: {ph}.'}), 400
+    fields = tuple(f for f in (request.args.get('fields') or '').split(',') if f in _ARCHIVE_FIELDS) or _ARCHIVE_FIELDS
+    try: cols = _load_columns(device_id, session_id, ph, meta, fields)
+    except Exception as e: return jsonify({'ok': False, 'error': f'Gagal membaca record: {e}'}), 500
+    out = {'ok': True, 'device_id': device_id, 'session_id': session_id, 'phase': ph,
+           'source': 'archive' if cols is not None and 'display_ms' in cols else 'history', 'count': 0, 't': [], 'offline': []}
+    if cols is None: return jsonify({**out, **{f: [] for f in fields}})
+    t   = cols['ts'] + cols['offset_ms']
+    sel = (t >= request.args.get('from', -2 ** 62, type=int)) & (t <= request.args.get('to', 2 ** 62, type=int))
+    out.update(count=int(sel.sum()), t=t[sel].tolist(), offline=cols['offline'][sel].astype(int).tolist())
+    for f in fields + tuple(f for f in _ARCHIVE_EXTRA if f in cols):
+        out[f] = [None if v != v else v for v in cols[f][sel].tolist()]
+    return jsonify(out)
+_leader_start()
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,212 @@
+# Local stand-in for the Firebase RTDB REST API, limited to what app.py uses:
+# GET (shallow, orderBy="$key" paging, ETag / If-None-Match -> 304), PUT,
+# PATCH (multi-path), DELETE and text/event-stream subscriptions.
+# Latency and failures can be injected; a device simulator writes RealTime.
+#
+#   python bench/rtdb_emulator.py --port 9000 --devices 10 --phases 3 --latency 0.02
+#   FIREBASE_DATABASE_URL=http://127.0.0.1:9000 python app.py
+#
+# GET /.emulator/stats returns request counters, POST /.emulator/reset clears them.
+from __future__ import annotations
+import argparse, hashlib, json, random, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+def _split(path: str) -> list:
+    return [p for p in path.split('/') if p]
+def _set(node, parts: list, value):
+    if not parts: return value
+    node = dict(node) if isinstance(node, dict) else {}
+    child = _set(node.get(parts[0]), parts[1:], value)
+    if child is None: node.pop(parts[0], None)
+    else: node[parts[0]] = child
+    return node or None
+def _overlaps(a: list, b: list) -> bool:
+    n = min(len(a), len(b))
+    return a[:n] == b[:n]
+
+class RTDBEmulator:
+    def __init__(self, port: int = 0, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 timeout_rate: float = 0.0, host: str = '127.0.0.1'):
+        self.latency, self.jitter, self.error_rate, self.timeout_rate = latency, jitter, error_rate, timeout_rate
+        self.tree    = {}
+        self.version = 0
+        self.cond    = threading.Condition()
+        self.changes = []          # (version, path parts) of recent writes, for stream fan-out
+        self.stats   = {}
+        self._stats_lock = threading.Lock()
+        self.started = time.time()
+        self.server  = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.port    = self.server.server_address[1]
+        self.url     = f'http://{host}:{self.port}'
+    def start(self) -> 'RTDBEmulator':
+        threading.Thread(target=self.server.serve_forever, daemon=True).start(); return self
+    def stop(self) -> None: self.server.shutdown()
+    def get(self, path: str):
+        node = self.tree
+        for p in _split(path):
+            if not isinstance(node, dict) or p not in node: return None
+            node = node[p]
+        return node
+    def write(self, updates: dict) -> None:
+        with self.cond:
+            for path, value in updates.items():
+                self.tree = _set(self.tree, _split(path), value) or {}
+                self.version += 1
+                self.changes.append((self.version, _split(path)))
+            del self.changes[:-1000]
+            self.cond.notify_all()
+    def count(self, key: str) -> None:
+        with self._stats_lock: self.stats[key] = self.stats.get(key, 0) + 1
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            return {'requests': dict(self.stats), 'total': sum(self.stats.values()), 'since': self.started, 'now': time.time()}
+    def reset(self) -> None:
+        with self._stats_lock: self.stats = {}; self.started = time.time()
+
+    def _handler(self):
+        emu = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def log_message(self, *a): pass
+            def _parse(self):
+                u = urlparse(self.path); path = u.path
+                if path.endswith('.json'): path = path[:-5]
+                return path.strip('/'), {k: v[0] for k, v in parse_qs(u.query).items()}
+            def _send(self, code: int, body=None, headers: dict | None = None):
+                data = b'' if code == 304 else json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for k, v in (headers or {}).items(): self.send_header(k, v)
+                self.end_headers()
+                if data: self.wfile.write(data)
+            def _body(self):
+                n = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(n) or b'null')
+            def _inject(self, method: str) -> bool:
+                emu.count(method)
+                if emu.latency or emu.jitter: time.sleep(max(0.0, emu.latency + random.uniform(-emu.jitter, emu.jitter)))
+                if emu.timeout_rate and random.random() < emu.timeout_rate:
+                    emu.count('injected_timeout'); time.sleep(30); return True
+                if emu.error_rate and random.random() < emu.error_rate:
+                    emu.count('injected_error'); self._send(503, {'error': 'injected'}); return True
+                return False
+            def do_GET(self):
+                path, q = self._parse()
+                if path == '.emulator/stats': return self._send(200, emu.snapshot())
+                if 'text/event-stream' in (self.headers.get('Accept') or ''): return self._stream(path)
+                if self._inject('GET'): return
+                with emu.cond: v = emu.get(path)
+                if q.get('orderBy') == '"$key"' and isinstance(v, dict):
+                    keys = sorted(v)
+                    if 'startAt' in q: keys = [k for k in keys if k >= json.loads(q['startAt'])]
+                    if 'endAt' in q:   keys = [k for k in keys if k <= json.loads(q['endAt'])]
+                    if 'limitToFirst' in q: keys = keys[:int(q['limitToFirst'])]
+                    if 'limitToLast' in q:  keys = keys[-int(q['limitToLast']):]
+                    v = {k: v[k] for k in keys}
+                if q.get('shallow') == 'true' and isinstance(v, dict): v = {k: True for k in v}
+                etag = hashlib.md5(json.dumps(v, sort_keys=True).encode()).hexdigest()
+                if self.headers.get('If-None-Match') == etag:
+                    emu.count('GET_304'); return self._send(304, headers={'ETag': etag})
+                self._send(200, v, {'ETag': etag})
+            def do_PUT(self):
+                path, _ = self._parse(); body = self._body()
+                if self._inject('PUT'): return
+                emu.write({path: body}); self._send(200, body)
+            def do_PATCH(self):
+                path, _ = self._parse(); body = self._body()
+                if self._inject('PATCH'): return
+                if not isinstance(body, dict): return self._send(400, {'error': 'Invalid data; couldn\'t parse JSON object.'})
+                keys = [_split(f'{path}/{k}') for k in body]
+                if any(a != b and _overlaps(a, b) for i, a in enumerate(keys) for b in keys[i + 1:]):
+                    return self._send(400, {'error': 'Invalid data; ancestor paths overlap'})
+                emu.write({f'{path}/{k}': v for k, v in body.items()}); self._send(200, body)
+            def do_POST(self):
+                path, _ = self._parse()
+                if path == '.emulator/reset': emu.reset(); return self._send(200, {'ok': True})
+                self._send(404, {'error': 'not supported'})
+            def do_DELETE(self):
+                path, _ = self._parse()
+                if self._inject('DELETE'): return
+                emu.write({path: None}); self._send(200, None)
+            def _stream(self, path: str):
+                emu.count('STREAM')
+                parts = _split(path)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                def event(name: str, data) -> None:
+                    b = f'event: {name}\ndata: {json.dumps(data)}\n\n'.encode()
+                    self.wfile.write(b'%x\r\n' % len(b) + b + b'\r\n'); self.wfile.flush()
+                try:
+                    with emu.cond: seen = emu.version; snap = emu.get(path)
+                    event('put', {'path': '/', 'data': snap})
+                    while True:
+                        with emu.cond:
+                            emu.cond.wait(15)
+                            # Change log trimmed past what this stream saw: resend to be safe
+                            hit = bool(emu.changes) and emu.changes[0][0] > seen + 1 or \
+                                  any(v > seen and _overlaps(parts, p) for v, p in emu.changes)
+                            seen = emu.version; snap = emu.get(path) if hit else None
+                        if hit: event('put', {'path': '/', 'data': snap})
+                        else: event('keep-alive', None)
+                except Exception: return
+        return Handler
+
+def realtime_payload(phases: int, i: int, rnd: random.Random) -> dict:
+    out = {}
+    for p in range(1, phases + 1):
+        v, a = 220 + rnd.uniform(-3, 3), max(0.0, 2 + rnd.uniform(-1, 1))
+        out[f'L{p}'] = {
+            'Voltage (V)': round(v, 2), 'Current (A)': round(a, 3), 'Power (W)': round(v * a * 0.9, 2),
+            'Frequency (Hz)': round(50 + rnd.uniform(-0.05, 0.05), 2), 'Power Factor': 0.9,
+            'Apparent Power (kVA)': round(v * a / 1000, 4), 'Reactive Power (kVAR)': round(v * a * 0.43 / 1000, 4),
+            'Phase Angle (°)': 25.84, 'Active Energy (kWh)': round(i * 0.001, 4),
+            'Apparent Energy (kVAh)': round(i * 0.0011, 4), 'Reactive Energy (kVARh)': round(i * 0.0005, 4),
+        }
+    return out
+
+class DeviceSimulator:
+    # N devices x M phases; each device rewrites its RealTime node every `period` seconds
+    def __init__(self, emu: RTDBEmulator, devices: int, phases: int, period: float = 1.0, seed: int = 1):
+        self.emu, self.devices, self.phases, self.period = emu, devices, phases, period
+        self.rnd  = random.Random(seed)
+        self._stop = threading.Event()
+        emu.write({f'devices/dev{d:04d}/meta': {
+            'name': f'Device {d}', 'online': True, 'lastSeen': '---',
+            'sensors': {f'L{p}': {'name': f'Phase {p}', 'phase': f'L{p}', 'properties': [], 'enabled': True} for p in range(1, phases + 1)},
+        } for d in range(devices)})
+        self._tick(0)
+    def _tick(self, i: int) -> None:
+        self.emu.write({f'devices/dev{d:04d}/RealTime': realtime_payload(self.phases, i, self.rnd) for d in range(self.devices)})
+    def start(self) -> 'DeviceSimulator':
+        def run():
+            i, nxt = 0, time.monotonic()
+            while not self._stop.is_set():
+                nxt += self.period; i += 1
+                self._stop.wait(max(0.0, nxt - time.monotonic()))
+                self._tick(i)
+        threading.Thread(target=run, daemon=True).start(); return self
+    def stop(self) -> None: self._stop.set()
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Local Firebase RTDB REST stand-in')
+    ap.add_argument('--port', type=int, default=9000)
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--devices', type=int, default=0, help='simulated devices writing RealTime')
+    ap.add_argument('--phases', type=int, default=3)
+    ap.add_argument('--period', type=float, default=1.0, help='seconds between RealTime updates')
+    ap.add_argument('--latency', type=float, default=0.0, help='added seconds per request')
+    ap.add_argument('--jitter', type=float, default=0.0)
+    ap.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered 503')
+    ap.add_argument('--timeout-rate', type=float, default=0.0, help='fraction of requests stalled 30 s')
+    a = ap.parse_args()
+    emu = RTDBEmulator(a.port, a.latency, a.jitter, a.error_rate, a.timeout_rate, a.host).start()
+    if a.devices: DeviceSimulator(emu, a.devices, a.phases, a.period).start()
+    print(f'RTDB emulator on {emu.url} ({a.devices} devices x {a.phases} phases)', flush=True)
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt: pass
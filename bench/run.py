@@ -0,0 +1,157 @@
+# Load benchmark: starts bench/rtdb_emulator.py in a subprocess with N devices
+# x M phases, points app.py at it and runs the real workers for --duration
+# seconds while capture sessions record and API clients poll. Each run is
+# appended to bench/results.jsonl and compared with the previous run that used
+# the same parameters, so regressions show up between versions.
+#
+#   python bench/run.py --devices 50 --phases 3 --duration 60 --captures 5
+from __future__ import annotations
+import argparse, json, os, socket, statistics, subprocess, sys, tempfile, threading, time
+from datetime import datetime, timezone
+from urllib.request import Request, urlopen
+
+HERE    = os.path.dirname(os.path.abspath(__file__))
+ROOT    = os.path.dirname(HERE)
+RESULTS = os.path.join(HERE, 'results.jsonl')
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0)); return s.getsockname()[1]
+def _emu_call(url: str, path: str, method: str = 'GET') -> dict:
+    with urlopen(Request(f'{url}/{path}', method=method, data=b'' if method == 'POST' else None), timeout=10) as r:
+        return json.loads(r.read())
+def _pct(values: list, q: float):
+    if not values: return None
+    v = sorted(values)
+    return round(v[min(len(v) - 1, int(q * len(v)))], 6)
+def _summary(values: list) -> dict:
+    if not values: return {'n': 0}
+    return {'n': len(values), 'mean': round(statistics.fmean(values), 6), 'p50': _pct(values, 0.5),
+            'p95': _pct(values, 0.95), 'p99': _pct(values, 0.99), 'max': round(max(values), 6),
+            'stdev': round(statistics.pstdev(values), 6)}
+def _rss_kb() -> dict:
+    out = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')): out[line.split(':')[0]] = int(line.split()[1])
+    except OSError: pass
+    return {'rss_kb': out.get('VmRSS'), 'peak_rss_kb': out.get('VmHWM')}
+def _git_rev() -> str | None:
+    try: return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception: return None
+def _record(samples: list, hist) -> None:
+    orig = hist.observe
+    def observe(value, *lv):
+        samples.append(value); orig(value, *lv)
+    hist.observe = observe
+
+def run(a) -> dict:
+    port = a.port or _free_port()
+    emu_cmd = [sys.executable, os.path.join(HERE, 'rtdb_emulator.py'), '--port', str(port), '--devices', str(a.devices),
+               '--phases', str(a.phases), '--period', str(a.period), '--latency', str(a.latency), '--jitter', str(a.jitter),
+               '--error-rate', str(a.error_rate)]
+    emu = subprocess.Popen(emu_cmd, stdout=subprocess.PIPE, text=True)
+    emu.stdout.readline()
+    url = f'http://127.0.0.1:{port}'
+    tmp = tempfile.mkdtemp(prefix='bench-')
+    os.environ.update({'FIREBASE_DATABASE_URL': url, 'INGEST_MODE': a.ingest,
+                       'SERIES_DB_PATH': os.path.join(tmp, 'series.db') if a.series else ''})
+    sys.path.insert(0, ROOT)
+    try:
+        import app as sem
+        live, drift, api = [], [], {'devices': [], 'live_buffer': []}
+        _record(live, sem._m_live_cycle); _record(drift, sem._m_cap_drift)
+        client = sem.app.test_client()
+        time.sleep(a.warmup)
+        dids = [f'dev{d:04d}' for d in range(a.devices)]
+        for did in dids[:a.captures]:
+            client.post('/api/capture/start', json={'deviceId': did, 'interval': a.interval,
+                                                    'phases': [f'L{p}' for p in range(1, a.phases + 1)]})
+        live.clear(); drift.clear()
+        _emu_call(url, '.emulator/reset', 'POST')
+        stop = threading.Event()
+        def poll_api():
+            i, etag = 0, None
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                r = client.get('/api/devices', headers={'If-None-Match': etag} if etag else {})
+                api['devices'].append(time.perf_counter() - t0); etag = r.headers.get('ETag') or etag
+                t0 = time.perf_counter()
+                client.get(f'/api/live-buffer/{dids[i % len(dids)]}?seconds=300')
+                api['live_buffer'].append(time.perf_counter() - t0)
+                i += 1; stop.wait(a.api_period)
+        clients = [threading.Thread(target=poll_api, daemon=True) for _ in range(a.clients)]
+        for t in clients: t.start()
+        t_start = time.time()
+        time.sleep(a.duration)
+        stop.set()
+        for t in clients: t.join(5)
+        elapsed = time.time() - t_start
+        reqs = _emu_call(url, '.emulator/stats')['requests']
+        with sem._capture_lock:
+            caps = [(s['count'], s['_expected']) for s in sem._capture_sessions.values()]
+        return {
+            'live_cycle_s':        _summary(live),
+            'live_cycle_overruns': sum(1 for v in live if v > sem.LIVE_CYCLE_BUDGET),
+            'capture_drift_s':     _summary(drift),
+            'capture_written':     sum(w for w, _ in caps),
+            'capture_expected':    sum(e for _, e in caps),
+            'api_devices_s':       _summary(api['devices']),
+            'api_live_buffer_s':   _summary(api['live_buffer']),
+            'requests_per_min':    {k: round(v * 60 / elapsed, 1) for k, v in sorted(reqs.items())},
+            'requests_per_min_total': round(sum(v for k, v in reqs.items() if k in ('GET', 'PUT', 'PATCH', 'DELETE')) * 60 / elapsed, 1),
+            'threads':             threading.active_count(),
+            'live_buffer_bytes':   sum(b.nbytes() for b in list(sem._device_live_buffer.values())),
+            **_rss_kb(),
+        }
+    finally:
+        emu.terminate()
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description='Smart Energy Meter load benchmark')
+    ap.add_argument('--devices', type=int, default=20)
+    ap.add_argument('--phases', type=int, default=3)
+    ap.add_argument('--period', type=float, default=1.0, help='device RealTime update period (s)')
+    ap.add_argument('--duration', type=float, default=60)
+    ap.add_argument('--warmup', type=float, default=5)
+    ap.add_argument('--captures', type=int, default=2, help='concurrent capture sessions')
+    ap.add_argument('--interval', type=float, default=1, help='capture interval (s); below 1 uses the high-rate mode')
+    ap.add_argument('--clients', type=int, default=2, help='simulated dashboard tabs polling the API')
+    ap.add_argument('--api-period', type=float, default=0.5)
+    ap.add_argument('--ingest', choices=('poll', 'stream'), default='poll')
+    ap.add_argument('--series', action='store_true', help='enable the local series store')
+    ap.add_argument('--latency', type=float, default=0.0)
+    ap.add_argument('--jitter', type=float, default=0.0)
+    ap.add_argument('--error-rate', type=float, default=0.0)
+    ap.add_argument('--port', type=int, default=0)
+    ap.add_argument('--label', default='')
+    ap.add_argument('--no-save', action='store_true')
+    a = ap.parse_args()
+    params = {k: getattr(a, k) for k in ('devices', 'phases', 'period', 'duration', 'captures', 'interval', 'clients',
+                                         'api_period', 'ingest', 'series', 'latency', 'jitter', 'error_rate')}
+    res = run(a)
+    entry = {'at': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'commit': _git_rev(), 'label': a.label,
+             'params': params, 'results': res}
+    prev = None
+    if os.path.exists(RESULTS):
+        with open(RESULTS) as f:
+            for line in f:
+                try: e = json.loads(line)
+                except ValueError: continue
+                if e.get('params') == params: prev = e
+    print(json.dumps(entry, indent=2))
+    if prev:
+        print(f"\nvs {prev.get('commit')} ({prev.get('at')}):")
+        for key, sub in (('live_cycle_s', 'p95'), ('capture_drift_s', 'p95'), ('api_devices_s', 'p95'),
+                         ('api_live_buffer_s', 'p95'), ('requests_per_min_total', None), ('peak_rss_kb', None)):
+            old = prev['results'].get(key); new = res.get(key)
+            if sub: old, new = (old or {}).get(sub), (new or {}).get(sub)
+            if old and new is not None:
+                print(f"  {key}{'.' + sub if sub else ''}: {old} -> {new} ({(new - old) / old * 100:+.1f}%)")
+    if not a.no_save:
+        with open(RESULTS, 'a') as f: f.write(json.dumps(entry) + '\n')
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -1959,7 +1959,8 @@ function _attachHistoryListener(deviceId) {
     if (window._currentHistoryRef) window._currentHistoryRef.off();
     window._currentHistoryRef = database.ref(`devices/${deviceId}/Sessions`);
     window._currentHistoryRef.on('value', snap => {
-        historyData = []; recordsBySession = {}; sessionsData = {};
+        const prevMeta = sessionsData;
+        historyData = []; sessionsData = {};
         if (snap.exists()) {
             snap.forEach(sessionSnap => {
                 const sid = sessionSnap.key;
@@ -1970,6 +1971,10 @@ function _attachHistoryListener(deviceId) {
                 }
             });
         }
+        // Records loaded from /records stay until their session changes
+        Object.keys(recordsBySession).forEach(sid => {
+            if (!sessionsData[sid] || _sessionMetaKey(sessionsData[sid]) !== _sessionMetaKey(prevMeta[sid])) delete recordsBySession[sid];
+        });
         buildSessionUI();
     });
 }
@@ -2020,6 +2025,49 @@ function parseTimestamp(ts) {
         return new Date(y, mo - 1, d, h, m, s);
     } catch (_) { return new Date(); }
 }
+function _fmtWib(ms) {
+    const d = new Date(ms + 7 * 3600e3), p = n => String(n).padStart(2, '0');
+    return `${p(d.getUTCHours())}:${p(d.getUTCMinutes())}:${p(d.getUTCSeconds())} ${p(d.getUTCDate())}/${p(d.getUTCMonth() + 1)}/${d.getUTCFullYear()}`;
+}
+function _sessionMetaKey(meta) {
+    return meta ? JSON.stringify([meta.recordCount, meta.startTime, meta.endTime, meta.archived || null]) : '';
+}
+function _sessionPhaseKeys(sessionId) {
+    const s = sessionsData[sessionId] || {};
+    return Array.from(new Set([...Object.keys(recordsBySession[sessionId] || {}), ...Object.keys(s.phaseNames || {}), ...(s.archived?.phases || [])]))
+        .filter(k => /^L\d+$/.test(k))
+        .sort((a, b) => parseInt(a.slice(1)) - parseInt(b.slice(1)));
+}
+function _sessionPhaseCount(sessionId, phase) {
+    const loaded = recordsBySession[sessionId]?.[phase];
+    if (loaded) return loaded.length;
+    const s = sessionsData[sessionId] || {};
+    // Archived sessions may no longer have raw History nodes; their _meta keeps the totals
+    if (s.archived?.phases?.length) return s.archived.phases.includes(phase) ? Math.round(s.archived.records / s.archived.phases.length) : 0;
+    return s.recordCount || 0;
+}
+function _sessionRecordCount(sessionId) {
+    return _sessionPhaseKeys(sessionId).reduce((n, ph) => n + _sessionPhaseCount(sessionId, ph), 0);
+}
+const _phaseLoads = {};
+async function _loadPhaseRecords(sessionId, phase) {
+    // Records come from the server, which reads the session archive or raw History
+    const key = `${sessionId}_${phase}`;
+    if (_phaseLoads[key] && (_phaseLoads[key].pending || Date.now() - _phaseLoads[key].at < 5000)) return;
+    _phaseLoads[key] = { pending: true, at: Date.now() };
+    try {
+        const deviceId = sessionsData[sessionId]?.deviceId || selectedDeviceId;
+        const fields = ['Voltage', 'Current', 'Power', 'Frequency', 'Energy', 'PowerFactor'];
+        const res = await fetch(`/api/sessions/${encodeURIComponent(deviceId)}/${encodeURIComponent(sessionId)}/records?phase=${phase}&fields=${fields.join(',')}`).then(r => r.json());
+        if (!res.ok || !sessionsData[sessionId]) return;
+        (recordsBySession[sessionId] ||= {})[phase] = res.t.map((t, i) => {
+            const rec = { timestamp: _fmtWib(t), offline: !!res.offline[i], sessionId };
+            fields.forEach(f => { rec[f] = res[f][i]; });
+            return rec;
+        });
+        buildSessionUI();
+    } catch (_) { } finally { _phaseLoads[key].pending = false; _phaseLoads[key].at = Date.now(); }
+}
 function _escapeAttr(s) { return (s || '').replace(/'/g, "\\'"); }
 function _highlight(text) {
     if (!dbSearchQuery) return text;
@@ -2053,21 +2101,13 @@ function buildSessionUI() {
     });
     tbody.innerHTML = filtered.map(session => {
         const frozenNames = session.phaseNames || {};
-        const recordedPhaseKeys = Object.keys(recordsBySession[session.id] || {})
-            .filter(k => /^L\d+$/.test(k))
-            .sort((a, b) => parseInt(a.slice(1)) - parseInt(b.slice(1)));
-        const phaseSourceKeys = recordedPhaseKeys.length > 0
-            ? recordedPhaseKeys
-            : Object.keys(frozenNames)
-                .filter(k => /^L\d+$/.test(k))
-                .sort((a, b) => parseInt(a.slice(1)) - parseInt(b.slice(1)));
+        const phaseSourceKeys = _sessionPhaseKeys(session.id);
         const dev2 = _deviceListCache.find(d => d.id === selectedDeviceId);
         const phases = phaseSourceKeys.map(ph => {
             const cachedName = dev2?.phases?.find(p => p.phase === ph)?.name;
             return { phase: ph, name: frozenNames[ph] || cachedName || ph };
         });
-        const allPhaseRecords = Object.values(recordsBySession[session.id] || {}).flat();
-        const isActive = session.id === currentSessionId && captureActive;
+        const isActive = _liveSessionIds.has(session.id) || (session.id === currentSessionId && captureActive);
         let actionBtns = `
             <button class="session-rename-btn" onclick="openChangeTimeModal('${session.id}','${session.startTime}','${_escapeAttr(session.name)}',event)" title="Ubah Waktu" style="color:var(--text-secondary)">
                 <svg viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2"><circle cx="12" cy="12" r="10"></circle><polyline points="12 6 12 12 16 14"></polyline></svg>
@@ -2089,7 +2129,7 @@ function buildSessionUI() {
                     <span id="chevron_${session.id}_${p.phase}" style="font-size:11px;color:var(--text-tertiary)">▶</span>
                     <span style="display:inline-flex;width:26px;height:26px;background:var(--blue);color:white;border-radius:6px;align-items:center;justify-content:center;font-weight:700;font-size:11px">${p.phase}</span>
                     <span id="sph-label_${session.id}_${p.phase}" style="flex:1;font-size:13px;font-weight:600;color:var(--text-primary)">${p.name}</span>
-                    <span style="font-size:11px;color:var(--text-tertiary)">${(recordsBySession[session.id]?.[p.phase] || []).length} record</span>
+                    <span style="font-size:11px;color:var(--text-tertiary)">${_sessionPhaseCount(session.id, p.phase)} record</span>
                     ${!isActive ? `<button class="sph-edit-btn" title="Ubah nama fase"
                         onclick="event.stopPropagation();startRenameSessionPhase('${session.id}','${p.phase}')"
                         style="display:flex;align-items:center;justify-content:center;width:26px;height:26px;border-radius:6px;border:1.5px solid transparent;background:transparent;color:var(--text-tertiary);cursor:pointer;flex-shrink:0;opacity:0;transition:opacity .15s ease,background .15s ease,border-color .15s ease;">
@@ -2116,7 +2156,8 @@ function buildSessionUI() {
                 </div>
                 <div id="phase-detail_${session.id}_${p.phase}" style="display:none">
                     ${(() => {
-                const pr = (recordsBySession[session.id]?.[p.phase] || []).slice().sort((a, b) => parseTimestamp(b.timestamp) - parseTimestamp(a.timestamp));
+                const loaded = recordsBySession[session.id]?.[p.phase];
+                const pr = (loaded || []).slice().sort((a, b) => parseTimestamp(b.timestamp) - parseTimestamp(a.timestamp));
                 return `<table class="data-table inner-table" style="width:100%;margin:0;border-radius:0">
                         <thead><tr><th>Timestamp</th><th>Voltage (V)</th><th>Current (A)</th><th>Power (W)</th><th>Frequency (Hz)</th><th>Energy (kWh)</th><th>PF</th></tr></thead>
                         <tbody>${pr.length ? pr.map(e => {
@@ -2131,7 +2172,7 @@ function buildSessionUI() {
                         + '<td>' + (e.Energy != null ? e.Energy.toFixed(3) : '---') + '</td>'
                         + '<td style="color:' + pfColor + '">' + (e.PowerFactor != null ? e.PowerFactor.toFixed(3) : '---') + '</td>'
                         + '</tr>';
-                }).join('') : '<tr><td colspan="7" class="loading-cell" style="padding:20px !important">Tampilan riwayat (History) dimatikan untuk perlindungan limit kuota.</td></tr>'}</tbody>
+                }).join('') : `<tr><td colspan="7" class="loading-cell" style="padding:20px !important">${loaded ? 'Tidak ada record.' : 'Memuat record...'}</td></tr>`}</tbody>
                         </table>`;
             })()}
                 </div>
@@ -2151,7 +2192,7 @@ function buildSessionUI() {
             <td>${isActive ? '<span style="color:#00A651;font-weight:700">Sedang berlangsung...</span>' : (session.endTime || '---')}</td>
             <td style="text-align:right;padding-right:16px">
                 <div class="session-actions">
-                    <span class="record-count-badge">${allPhaseRecords.length} record</span>
+                    <span class="record-count-badge">${_sessionRecordCount(session.id)} record</span>
                     ${actionBtns}
                 </div>
             </td>
@@ -2173,6 +2214,8 @@ function buildSessionUI() {
         const detail = $(`phase-detail_${key}`), chevron = $(`chevron_${key}`);
         if (detail) detail.style.display = 'block';
         if (chevron) chevron.textContent = '\u25BC';
+        const [sid, ph] = [key.slice(0, key.lastIndexOf('_')), key.slice(key.lastIndexOf('_') + 1)];
+        if (sessionsData[sid] && !recordsBySession[sid]?.[ph]) _loadPhaseRecords(sid, ph);
     });
     editingPhases.forEach((inputValue, key) => {
         const viewEl = document.getElementById('sph-view_' + key);
@@ -2202,6 +2245,7 @@ function togglePhaseDetails(sessionId, phase) {
     const isOpen = detail.style.display !== 'none';
     detail.style.display = isOpen ? 'none' : 'block';
     if (chevron) chevron.textContent = isOpen ? '▶' : '▼';
+    if (!isOpen && !recordsBySession[sessionId]?.[phase]) _loadPhaseRecords(sessionId, phase);
 }
 (function _injectSphHoverStyle() {
     if (document.getElementById('sph-hover-style')) return;
@@ -2262,8 +2306,7 @@ async function saveRenameSessionPhase(sessionId, phase) {
         sessionsData[sessionId].phaseNames[phase] = newName;
     }
     try {
-        const phaseKeys = Object.keys(recordsBySession[sessionId] || {})
-            .filter(k => /^L\d+$/.test(k));
+        const phaseKeys = _sessionPhaseKeys(sessionId);
         if (!phaseKeys.length) {
             await showModal('Error', 'Tidak ada data phase untuk diperbarui.', 'error');
             return;
@@ -2290,73 +2333,23 @@ function getDevicePhasesWithNames() {
     if (!dev?.phases?.length) return [];
     return dev.phases.filter(p => p.enabled !== false).map(p => ({ phase: p.phase, name: p.name }));
 }
-const COL_WIDTHS = [
-    { wch: 20 }, { wch: 20 }, { wch: 20 }, { wch: 10 }, { wch: 13 }, { wch: 13 }, { wch: 13 },
-    { wch: 20 }, { wch: 20 }, { wch: 14 }, { wch: 16 }, { wch: 14 }, { wch: 20 }, { wch: 22 }, { wch: 22 },
-];
-function _buildExcelRow(entry, deviceName) {
-    const row = {};
-    row['Device Name'] = deviceName;
-    row['Timestamp'] = entry.timestamp ?? '';
-    row['Status'] = entry.offline ? 'OFFLINE' : 'online';
-    row['Voltage (V)'] = entry.Voltage != null ? +entry.Voltage.toFixed(2) : '';
-    row['Current (A)'] = entry.Current != null ? +entry.Current.toFixed(2) : '';
-    row['Power (W)'] = entry.Power != null ? +entry.Power.toFixed(2) : '';
-    row['Apparent Power (kVA)'] = entry.Apparent != null ? +entry.Apparent.toFixed(4) : '';
-    row['Reactive Power (kVAR)'] = entry.Reactive != null ? +entry.Reactive.toFixed(4) : '';
-    row['Power Factor'] = entry.PowerFactor != null ? +entry.PowerFactor.toFixed(4) : '';
-    row['Phase Angle (°)'] = entry.Phase1 != null ? +entry.Phase1.toFixed(3) : '';
-    row['Frequency (Hz)'] = entry.Frequency != null ? +entry.Frequency.toFixed(1) : '';
-    row['Active Energy (kWh)'] = entry.Energy != null ? +entry.Energy.toFixed(4) : '';
-    row['Apparent Energy (kVAh)'] = entry.EnergyApparent != null ? +entry.EnergyApparent.toFixed(4) : '';
-    row['Reactive Energy (kVARh)'] = entry.EnergyReactive != null ? +entry.EnergyReactive.toFixed(4) : '';
-    return row;
-}
 async function exportSession(sessionId, sessionName, event) {
     event.stopPropagation();
-    const phaseData = recordsBySession[sessionId] || {};
-    const phaseKeys = Object.keys(phaseData).filter(k => /^L\d+$/.test(k)).sort((a, b) => parseInt(a.slice(1)) - parseInt(b.slice(1)));
-    const totalRecords = phaseKeys.reduce((s, ph) => s + (phaseData[ph]?.length || 0), 0);
+    const phaseKeys = _sessionPhaseKeys(sessionId);
+    const totalRecords = _sessionRecordCount(sessionId);
     if (!phaseKeys.length || totalRecords === 0) { await showModal('Tidak Ada Data', `Sesi "${sessionName}" belum memiliki record.`, 'warning'); return; }
     const confirmed = await showModal('Export Sesi',
         `Ekspor ${totalRecords} record (${phaseKeys.length} phase) dari sesi:\n"${sessionName}"\n\nData Firebase TIDAK dihapus. Lanjutkan?`, 'info', ['confirm']);
     if (!confirmed) return;
     try {
         const session = sessionsData[sessionId];
-        const deviceName = session?.deviceName || _deviceListCache.find(d => d.id === (session?.deviceId || selectedDeviceId))?.name || selectedDeviceId;
-        const wb = XLSX.utils.book_new();
-        const frozenNames = session.phaseNames || {};
-        for (const phase of phaseKeys) {
-            const phaseRecs = (phaseData[phase] || []).slice().sort((a, b) => parseTimestamp(a.timestamp) - parseTimestamp(b.timestamp));
-            const phaseDevName = frozenNames[phase] || phase;
-            const ws = XLSX.utils.json_to_sheet(phaseRecs.map(e => _buildExcelRow(e, deviceName)));
-            ws['!cols'] = COL_WIDTHS;
-            XLSX.utils.book_append_sheet(wb, ws, phaseDevName);
-        }
-        const allRecords = Object.values(phaseData).flat();
-        const onlineRows = allRecords.filter(e => !e.offline);
-        const avg = f => onlineRows.length ? onlineRows.reduce((s, e) => s + (e[f] || 0), 0) / onlineRows.length : 0;
-        const sum = f => onlineRows.reduce((s, e) => s + (e[f] || 0), 0);
-        const wsMeta = XLSX.utils.aoa_to_sheet([
-            ['Smart Energy Monitor - Session Export'], [''],
-            ['Nama Sesi', sessionName], ['Export Date', new Date().toLocaleString('id-ID')],
-            ['Device Name', deviceName], ['Phases', phaseKeys.join(', ')],
-            ['Waktu Mulai', session?.startTime || '---'], ['Waktu Selesai', session?.endTime || 'Berlangsung'],
-            ['Total Records', totalRecords], ['Records Online', onlineRows.length], ['Records Offline', allRecords.length - onlineRows.length], [''],
-            ['Summary Statistics (semua phase, online saja)'], [''],
-            ['Parameter', 'Rata-rata', 'Satuan'],
-            ['Voltage', avg('Voltage').toFixed(2), 'V'], ['Current', avg('Current').toFixed(2), 'A'],
-            ['Power', avg('Power').toFixed(2), 'W'], ['Apparent Power', avg('Apparent').toFixed(4), 'kVA'],
-            ['Reactive Power', avg('Reactive').toFixed(4), 'kVAR'], ['Power Factor', avg('PowerFactor').toFixed(4), ''],
-            ['Phase Angle', avg('Phase1').toFixed(3), '°'], ['Frequency', avg('Frequency').toFixed(1), 'Hz'],
-            ['Total Active Energy', sum('Energy').toFixed(4), 'kWh'],
-            ['Total Apparent Energy', sum('EnergyApparent').toFixed(4), 'kVAh'],
-            ['Total Reactive Energy', sum('EnergyReactive').toFixed(4), 'kVARh'],
-        ]);
-        wsMeta['!cols'] = [{ wch: 28 }, { wch: 28 }, { wch: 10 }];
-        XLSX.utils.book_append_sheet(wb, wsMeta, 'Summary');
-        XLSX.writeFile(wb, `${sessionName.replace(/[\\/:*?"<>|]/g, '_')}.xlsx`);
-        await showModal('Export Berhasil!', `${totalRecords} record dari "${sessionName}" berhasil diekspor.`, 'success');
+        const deviceId = session?.deviceId || selectedDeviceId;
+        // Workbook is built and streamed by the server; the tab no longer holds every record
+        const a = document.createElement('a');
+        a.href = `/api/sessions/${encodeURIComponent(deviceId)}/${encodeURIComponent(sessionId)}/export?format=xlsx`;
+        a.download = `${sessionName.replace(/[\\/:*?"<>|]/g, '_')}.xlsx`;
+        document.body.appendChild(a); a.click(); a.remove();
+        await showModal('Export Dimulai', `${totalRecords} record dari "${sessionName}" sedang diunduh.`, 'success');
     } catch (e) { await showModal('Export Gagal', 'Error: ' + e.message, 'error'); }
 }
 async function clearRecords() {
@@ -2366,6 +2359,7 @@ async function clearRecords() {
     try {
         await database.ref(`devices/${selectedDeviceId}/History`).remove();
         await database.ref(`devices/${selectedDeviceId}/Sessions`).remove();
+        await database.ref(`devices/${selectedDeviceId}/Archive`).remove();
         historyData = []; recordsBySession = {}; sessionsData = {};
         buildSessionUI();
         await showModal('Berhasil Dihapus', 'Semua data rekaman telah dihapus.', 'success');
@@ -2376,9 +2370,11 @@ let captureInterval = 3000;
 let _captureTransitioning = false;
 let _captureStatusPollId = null;
 let _intervalUserEdited = false;
+let _liveSessionIds = new Set();
 async function syncCaptureStatus() {
     try {
-        const status = await fetch('/api/capture/status').then(r => r.json());
+        const status = await fetch(`/api/capture/status?device_id=${encodeURIComponent(selectedDeviceId || '')}`).then(r => r.json());
+        _liveSessionIds = new Set((status.sessions || []).filter(s => s.active && s.device_id === selectedDeviceId).map(s => s.session_id));
         if (!_captureTransitioning) {
             if (status.active) {
                 captureActive = true;
@@ -2392,14 +2388,15 @@ async function syncCaptureStatus() {
         }
         if (!_captureTransitioning && !_intervalUserEdited) {
             const serverSec = status.interval || 3;
+            const subSecond = serverSec < 1;
             captureInterval = serverSec * 1000;
             const inputEl = $('intervalInput'), unitEl = $('intervalUnit');
             if (inputEl && unitEl) {
-                inputEl.value = serverSec;
-                unitEl.value = '1';
+                inputEl.value = subSecond ? Math.round(serverSec * 1000) : serverSec;
+                unitEl.value = subSecond ? '0.001' : '1';
             }
             if (DOM.intervalDisplay)
-                DOM.intervalDisplay.textContent = `Current: ${serverSec} seconds`;
+                DOM.intervalDisplay.textContent = subSecond ? `Current: ${Math.round(serverSec * 1000)} ms` : `Current: ${serverSec} seconds`;
         }
         buildSessionUI();
     } catch (e) { }
@@ -2437,14 +2434,18 @@ async function toggleCapture() {
     }
 }
 async function _apiStopCapture() {
+    const sessionId = currentSessionId;
     captureActive = false;
     currentSessionId = null;
     _captureTransitioning = true;
     _updateCaptureButtonUI(false);
     buildSessionUI();
     try {
-        const json = await fetch('/api/capture/stop', { method: 'POST' })
-            .then(r => r.json());
+        const json = await fetch('/api/capture/stop', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ sessionId, deviceId: selectedDeviceId }),
+        }).then(r => r.json());
         if (!json.ok) {
             await showModal('Error', 'Gagal menghentikan: ' + json.error, 'error');
         }
@@ -2497,7 +2498,7 @@ async function confirmRenameSession() {
     closeSessionNameModal();
     if (!targetId) return;
     try {
-        const phaseKeys = Object.keys(recordsBySession[targetId] || {}).filter(k => /^L\d+$/.test(k));
+        const phaseKeys = _sessionPhaseKeys(targetId);
         if (phaseKeys.length) {
             await Promise.all(phaseKeys.map(ph => database.ref(`devices/${selectedDeviceId}/History/${ph}/${targetId}/_meta`).update({ name: newName })));
         }
@@ -2509,7 +2510,7 @@ async function confirmRenameSession() {
 async function confirmStartCapture() {
     const sessionName = $('sessionNameInput')?.value.trim()
         || `Rekaman ${new Date().toLocaleTimeString('id-ID')}`;
-    const intervalSec = Math.round(captureInterval / 1000) || 3;
+    const intervalSec = captureInterval < 1000 ? captureInterval / 1000 : (Math.round(captureInterval / 1000) || 3);
     closeSessionNameModal();
     const activeDev = _deviceListCache.find(d => d.id === selectedDeviceId);
     const phasesHint = (activeDev?.phases || []).filter(p => p.enabled !== false).map(p => p.phase);
@@ -2596,137 +2597,20 @@ async function confirmChangeTime() {
         return;
     }
 
-    const oldDate = parseTimestamp(oldTimeStr);
-    const newDate = parseTimestamp(newTimeStr);
-    if (isNaN(oldDate.getTime()) || isNaN(newDate.getTime())) {
-        closeChangeTimeModal();
-        showModal('Error', 'Format waktu tidak valid! Gunakan: HH:MM:SS DD/MM/YYYY', 'warning');
-        return;
-    }
-
-    const deltaMs = newDate.getTime() - oldDate.getTime();
-
     try {
         closeChangeTimeModal();
         showGlobalLoader();
-
-        let snap;
-        for (let i = 0; i < 15; i++) {
-            snap = await database.ref(`devices/${selectedDeviceId}/History`).get();
-            let hasRecord = false;
-            if (snap && snap.exists()) {
-                snap.forEach(phaseSnap => {
-                    const sSnap = phaseSnap.child(sessionId);
-                    if (sSnap.exists() && Object.keys(sSnap.val() || {}).length > 1) {
-                        hasRecord = true;
-                    }
-                });
-            }
-            if (hasRecord) break;
-            await new Promise(r => setTimeout(r, 600));
-        }
-
-        let oldestRecTs = Infinity;
-        if (snap && snap.exists()) {
-            snap.forEach(phaseSnap => {
-                const ph = phaseSnap.key;
-                if (!/^L\d+$/.test(ph)) return;
-                const sessSnap = phaseSnap.child(sessionId);
-                if (sessSnap.exists()) {
-                    sessSnap.forEach(recSnap => {
-                        if (recSnap.key === '_meta') return;
-                        const rec = recSnap.val();
-                        if (rec.timestamp) {
-                            const recDate = parseTimestamp(rec.timestamp);
-                            if (!isNaN(recDate.getTime()) && recDate.getTime() < oldestRecTs) {
-                                oldestRecTs = recDate.getTime();
-                            }
-                        }
-                    });
-                }
-            });
-        }
-
-        if (oldestRecTs === Infinity) oldestRecTs = oldDate.getTime();
-        const deltaMs = newDate.getTime() - oldestRecTs;
-
-        let shiftEpoch = Infinity;
-        try {
-            const res = await fetch('/api/capture/shift_time', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ sessionId, deltaMs })
-            }).then(r => r.json());
-            if (res && res.shift_epoch) shiftEpoch = res.shift_epoch * 1000;
-        } catch (err) { console.error('Failed to shift backend time', err); }
-
-        await new Promise(r => setTimeout(r, 3500));
-
-        let updates = {};
-        const p2 = v => String(v).padStart(2, '0');
-        const serializeTs = (date) => `${p2(date.getHours())}:${p2(date.getMinutes())}:${p2(date.getSeconds())} ${p2(date.getDate())}/${p2(date.getMonth() + 1)}/${date.getFullYear()}`;
-        const newStartTime = serializeTs(newDate);
-
-        const finalSnap = await database.ref(`devices/${selectedDeviceId}/History`).get();
-        let latestRecTs = 0;
-
-        if (finalSnap && finalSnap.exists()) {
-            finalSnap.forEach(phaseSnap => {
-                const ph = phaseSnap.key;
-                if (!/^L\d+$/.test(ph)) return;
-                const sessSnap = phaseSnap.child(sessionId);
-                if (sessSnap.exists()) {
-                    sessSnap.forEach(recSnap => {
-                        if (recSnap.key === '_meta') return;
-                        const rec = recSnap.val();
-                        if (!rec.timestamp) return;
-
-                        const schedTsStr = recSnap.key.replace('capture_', '');
-                        const schedTs = parseInt(schedTsStr);
-                        const recDate = parseTimestamp(rec.timestamp).getTime();
-                        if (isNaN(recDate)) return;
-
-                        const isAlreadyShifted = (!isNaN(schedTs) && schedTs >= shiftEpoch);
-                        const finalTs = isAlreadyShifted ? recDate : recDate + deltaMs;
-                        if (finalTs > latestRecTs) latestRecTs = finalTs;
-                    });
-                }
-            });
-
-            finalSnap.forEach(phaseSnap => {
-                const ph = phaseSnap.key;
-                if (!/^L\d+$/.test(ph)) return;
-                const sessSnap = phaseSnap.child(sessionId);
-                if (sessSnap.exists()) {
-                    const meta = sessSnap.child('_meta').val() || {};
-                    updates[`devices/${selectedDeviceId}/History/${ph}/${sessionId}/_meta/startTime`] = newStartTime;
-                    if (meta.startTimestamp) {
-                        updates[`devices/${selectedDeviceId}/History/${ph}/${sessionId}/_meta/startTimestamp`] = (meta.startTimestamp || 0) + deltaMs;
-                    }
-                    if (meta.endTime && meta.endTime !== '---' && latestRecTs > 0) {
-                        updates[`devices/${selectedDeviceId}/History/${ph}/${sessionId}/_meta/endTime`] = serializeTs(new Date(latestRecTs));
-                    }
-
-                    sessSnap.forEach(recSnap => {
-                        if (recSnap.key === '_meta') return;
-                        const schedTsStr = recSnap.key.replace('capture_', '');
-                        const schedTs = parseInt(schedTsStr);
-                        if (!isNaN(schedTs) && schedTs >= shiftEpoch) return;
-
-                        const rec = recSnap.val();
-                        if (!rec.timestamp) return;
-                        const recDate = parseTimestamp(rec.timestamp);
-                        if (isNaN(recDate.getTime())) return;
-                        const shiftedDate = new Date(recDate.getTime() + deltaMs);
-                        updates[`devices/${selectedDeviceId}/History/${ph}/${sessionId}/${recSnap.key}/timestamp`] = serializeTs(shiftedDate);
-                    });
-                }
-            });
-        }
-
-        if (Object.keys(updates).length > 0) {
-            await database.ref().update(updates);
+        const url = `/api/sessions/${encodeURIComponent(selectedDeviceId)}/${encodeURIComponent(sessionId)}/shift-time`;
+        let job = await fetch(url, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ newStartTime: newTimeStr })
+        }).then(r => r.json());
+        while (job.ok && (job.state === 'queued' || job.state === 'running')) {
+            await new Promise(r => setTimeout(r, 700));
+            job = await fetch(url).then(r => r.json());
         }
+        if (!job.ok || job.state !== 'done') throw new Error(job.error || 'unknown');
 
         hideGlobalLoader();
         showModal('Sukses', 'Waktu sesi berhasil diubah dan disinkronkan.', 'success');
@@ -2743,7 +2627,7 @@ async function deleteSession(sessionId, sessionName, event) {
     const confirmed = await showModal('Hapus Sesi', `Hapus sesi:\n"${sessionName}"\n\nSemua record akan ikut terhapus.`, 'warning', ['confirm']);
     if (!confirmed) return;
     try {
-        const historyPhaseKeys = Object.keys(recordsBySession[sessionId] || {});
+        const historyPhaseKeys = _sessionPhaseKeys(sessionId);
         const activePhases = getDevicePhasesWithNames().map(p => p.phase);
         const phaseKeys = Array.from(new Set([...historyPhaseKeys, ...activePhases]));
         if (phaseKeys.length > 0) {
@@ -2752,6 +2636,7 @@ async function deleteSession(sessionId, sessionName, event) {
             await database.ref(`devices/${selectedDeviceId}/History/${sessionId}`).remove();
         }
         await database.ref(`devices/${selectedDeviceId}/Sessions/${sessionId}`).remove();
+        await database.ref(`devices/${selectedDeviceId}/Archive/${sessionId}`).remove();
         delete sessionsData[sessionId]; delete recordsBySession[sessionId];
         historyData = historyData.filter(r => r.sessionId !== sessionId);
         buildSessionUI();
@@ -2760,9 +2645,10 @@ async function deleteSession(sessionId, sessionName, event) {
 }
 async function setCaptureInterval() {
     const val = parseInt($('intervalInput')?.value);
-    const multiplier = parseInt($('intervalUnit')?.value);
+    const multiplier = parseFloat($('intervalUnit')?.value);
     if (isNaN(val) || val < 1) { await showModal('Input Tidak Valid', 'Masukkan nilai interval yang valid (minimal 1)!', 'warning'); return; }
-    const totalSec = val * multiplier;
+    if (multiplier < 1 && val < 100) { await showModal('Input Tidak Valid', 'Interval minimal 100 ms!', 'warning'); return; }
+    const totalSec = multiplier < 1 ? val / 1000 : val * multiplier;
     captureInterval = totalSec * 1000;
     _intervalUserEdited = true;
     const unitLabel = $('intervalUnit')?.options[$('intervalUnit').selectedIndex]?.text.toLowerCase() || 'seconds';
@@ -0,0 +1,27 @@
+# The app is imported once, pointed at an in-process RTDB emulator with two
+# simulated devices (dev0000, dev0001; phases L1, L2) updating every 0.1 s.
+import os, sys, time
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'bench')]
+from rtdb_emulator import RTDBEmulator, DeviceSimulator
+
+_emu = RTDBEmulator().start()
+os.environ.update(FIREBASE_DATABASE_URL=_emu.url, SERIES_DB_PATH='', LEADER_MODE='0')
+_sim = DeviceSimulator(_emu, 2, 2, period=0.1).start()
+import app as _app
+import pytest
+
+@pytest.fixture
+def emu(): return _emu
+@pytest.fixture
+def sem(): return _app
+@pytest.fixture
+def client(): return _app.app.test_client()
+
+def wait_for(cond, timeout: float = 20, step: float = 0.1):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        v = cond()
+        if v: return v
+        time.sleep(step)
+    return cond()
@@ -0,0 +1,52 @@
+import numpy as np
+from conftest import wait_for
+
+T0 = 1767236400000   # 10:00:00 01/01/2026 WIB
+
+def _rec(sem, i: int, **kw) -> dict:
+    rec = {'timestamp': sem._fmt_ts(T0 + i * 1000), 'offline': False,
+           **{f: round(220 + i * 0.01, 2) if f == 'Voltage' else round(i * 0.1, 3) for f in sem._ARCHIVE_FIELDS}}
+    rec.update(kw)
+    return {k: v for k, v in rec.items() if v is not None}
+def _session(emu, sem, did: str, sid: str, recs: dict) -> None:
+    meta = {'id': sid, 'name': sid, 'deviceId': did, 'startTime': sem._fmt_ts(T0), 'startTimestamp': T0,
+            'endTime': sem._fmt_ts(T0 + 60000), 'recordCount': len(recs), 'phaseNames': {'L1': 'L1'}}
+    emu.write({f'devices/{did}/Sessions/{sid}': meta, f'devices/{did}/History/L1/{sid}': {'_meta': meta, **recs}})
+def _archive(client, did: str, sid: str, delete_raw: bool = False) -> dict:
+    r = client.post(f'/api/sessions/{did}/{sid}/archive', json={'deleteRaw': delete_raw})
+    assert r.status_code == 202, r.get_json()
+    return wait_for(lambda: (j := client.get(f'/api/sessions/{did}/{sid}/archive').get_json())['state'] in ('done', 'error') and j)
+
+def test_encode_decode_round_trip(sem):
+    n = 500
+    cols = {'ts': np.arange(n, dtype=np.int64) * 1000 + T0, 'display_ms': np.arange(n, dtype=np.int64) * 1000 + T0,
+            'offline': np.arange(n) % 7 == 0, 'Voltage': np.round(220 + np.sin(np.arange(n)), 2),
+            'Power': np.random.default_rng(1).random(n), 'sampled_ms': np.arange(n, dtype=np.float64) * 1000 + T0}
+    cols['Voltage'][[3, 40]] = np.nan
+    out = sem._archive_decode(sem._archive_encode(cols))
+    assert out.keys() == cols.keys()
+    for k, v in cols.items(): np.testing.assert_array_equal(out[k], v)
+    assert len(sem._archive_encode(cols)) < sum(v.nbytes for v in cols.values()) / 2
+
+def test_archive_missing_fields_and_bad_records(client, sem, emu):
+    recs = {f'capture_{T0 + i * 1000}': _rec(sem, i) for i in range(50)}
+    recs[f'capture_{T0 + 5000}'] = _rec(sem, 5, Power=None, Current=None)
+    recs[f'capture_{T0 + 6000}'] = _rec(sem, 6, offline=None)
+    recs[f'capture_{T0 + 7000}'] = _rec(sem, 7, Voltage='n/a')
+    _session(emu, sem, 'arc0', 'session_a', recs)
+    j = _archive(client, 'arc0', 'session_a')
+    assert j['state'] == 'done' and j['records'] == 49 and j['skipped'] == 1
+    assert dict(sem._archive_records(sem._archive_read('arc0', 'session_a', 'L1')))[f'capture_{T0 + 5000}'] == recs[f'capture_{T0 + 5000}']
+    r = client.get('/api/sessions/arc0/session_a/records?phase=L1&fields=Power,Voltage').get_json()
+    assert r['source'] == 'archive' and r['count'] == 49 and r['Power'][5] is None
+
+def test_delete_raw_removes_only_archived_keys(client, sem, emu):
+    recs = {f'capture_{T0 + i * 1000}': _rec(sem, i) for i in range(20)}
+    _session(emu, sem, 'arc1', 'session_b', recs)
+    assert _archive(client, 'arc1', 'session_b')['state'] == 'done'
+    late = f'capture_{T0 + 99000}'
+    emu.write({f'devices/arc1/History/L1/session_b/{late}': _rec(sem, 99)})
+    j = _archive(client, 'arc1', 'session_b', delete_raw=True)
+    assert j['state'] == 'done' and j['raw_deleted']
+    left = emu.get('devices/arc1/History/L1/session_b')
+    assert set(left) == {'_meta', late} and left['_meta']['archived']['raw_deleted']
@@ -0,0 +1,87 @@
+import time
+from conftest import wait_for
+
+def _start(client, did, interval, phases=('L1',)):
+    r = client.post('/api/capture/start', json={'deviceId': did, 'interval': interval, 'phases': list(phases)})
+    assert r.status_code == 200, r.get_json()
+    return r.get_json()['session_id']
+def _stop(client, sem, sid):
+    assert client.post('/api/capture/stop', json={'sessionId': sid}).get_json()['ok']
+    assert wait_for(lambda: sid not in sem._capture_sessions, 30)
+def _status(client, sid): return client.get(f'/api/capture/status?session_id={sid}').get_json()
+
+def test_highrate_sessions_share_stream(client, sem):
+    a = _start(client, 'dev0000', 0.2)
+    b = _start(client, 'dev0000', 0.25)
+    assert wait_for(lambda: (st := sem._rt_streams.get('dev0000')) is not None and st.healthy)
+    assert wait_for(lambda: _status(client, b)['count'] >= 5)
+    _stop(client, sem, a)
+    st = sem._rt_streams.get('dev0000')
+    assert st is not None and st.healthy
+    missed = _status(client, b)['missed']
+    time.sleep(2)
+    assert _status(client, b)['missed'] == missed
+    _stop(client, sem, b)
+    assert 'dev0000' not in sem._rt_streams
+
+def test_finalize_drains_dispatched_ticks(client, sem, emu, monkeypatch):
+    orig = sem.fb_get_realtime
+    def slow(did):
+        if did == 'dev0001': time.sleep(3)
+        return orig(did)
+    monkeypatch.setattr(sem, 'fb_get_realtime', slow)
+    sid = _start(client, 'dev0001', 1)
+    assert wait_for(lambda: _status(client, sid)['count'] >= 2)
+    _stop(client, sem, sid)
+    def written():
+        sem._fb_writes.flush()
+        h = emu.get(f'devices/dev0001/History/L1/{sid}') or {}
+        return sum(k.startswith('capture_') for k in h), h.get('_meta', {}).get('recordCount')
+    n, count = written()
+    assert n == count
+    time.sleep(4)
+    assert written() == (n, count)
+
+def test_status_reports_active_session_of_device(client, sem):
+    a = _start(client, 'dev0000', 1)
+    b = _start(client, 'dev0000', 2)
+    assert client.post('/api/capture/stop', json={'deviceId': 'dev0000'}).status_code == 400
+    assert client.post('/api/capture/stop', json={'sessionId': a}).get_json()['ok']
+    st = client.get('/api/capture/status?device_id=dev0000').get_json()
+    assert st['session_id'] == b and st['active']
+    _stop(client, sem, b)
+    assert wait_for(lambda: a not in sem._capture_sessions, 30)
+
+def test_series_fed_once_per_sample(client, sem, emu, monkeypatch):
+    class Recorder:
+        def __init__(self): self.rows = []
+        def add(self, did, ph, ts_ms, rec): self.rows.append((did, ph, ts_ms))
+    rec = Recorder(); monkeypatch.setattr(sem, '_series', rec)
+    sid = _start(client, 'dev0001', 1)
+    assert wait_for(lambda: _status(client, sid)['count'] >= 3)
+    _stop(client, sem, sid)
+    keys = {int(k[8:]) for k in emu.get(f'devices/dev0001/History/L1/{sid}') or {} if k.startswith('capture_')}
+    assert keys and any(r[0] == 'dev0001' for r in rec.rows)
+    assert not keys & {ts for did, ph, ts in rec.rows if did == 'dev0001'}
+
+def test_shift_active_session_keeps_one_offset(client, sem, emu, monkeypatch):
+    orig = sem._scheduler.wait_idle
+    def wait_idle(pred, timeout=None):
+        # Let ticks past the shift boundary land before the rewrite scan
+        r = orig(pred, timeout); time.sleep(2.5); return r
+    monkeypatch.setattr(sem._scheduler, 'wait_idle', wait_idle)
+    sid = _start(client, 'dev0001', 1)
+    assert wait_for(lambda: _status(client, sid)['count'] >= 3)
+    r = client.post(f'/api/sessions/dev0001/{sid}/shift-time', json={'newStartTime': '08:00:00 01/01/2026'})
+    assert r.status_code == 202, r.get_json()
+    j = wait_for(lambda: (j := client.get(f'/api/sessions/dev0001/{sid}/shift-time').get_json())['state'] in ('done', 'error') and j, 30)
+    assert j['state'] == 'done', j
+    n = _status(client, sid)['count']
+    assert wait_for(lambda: _status(client, sid)['count'] >= n + 3)
+    _stop(client, sem, sid)
+    sem._fb_writes.flush()
+    h = emu.get(f'devices/dev0001/History/L1/{sid}')
+    offs = {k: sem._parse_ts(v['timestamp']) - int(k[8:]) for k, v in h.items() if k.startswith('capture_')}
+    assert len(offs) >= n + 3
+    assert all(abs(o - j['delta_ms']) < 2000 for o in offs.values()), offs
+    assert h['_meta']['startTime'] == '08:00:00 01/01/2026'
@@ -0,0 +1,22 @@
+import pytest
+import app
+
+def _consumed(energy: list) -> float:
+    agg = app._DayAgg()
+    for i, e in enumerate(energy): agg.add(f'capture_{i:04d}', {'Energy': e})
+    return agg.record('2026-01-01')['EnergyConsumed']
+
+@pytest.mark.parametrize('energy, expected', [
+    ([1, 2, 3], 2),
+    ([100, 105, 110, 0, 2, 5], 15),
+    ([2, 4, 3, 6], 8),
+    ([5], 0),
+])
+def test_energy_consumed_across_reset(energy, expected):
+    assert _consumed(energy) == pytest.approx(expected)
+
+def test_energy_consumed_tail_rewrite():
+    # The open bucket is re-written in place; only its last value counts
+    agg = app._DayAgg()
+    for key, e in (('a', 10), ('b', 12), ('b', 13), ('b', 16)): agg.add(key, {'Energy': e})
+    assert agg.record('2026-01-01')['EnergyConsumed'] == pytest.approx(6)
@@ -0,0 +1,12 @@
+import json
+from conftest import wait_for
+
+def test_registry_refreshes_without_periodic_job(sem, emu, monkeypatch):
+    # A follower falling back to its own registry has no refresh job scheduled
+    emu.write({'devices/reg0/meta': {'name': 'Before', 'sensors': {}}})
+    reg = sem._DeviceRegistry()
+    names = lambda: {d['id']: d['name'] for d in json.loads(reg.response()[0])}
+    assert names()['reg0'] == 'Before'
+    emu.write({'devices/reg0/meta/name': 'After'})
+    monkeypatch.setattr(sem, 'DEVICE_REFRESH_S', 0.2)
+    assert wait_for(lambda: names()['reg0'] == 'After', 5)
@@ -0,0 +1,15 @@
+import csv, io, zipfile
+from test_archive import T0, _rec, _session
+
+def test_csv_export_streams_all_pages_in_order(client, sem, emu):
+    n = 2 * sem.EXPORT_PAGE_SIZE + 345
+    _session(emu, sem, 'exp0', 'session_x', {f'capture_{T0 + i * 1000}': _rec(sem, i, offline=i % 100 == 50) for i in range(n)})
+    r = client.get('/api/sessions/exp0/session_x/export?format=csv')
+    assert r.status_code == 200 and r.is_streamed and r.mimetype == 'application/zip'
+    zf = zipfile.ZipFile(io.BytesIO(r.get_data()))
+    assert sorted(zf.namelist()) == ['L1.csv', 'Summary.csv']
+    rows = list(csv.reader(io.StringIO(zf.read('L1.csv').decode('utf-8-sig'))))
+    assert rows[0] == sem._EXPORT_HEADER and len(rows) == n + 1
+    assert [row[1] for row in rows[1:]] == [sem._fmt_ts(T0 + i * 1000) for i in range(n)]
+    assert [i for i, row in enumerate(rows[1:]) if row[2] == 'OFFLINE'] == list(range(50, n, 100))
+    assert client.get('/api/sessions/exp0/missing/export').status_code == 404
@@ -0,0 +1,69 @@
+import threading, time
+from conftest import wait_for
+
+def _queue(sem, monkeypatch, delay: float = 0.0):
+    q, sent = sem._WriteQueue(), []
+    orig = q._send
+    def send(updates):
+        sent.append(dict(updates)); time.sleep(delay)
+        return orig(updates)
+    monkeypatch.setattr(q, '_send', send)
+    return q, sent
+
+def test_write_queue_splits_overlapping_paths(sem, emu, monkeypatch):
+    q, sent = _queue(sem, monkeypatch)
+    q.put('wqtest/a', {'v': 1, 'w': 1})
+    q.put('wqtest/a/v', 2)
+    q.put('wqtest/b', 3)
+    q.put('wqtest/a/v', 4)
+    assert q.flush(5)
+    assert [sorted(b) for b in sent] == [['wqtest/a'], ['wqtest/a/v', 'wqtest/b']]
+    assert emu.get('wqtest') == {'a': {'v': 4, 'w': 1}, 'b': 3}
+    assert q.snapshot()['failed'] == 0
+
+def test_write_queue_flush_waits_only_for_pending(sem, emu, monkeypatch):
+    q, _ = _queue(sem, monkeypatch)
+    hold, late, done = threading.Event(), threading.Event(), threading.Event()
+    orig = q._send
+    def send(updates):
+        hold.wait(10)
+        if updates.get('wqflush/a') == 'late': late.wait(10)
+        return orig(updates)
+    monkeypatch.setattr(q, '_send', send)
+    q.put('wqflush/a', {'b': 1}); q.put('wqflush/a/b', 2)
+    threading.Thread(target=lambda: q.flush(10) and done.set(), daemon=True).start()
+    assert wait_for(lambda: q._urgent, 2)
+    q.put('wqflush/a', 'late')
+    hold.set()
+    try:
+        assert done.wait(5)
+        assert emu.get('wqflush/a') == {'b': 2}
+    finally: late.set()
+    assert q.flush(5) and emu.get('wqflush/a') == 'late'
+
+def test_cache_lru_eviction_and_revalidation(sem, emu):
+    emu.write({f'cachetest/lru/{k}': {'blob': k * 400} for k in 'abc'})
+    c = sem._ResponseCache(1000)
+    for k in 'abc': assert c.get(f'cachetest/lru/{k}')['blob'] == k * 400
+    assert c.stats['misses'] == 3 and c.stats['evictions'] == 1
+    assert 'cachetest/lru/a' not in c._entries and list(c._entries) == ['cachetest/lru/b', 'cachetest/lru/c']
+    b = c._entries['cachetest/lru/b'].data
+    assert c.get('cachetest/lru/b') is b and c.stats['not_modified'] == 1
+    assert list(c._entries) == ['cachetest/lru/c', 'cachetest/lru/b']
+    c.get('cachetest/lru/a')
+    assert 'cachetest/lru/c' not in c._entries and c.stats['evictions'] == 2
+
+def test_cache_single_flight(sem, emu, monkeypatch):
+    emu.write({'cachetest/flight': {'v': 1}})
+    orig, calls = sem._fb_request, []
+    def slow(method, path, **kw):
+        if path.startswith('cachetest/'): calls.append(path); time.sleep(0.5)
+        return orig(method, path, **kw)
+    monkeypatch.setattr(sem, '_fb_request', slow)
+    c, out = sem._ResponseCache(1 << 20), []
+    ts = [threading.Thread(target=lambda: out.append(c.get('cachetest/flight'))) for _ in range(6)]
+    for t in ts: t.start()
+    for t in ts: t.join()
+    assert out == [{'v': 1}] * 6 and calls == ['cachetest/flight']
+    assert c.stats['misses'] == 1 and c.stats['coalesced'] == 5
+    assert wait_for(lambda: not c._inflight, 1)
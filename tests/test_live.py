@@ -0,0 +1,49 @@
+def _apply(state: dict, delta: dict) -> None:
+    for ph, pd in delta['d'].items():
+        if pd is None: state.pop(ph, None); continue
+        cur = state.setdefault(ph, {})
+        for k, v in pd.items():
+            if v is None: cur.pop(k, None)
+            else: cur[k] = v
+
+def test_delta_signals_removed_fields_and_phases(sem):
+    frames = [
+        {'L1': {'v': 220, 'i': 1.0}, 'L2': {'v': 221, 'i': 2.0}},
+        {'L1': {'v': 220, 'i': 1.5}, 'L2': {'v': 221, 'i': 2.0}},
+        {'L1': {'v': 220}, 'L2': {'v': 222, 'i': 2.0}},
+        {'L1': {'v': 219, 'i': 0.5}},
+        {'L1': {'v': 219, 'i': 0.5}, 'L3': {'v': 230}},
+    ]
+    last, state = {}, {}
+    for i, f in enumerate(frames):
+        _apply(state, sem._delta_entry({'t': i, 'd': f}, last))
+        assert state == f
+
+def test_change_tracker_deadband_uses_last_accepted(sem, monkeypatch):
+    monkeypatch.setitem(sem.CHANGE_DEADBAND, 'Power (W)', 5)
+    ct, did = sem._ChangeTracker(), 'dbtest'
+    raw = {'L1': {'Power (W)': 100.0, 'Voltage (V)': 220.0}}
+    assert ct.observe(did, raw, 1)['seq'] == 1
+    assert ct.observe(did, raw, 2) is None
+    for p in (103.0, 104.5, 96.0): assert ct.observe(did, {'L1': {'Power (W)': p, 'Voltage (V)': 220.0}}, 3) is None
+    rec = ct.observe(did, {'L1': {'Power (W)': 105.0, 'Voltage (V)': 220.0}}, 4)
+    assert rec['changes'] == {'L1': {'Power (W)': 5.0}} and rec['phases'] == ['L1']
+    assert ct.observe(did, {'L1': {'Power (W)': 101.0, 'Voltage (V)': 220.5}}, 5)['changes'] == {'L1': {'Voltage (V)': 0.5}}
+    rec = ct.observe(did, {'L1': {'Power (W)': 101.0}}, 6)
+    assert rec['changes'] == {'L1': {'Voltage (V)': None}}
+    assert [r['seq'] for r in ct.since(did, 1)] == [2, 3, 4] and ct.last_change_ms(did) == 6
+    assert ct.stats()[did]['unchanged_identity'] == 1
+
+def test_live_ring_since_cursor(sem):
+    ring = sem._LiveRing(window_s=60, max_entries=256)
+    for i in range(100):
+        if i % 10 == 9: ring.append_offline(1000 * i)
+        else: ring.append(1000 * i, {'L1': {'Voltage (V)': 220 + i, 'Power (W)': i}, 'Status': 'ok'})
+    assert len(ring) == 61 and ring.last_ts() == 99000
+    got, cur = [], 30000
+    while (w := ring.window(cur, compact=True)):
+        got += w[:7]; cur = w[:7][-1]['t']
+    assert [e['t'] for e in got] == list(range(39000, 100000, 1000))
+    assert got[0] == {'t': 39000, 'off': 1} and got[1] == {'t': 40000, 'd': {'L1': {'v': 260.0, 'p': 40.0}}}
+    assert ring.window(99000) == [] and [e['timestamp'] for e in ring.window(None, seconds=2)] == [97000, 98000, 99000]
+    assert not ring.wait_newer(99000, 0.05)
@@ -0,0 +1,35 @@
+import threading, time
+from conftest import wait_for
+
+def test_bulk_jobs_do_not_starve_ticks(sem):
+    sch, gate, ran = sem._Scheduler(2, 1), threading.Event(), []
+    for i in range(4): sch.submit(gate.wait, 10, key=f'finalize:{i}', bulk=True)
+    for i in range(10): sch.submit(ran.append, i, key=f'capture:d:{i}', deadline=0.5)
+    assert wait_for(lambda: len(ran) == 10, 2)
+    assert sch.snapshot()['expired'] == 0
+    gate.set()
+    assert sch.wait_idle(lambda k: k.startswith('finalize:'), 5)
+
+def test_merge_reruns_once_and_skip_collapses(sem):
+    sch, gate, runs = sem._Scheduler(4, 1), threading.Event(), []
+    def job(tag): runs.append(tag); gate.wait(5)
+    sch.submit(job, 'm0', key='m', overlap='merge')
+    assert wait_for(lambda: runs == ['m0'], 2)
+    for i in (1, 2, 3): assert sch.submit(job, f'm{i}', key='m', overlap='merge') is None
+    sch.submit(job, 's0', key='s')
+    assert wait_for(lambda: 's0' in runs, 2)
+    assert sch.submit(job, 's1', key='s') is None
+    gate.set()
+    assert sch.wait_idle(lambda k: True, 5)
+    assert sorted(runs) == ['m0', 'm3', 's0']
+    st = sch.snapshot()
+    assert st['merged'] == 3 and st['collapsed'] == 1 and st['keys'] == 0
+
+def test_deadline_expires_late_tasks(sem):
+    sch, ran = sem._Scheduler(2, 1), []
+    sch.submit(ran.append, 'late', key='capture:d:1', deadline=0.5, sched=time.monotonic() - 2)
+    sch.submit(ran.append, 'ok', key='capture:d:2', deadline=0.5)
+    assert sch.wait_idle(lambda k: k.startswith('capture:'), 2)
+    assert ran == ['ok'] and sch.snapshot()['expired'] == 1
+    sch.submit(ran.append, 'again', key='capture:d:1', deadline=0.5)
+    assert wait_for(lambda: 'again' in ran, 2)